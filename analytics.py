@@ -0,0 +1,237 @@
+# ------------ LIBRARIES ------------ #
+from flask import abort
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import glob
+import json
+import os
+
+from data_build import years, county_fips, rent_caps, read_partition, concat_rows, write_json
+from data_api import make_payload, payload_response, column_values, data_version, catalog_version
+
+
+# ------------ PLACE ANALYTICS ------------ #
+# Aggregates of the tract median rents (B25058_001E) for every place and year,
+# computed for the whole masterfile in one vectorized pass rather than place by
+# place:
+#
+#   tracts, reported, capped         tracts in the place, with an estimate, and with a capped estimate
+#   median                           median of the tract medians
+#   median_censored                  1 when the median falls among capped tracts, so it is unknown
+#   yoy                              change of the median from the previous year
+#   cagr, cagr_since                 compound annual growth of the median since the place's first year with one
+#   rank, ranked                     rank of the median among the places of the county (1 = highest, censored medians tie first)
+#   changes, change_p10 ... p90      tracts with a change from the previous year, and quantiles of those changes
+#
+# The masterfile carries no renter counts, so every tract weighs the same.
+# Missing estimates (NaN) are left out of every statistic. Capped estimates (the
+# $2001 and $3501 sentinels, see data_build.RENT_CAPS) are only known to be at
+# least the cap: they count towards the median as values above every other, and
+# a median that lands on one is reported as unknown. Tract changes from or to a
+# capped estimate are left out.
+#
+# Results are cached on disk per data version (cache/analytics/{data_version}.json),
+# as the JSON served to the client.
+
+ESTIMATE = 'B25058_001E'
+
+CHANGE_QUANTILES = {'change_p10': 0.1, 'change_p25': 0.25, 'change_p50': 0.5, 'change_p75': 0.75, 'change_p90': 0.9}
+
+METRICS = ['tracts', 'reported', 'capped', 'median', 'median_censored', 'yoy', 'cagr', 'cagr_since',
+           'rank', 'ranked', 'changes'] + list(CHANGE_QUANTILES)
+
+# Bump whenever the metrics change, so that cached results are not reused
+ANALYTICS_FORMAT = 2
+
+
+# Purpose: Quantile of the values of each group, with NaN left out and +inf sorting above everything
+def group_quantiles(groups, values, ngroups, q):
+    """
+    Interpolates linearly between the two closest values, like numpy.quantile.
+    Groups without values, and groups whose quantile involves an infinite
+    (censored) value, get NaN.
+    """
+    keep = ~np.isnan(values)
+    groups, values = groups[keep], values[keep]
+    counts = np.bincount(groups, minlength=ngroups)
+    result = np.full(ngroups, np.nan)
+    if len(values) == 0:
+        return result
+
+    values = values[np.lexsort((values, groups))]
+    starts = np.cumsum(counts) - counts
+    position = np.maximum(counts - 1, 0) * q
+    lower = np.floor(position).astype(np.int64)
+    fraction = position - lower
+    upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+
+    present = counts > 0
+    a = values[(starts + lower)[present]]
+    b = values[(starts + upper)[present]]
+    with np.errstate(invalid='ignore'):
+        quantile = np.where(fraction[present] == 0, a, a + (b - a) * fraction[present])
+    quantile[np.isinf(quantile)] = np.nan
+    result[present] = quantile
+    return result
+
+
+# Purpose: Compute every metric for every place and year of a masterfile
+def place_metrics(masterfile):
+    """
+    Returns one row per (PLACE, YEAR), sorted, with the place's COUNTY (the
+    county holding most of its tracts) and the columns in METRICS.
+    """
+    df = masterfile[['PLACE', 'YEAR', 'GEO_ID', ESTIMATE]].reset_index(drop=True)
+    values = df[ESTIMATE].to_numpy(dtype=float)
+    capped = values >= rent_caps(df['YEAR'].to_numpy())
+    uncapped = np.where(capped, np.nan, values)
+
+    grouped = df.groupby(['PLACE', 'YEAR'], sort=True, observed=True)
+    groups = grouped.ngroup().to_numpy()
+    result = grouped.size().rename('tracts').reset_index()
+    result['PLACE'] = result['PLACE'].astype(object)
+    ngroups = len(result)
+
+    result['reported'] = np.bincount(groups, weights=~np.isnan(values), minlength=ngroups).astype(np.int64)
+    result['capped'] = np.bincount(groups, weights=capped, minlength=ngroups).astype(np.int64)
+    result['median'] = group_quantiles(groups, np.where(capped, np.inf, values), ngroups, 0.5)
+    result['median_censored'] = ((result['reported'] > 0) & result['median'].isna()).astype(np.int64)
+
+    # Each tract's change from the previous year, within the same place
+    previous = pd.DataFrame({'PLACE': df['PLACE'], 'GEO_ID': df['GEO_ID'], 'YEAR': df['YEAR'] + 1,
+                             'PREVIOUS': uncapped}).drop_duplicates(['PLACE', 'GEO_ID', 'YEAR'])
+    previous = df[['PLACE', 'GEO_ID', 'YEAR']].merge(previous, on=['PLACE', 'GEO_ID', 'YEAR'], how='left')
+    change = uncapped / previous['PREVIOUS'].to_numpy() - 1
+    result['changes'] = np.bincount(groups, weights=~np.isnan(change), minlength=ngroups).astype(np.int64)
+    for col, q in CHANGE_QUANTILES.items():
+        result[col] = group_quantiles(groups, change, ngroups, q)
+
+    # Year-over-year change and growth since the first year, along each place's years
+    by_place = result.groupby('PLACE', sort=False)
+    consecutive = by_place['YEAR'].shift().to_numpy() == result['YEAR'].to_numpy() - 1
+    result['yoy'] = np.where(consecutive, result['median'] / by_place['median'].shift() - 1, np.nan)
+
+    first = result[result['median'].notna()].groupby('PLACE')[['YEAR', 'median']].first()
+    since = result['PLACE'].map(first['YEAR'])
+    span = result['YEAR'] - since
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cagr = (result['median'] / result['PLACE'].map(first['median'])) ** (1 / span) - 1
+    result['cagr'] = cagr.where(span > 0)
+    result['cagr_since'] = since.where(span > 0)
+
+    # Rank within the county, among the places with a median. A censored median is
+    # above every uncapped one, so those places tie for the top
+    counties = pd.Series(county_fips(df['GEO_ID'].to_numpy()), index=df.index)
+    place_county = counties.groupby(df['PLACE'], observed=True).agg(lambda county: county.value_counts().index[0])
+    result['COUNTY'] = result['PLACE'].map(place_county)
+    ranked_median = result['median'].mask(result['median_censored'] == 1, np.inf)
+    by_county = ranked_median.groupby([result['COUNTY'], result['YEAR']], sort=False)
+    result['rank'] = by_county.rank(ascending=False, method='min')
+    result['ranked'] = by_county.transform('count')
+    return result[['PLACE', 'YEAR', 'COUNTY'] + METRICS]
+
+
+# Purpose: Lay out the metrics per place, each as an array over `years` with null where the place has no data
+def metrics_table(metrics):
+    table = {'format': ANALYTICS_FORMAT, 'YEAR': list(years), 'metrics': METRICS, 'places': dict()}
+    for place, rows in metrics.groupby('PLACE', sort=True):
+        cols = rows['YEAR'].to_numpy() - years.start
+        entry = {'COUNTY': rows['COUNTY'].iloc[0]}
+        for col in METRICS:
+            values = np.full(len(years), np.nan)
+            values[cols] = rows[col].to_numpy(dtype=float)
+            entry[col] = column_values(values)
+        table['places'][place] = entry
+    return table
+
+
+
+# ------------ CACHE ------------ #
+
+# Data version -> metrics table, for this process
+tables = dict()
+
+
+# Purpose: Read every partition of a catalog of a data store (its current one by default) into one masterfile
+def read_masterfile(store, catalog=None):
+    # Partitions are read directly rather than through the store, so that a full
+    # pass does not evict what the app is serving from its cache
+    catalog = catalog or store.catalog
+    return concat_rows(read_partition(county, year, store.folder)
+                       for county, entry in sorted(catalog['counties'].items()) for year in entry['years'])
+
+
+# Purpose: Metrics table of a catalog of a data store (its current one by default), computed once per data version
+def analytics_table(store, catalog=None):
+    """
+    The catalog is read once, so that the table and its data version match even
+    when the store swaps in a new catalog meanwhile (see data_store.open_data_store).
+    """
+    catalog = catalog or store.catalog
+    version = catalog['data_version']
+    if version in tables:
+        return tables[version]
+    path = f'{store.folder}analytics/{version}.json'
+    try:
+        with open(path) as file:
+            table = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        table = None
+    if table is None or table.get('format') != ANALYTICS_FORMAT:
+        table = metrics_table(place_metrics(read_masterfile(store, catalog)))
+        write_json(path, table)
+        for stale in set(glob.glob(f'{store.folder}analytics/*.json')) - {path}:
+            os.remove(stale)
+    tables[version] = table
+    return table
+
+
+# Purpose: Payload of the metrics table, for the API and static exports
+def analytics_payload(store, catalog=None):
+    return make_payload(analytics_table(store, catalog))
+
+
+
+# ------------ ROUTES ------------ #
+
+# Purpose: Serve the place metrics alongside the data API
+def register_analytics_api(server, store, preload=False):
+    """
+    Endpoints (relative to the app's base path):
+
+    data/<version>/analytics/places.json   every metric of every place, each an array over the years
+
+    The metrics are computed on the first request, or read from the cache;
+    right away when preloading.
+    """
+    # Keyed by data version, which changes while the store is still loading years
+    @functools.lru_cache(maxsize=1)
+    def cached_payload(version):
+        catalog = store.catalog
+        if catalog_version(catalog) != version:
+            # The store moved on since the version was checked; aborting leaves nothing cached
+            abort(404)
+        return analytics_payload(store, catalog)
+
+    if preload:
+        cached_payload(data_version(store))
+
+    @server.route('/data/<version_id>/analytics/places.json')
+    def place_analytics(version_id):
+        if version_id != data_version(store):
+            abort(404)
+        return payload_response(cached_payload(version_id))
+
+
+
+# ------------ EXECUTE THE ANALYTICS ------------ #
+if __name__ == '__main__':
+    from data_store import open_data_store
+
+    parser = argparse.ArgumentParser(description='Compute the rent metrics of every place and year.')
+    parser.add_argument('output', help='CSV file to write the metrics to')
+    args = parser.parse_args()
+
+    place_metrics(read_masterfile(open_data_store())).to_csv(args.output, index=False)
@@ -14,57 +14,28 @@ import plotly.express as px
 import plotly.graph_objects as go
 import json
 from copy import deepcopy
+from flask import Response, request
 import os
 
-# ------------ DATA COLLECTION ------------ #
-assets_path = "assets/"
+from metrics import startup_mark, register_metrics, client_meta_tags
+from data_store import open_data_store, PRELOAD
+from data_api import register_data_api
+from geometry_api import register_geometry_api
+from lookup_api import register_lookup_api
+from analytics import register_analytics_api
+from export_api import register_export_api, export_formats
+from data_build import years
 
-data_path = "masterfiles/"
+# ------------ DATA COLLECTION ------------ #
 
 # -- Masterfile -- #
-masterfile = pd.DataFrame()
-years = range(2010, 2024)
-
-for year in years:
-    file_path = f'{data_path}contract_rent_masterfile_{year}.csv'
-    df = pd.read_csv(file_path)
-    map_path = f'{assets_path}contract_rent_mastergeometry_{year}.json'
-    gdf = gpd.read_file(map_path)
-    df = pd.merge(df, gdf[['GEO_ID','INTPTLAT','INTPTLON']], on='GEO_ID', how='left')
-
-    # For the trace
-    df['dummy'] = 1
-
-    # This is done because the ACS data caps values at $3501 (for data years
-    # after 2014) and $2001 (for data years 2014 and prior). Thus, if a certain
-    # metric indicates that number, it means the selected metric is obviously much
-    # higher.
-
-    # cc. Example: https://data.census.gov/table/ACSDT5Y2015.B25061?q=Renter+Costs&g=160XX00US0643000$1400000
-    # Compare the highest price bin in 2023 ('$3500 or more') to the highest price
-    # bin in 2014 ('$2000 or more') or any year prior to 2014 for that matter.
-
-    # As a side, it appears that max price was revised up from $2000 to $3500,
-    # corresponding to the transition from 2014 to 2015. This possibly reflects
-    # the sentiment that ACS data would not adequately capture the entire spectrum
-    # of variation in rents especially as they occur along the higher end of the spectrum.
-    # Nonetheless, it is curious as to why ACS data does not display or provide higher price bins
-    # for data years prior to 2014.
-    df['B25058_001E_copy'] = df['B25058_001E']
-    df['Median'] = df['B25058_001E_copy']
-    df['75th'] = df['B25059_001E']
-    df['25th'] = df['B25057_001E']
-    columns = ['Median', '75th', '25th']
-    for col in columns:
-        df[col] = '$' + df[col].astype(str)
-        df[col] = df[col].str.replace('.0', '')
-        df.loc[df[col] == '$3501', col] = 'Not available. Exceeds $3500!'
-        df.loc[df[col] == '$nan', col] = 'Not Available!'
-        if year in [2010, 2011, 2012, 2013, 2014]:
-            df.loc[df[col] == '$2001', col] = 'Not available. Exceeds $2000!'
-    df = df[['YEAR', 'PLACE', 'GEO_ID', 'NAME', 'B25058_001E', 'INTPTLAT', 'INTPTLON', 'dummy',
-             'Median', '75th', '25th']]
-    masterfile = pd.concat([masterfile, df], ignore_index = True)
+# Built by data_build.py into county-year partitions. Only the catalog is read
+# here; partitions are loaded on first access and kept in a bounded LRU. In
+# preload mode (gunicorn.conf.py) they are mapped from a dataset shared by every worker.
+# When run directly, stale years are rebuilt in the background once the latest
+# one is ready, and the page picks them up as they land (see data-status below)
+store = open_data_store(background=__name__ == '__main__')
+startup_mark('data_store')
 
 
 
@@ -74,22 +45,36 @@ for year in years:
 def place_year_dictionary():
     place_year_dict = dict()
 
-    places = masterfile['PLACE'].unique().tolist()
-    masterfile['NAME'].unique
-    for place in places:
-        df = masterfile[masterfile['PLACE'] == place]
-        list_of_years = df['YEAR'].unique().tolist()
-        dummy_dict = [{'label': year, 'value': year} for year in list_of_years]
+    for place, entry in store.catalog['places'].items():
+        dummy_dict = [{'label': year, 'value': year} for year in entry['years']]
         place_year_dict[place] = dummy_dict
 
     return place_year_dict
 
 
+# Message listing the years still loading and the years that failed to load, empty when there are none
+def data_status_message(loading, failed):
+    message = []
+    if loading:
+        message.append(f"Still loading {', '.join(str(year) for year in loading)}; these years will appear as they finish.")
+    if failed:
+        message.append(f"Could not load {', '.join(str(year) for year in failed)}.")
+    return ' '.join(message)
+
+
 
 # ------------ CONTAINERS AND STRINGS------------ #
 
 # Container for geospatial choropleth map
 geodata_map = html.Div([
+    dcc.RadioItems(id='map-mode',
+                   options=[{'label': ' Selected place', 'value': 'place'},
+                            {'label': ' All tracts in the county', 'value': 'county'}
+                           ],
+                   value='place',
+                   inline=True,
+                   labelStyle={'padding': '0px 15px 0px 0px'}
+                  ),
     dcc.Graph(
         id = "chloropleth_map",
         config={'modeBarButtonsToRemove': ['pan2d', 'lasso2d', 'select2d', 'resetview'],
@@ -100,6 +85,10 @@ geodata_map = html.Div([
 
 # Container for rent plot
 geodata_plot = html.Div([
+    dcc.Dropdown(id='compare-dropdown',
+                 placeholder='Compare with other census tracts',
+                 multi=True
+                ),
     dcc.Graph(
         id = "rent_plot",
         config={'modeBarButtonsToRemove': ['pan2d', 'lasso2d', 'select2d', 'resetview'],
@@ -110,6 +99,60 @@ geodata_plot = html.Div([
 
 
 
+# Container for the compare places panel
+places_plot = html.Div([
+    dcc.Dropdown(id='compare-places-dropdown',
+                 placeholder='Compare with other places',
+                 multi=True
+                ),
+    dcc.RadioItems(id='places-metric',
+                   options=[{'label': ' Median rent', 'value': 'median'},
+                            {'label': ' Year-over-year change', 'value': 'yoy'},
+                            {'label': ' Annual growth since first year', 'value': 'cagr'},
+                            {'label': ' Tract changes', 'value': 'changes'},
+                            {'label': ' Rank in county', 'value': 'rank'}
+                           ],
+                   value='median',
+                   inline=True,
+                   labelStyle={'padding': '10px 15px 0px 0px'}
+                  ),
+    dcc.Graph(
+        id = "places_plot",
+        config={'modeBarButtonsToRemove': ['pan2d', 'lasso2d', 'select2d', 'resetview'],
+                'displaylogo': False
+               },
+    )
+])
+
+
+
+# Container for the download panel
+download_panel = html.Div([
+    dcc.Dropdown(id='export-places-dropdown',
+                 placeholder='Every place',
+                 multi=True
+                ),
+    dcc.RangeSlider(id='export-years',
+                    min=years.start,
+                    max=years.stop - 1,
+                    step=1,
+                    marks={year: str(year) for year in years},
+                    value=[years.start, years.stop - 1]
+                   ),
+    dcc.RadioItems(id='export-format',
+                   options=[{'label': label, 'value': value}
+                            for value, label in [('csv', ' CSV'), ('parquet', ' Parquet'), ('geojson', ' GeoJSON'),
+                                                 ('geoparquet', ' GeoParquet')]
+                            if value in export_formats()],
+                   value='csv',
+                   inline=True,
+                   labelStyle={'padding': '10px 15px 10px 0px'}
+                  ),
+    html.A("Download", id='export-link', download='', className='btn btn-primary')
+])
+
+
+
 # Footer string
 footer_string = """
 ### <b style='color:#800000;'>Information</b>
@@ -137,7 +180,7 @@ and 75th percentile contract rents for the selected census tract.
    </ul>
 
 2. Data for contract rents were taken from the United States Census Bureau <u style='color:#800000;'><a href="https://www.census.gov/programs-surveys/acs.html" style="color:#800000;">American Community Survey</a></u> (ACS codes B25057, B25058, and B25059).
-3. Redistricting over the years affects the availability of some census tracts in certain cities. Unavailability of data for certain census tracts during select years may affect whether or not census tracts are displayed on the map. For these reasons, some census tracts and their data may only be available for a partial range of years.
+3. Redistricting over the years affects the availability of some census tracts in certain cities. Unavailability of data for certain census tracts during select years may affect whether or not census tracts are displayed on the map. For these reasons, some census tracts and their data may only be available for a partial range of years. Across the change of tract boundaries in 2020, the plot fills the missing years of a tract from the tracts it overlaps, weighted by area, and marks these interpolated years with open markers.
 4. For data years 2014 and prior, the American Community Survey caps the imputation of contract rents at $2000. For data years 2015 and later, the American Community Survey caps the imputation of contract rents at &#36;3500. As a result, some data on select census tracts may be unavailable in virtue of being higher than those permissible by these thresholds.
 
 ### <b style='color:#800000;'>Disclaimer</b>
@@ -159,6 +202,8 @@ Raminder Singh Dubb <br>
 
 # ------------ Initialization ------------ #
 place_year_dict = place_year_dictionary()
+data_alert = data_status_message(store.loading, store.catalog.get('failed_years', dict()))
+startup_mark('place_year_dictionary')
 
 
 # ------------ Colors ------------ #
@@ -178,10 +223,39 @@ CherryRed_color = '#E3242B'
 app = dash.Dash(__name__,
                 external_stylesheets=[dbc.themes.SIMPLEX,
                                       "assets/style.css"
-                                     ]
+                                     ],
+                meta_tags=client_meta_tags()
                )
 server=app.server
 
+# Request timings, response sizes and clientside callback timings on /metrics
+register_metrics(server)
+startup_mark('dash_app')
+
+# Partitions of the masterfile are served from the data API rather than shipped in the layout
+data_version = register_data_api(server, store, preload=PRELOAD)
+startup_mark('data_api')
+
+# Tract geometries for the map are served by the app itself
+geometry_api = register_geometry_api(server, app.get_relative_path)
+startup_mark('geometry_api')
+
+# The county-wide map needs the vector tiles of tile_build.py
+if geometry_api['tiles'] is None:
+    geodata_map.children[0].style = {'display': 'none'}
+
+# Batch point-to-tract lookups for joining geocoded listings to tract rents
+register_lookup_api(server, store, preload=PRELOAD)
+startup_mark('lookup_api')
+
+# Medians, growth and ranks of every place for the compare places panel, computed on first request
+register_analytics_api(server, store, preload=PRELOAD)
+startup_mark('analytics_api')
+
+# Streamed downloads of the tract rows of a selection of places and years
+export_api = register_export_api(server, store, app.get_relative_path)
+startup_mark('export_api')
+
 
 
 app.layout = dbc.Container([
@@ -217,6 +291,15 @@ app.layout = dbc.Container([
                 'padding': 0
                }
             ),
+    # ------------ Years still loading or failed ------------ #
+    dbc.Alert(id='data-alert',
+              children=data_alert,
+              is_open=bool(data_alert),
+              color='warning',
+              style={'margin': '1.5em 0 0 0',
+                     'font-family': 'Trebuchet MS, sans-serif'
+                    }
+             ),
     # ------------ Labels for dropdowns (discarded) ------------ #
     
     # ------------ Dropdowns ------------ #
@@ -289,6 +372,37 @@ app.layout = dbc.Container([
                 'padding': '10px 0px 20px 0px',
                }
             ),
+    # ------------ Compare places ------------ #
+    html.Div([
+        dbc.Card([
+            dbc.CardHeader(children = [html.B("Compare Places"), ": median of tract median contract rents, growth and rank in the county"],
+                           style = {'background-color': SinopiaRed_color,
+                                    'color': '#FFFFFF'}
+                          ),
+            dbc.CardBody([places_plot],
+                         style = {'background-color': AlabasterWhite_color}
+                        )
+        ])
+    ], style = {
+                'padding': '0px 0px 20px 0px',
+               }
+            ),
+    # ------------ Download ------------ #
+    html.Div([
+        dbc.Card([
+            dbc.CardHeader(children = [html.B("Download Data"), ": tract rents of a selection of places and years, as a table or with tract boundaries"],
+                           style = {'background-color': ObsidianBlack_color,
+                                    'color': '#FFFFFF'}
+                          ),
+            dbc.CardBody([download_panel],
+                         style = {'background-color': AlabasterWhite_color}
+                        )
+        ])
+    ], style = {
+                'display': 'block' if export_api is not None else 'none',
+                'padding': '0px 0px 20px 0px',
+               }
+            ),
     # ------------ Footer ------------ #
     html.Div([
         fmc.FefferyMarkdown(markdownStr    = footer_string,
@@ -300,8 +414,22 @@ app.layout = dbc.Container([
     ]
             ),
     # ------------ Data ------------ #
-    dcc.Store(id='masterfile_data',
-              data=masterfile.to_dict("records")
+    dcc.Store(id='data_api',
+              data={'base': app.get_relative_path(f'/data/{data_version}/'),
+                    'status': app.get_relative_path('/data/status.json'),
+                    'counties': {county: entry['name'] for county, entry in store.catalog['counties'].items()}
+                   }
+             ),
+    # Polls data/status.json while years are still loading, starting on page load
+    dcc.Interval(id='data-status',
+                 interval=2000,
+                 disabled=not store.loading
+                ),
+    dcc.Store(id='geometry_api',
+              data=geometry_api
+             ),
+    dcc.Store(id='export_api',
+              data=export_api
              ),
     dcc.Store(id='place_year_dict',
               data=place_year_dict
@@ -309,6 +437,18 @@ app.layout = dbc.Container([
 
 ], style = {'background-color': LightBrown_color, "padding": "0px 0px 20px 0px",})
 
+# The layout never changes, so in preload mode it is serialized once and shared by every
+# worker; Flask's before_request hook answers the layout route with it ahead of Dash's view
+if PRELOAD:
+    layout_json = app.serve_layout().get_data()
+    layout_path = app.config.routes_pathname_prefix + '_dash-layout'
+
+    @server.before_request
+    def cached_layout():
+        if request.path == layout_path:
+            return Response(layout_json, mimetype='application/json')
+startup_mark('layout')
+
 
 
 # ------------ CALLBACKS ------------ #
@@ -317,22 +457,79 @@ app.layout = dbc.Container([
 #
 #
 # Dropdowns:
+#  data status -> data API, place year dictionary, place options, data alert
 #  place value -> year options
-#  year options -> default year value
-#  place options, year options, map ClickData -> census tract options
-#  click data -> census tract value
+#  year options -> year value, kept when still among them
+#  place options, year options, map ClickData -> census tract options, compared tract options
+#  place year dictionary -> compared place options, exported place options
+#  click data, map mode -> census tract value, place value in county mode
 #
 # Titles:
-#  place value, year value -> map title
-#  place value, census tract value -> plot title
+#  place value, year value, map mode -> map title
+#  place value, census tract value, census tract options -> plot title
 #
 # Graphs:
-#  place value, year value, census tract value -> map
-#  place value, census tract value -> plot
+#  place value, year value, census tract value, map mode -> map
+#  place value, census tract value, compared tract values -> plot
+#  place value, compared place values, metric -> compare places plot
+#
+# Download:
+#  exported place values, exported years, export format -> download link
 #
 # ----------------------------------- #
 
 
+# ------------ Data status ------------ #
+
+
+# Years loaded since the page was served, and years still loading or failed
+app.clientside_callback(
+    """
+    async function(n_intervals, disabled, data_api, place_year_dict) {
+        var no_update = window.dash_clientside.no_update;
+        if (disabled) {
+            return [no_update, no_update, no_update, true, no_update, no_update];
+        }
+        var status = await window.rentsData.status(data_api);
+        var done = status.loading.length === 0;
+        var failed = Object.keys(status.failed);
+        var message = [];
+        if (!done) {
+            message.push(`Still loading ${status.loading.join(', ')}; these years will appear as they finish.`);
+        }
+        if (failed.length) {
+            message.push(`Could not load ${failed.join(', ')}.`);
+        }
+        var base = data_api.base.replace(/[^\/]+\/$/, `${status.version}/`);
+        if (base === data_api.base) {
+            return [no_update, no_update, no_update, done, message.join(' '), message.length > 0];
+        }
+
+        var years = {};
+        Object.entries(status.places).forEach(([place, place_years]) => {
+            years[place] = place_years.map(year => ({'label': year, 'value': year}));
+        });
+        var places = Object.keys(years).map(place => ({'label': place, 'value': place}));
+        return [Object.assign({}, data_api, {'base': base, 'counties': status.counties}), years, places,
+                done, message.join(' '), message.length > 0]
+    }
+    """,
+    [Output('data_api', 'data'),
+     Output('place_year_dict', 'data'),
+     Output('place-dropdown', 'options'),
+     Output('data-status', 'disabled'),
+     Output('data-alert', 'children'),
+     Output('data-alert', 'is_open')
+    ],
+    Input('data-status', 'n_intervals'),
+    [State('data-status', 'disabled'),
+     State('data_api', 'data'),
+     State('place_year_dict', 'data')
+    ]
+)
+
+
+
 # ------------ Dropdowns ------------ #
 
 
@@ -353,13 +550,17 @@ app.clientside_callback(
 # Year tract value
 app.clientside_callback(
     """
-    function(options) {
-        var opt = options.find(x => x['label'] === 2023);
+    function(options, selected_year) {
+        if (options.some(x => x['value'] === selected_year)) {
+            return selected_year
+        }
+        var opt = options.find(x => x['label'] === 2023) || options[options.length - 1];
         return opt['label']
     }
     """,
     Output('year-dropdown', 'value'),
-    Input('year-dropdown', 'options')
+    Input('year-dropdown', 'options'),
+    State('year-dropdown', 'value')
 )
 
 
@@ -367,31 +568,58 @@ app.clientside_callback(
 # Census tract options
 app.clientside_callback(
     """
-    function(selected_place, selected_year, masterfile_data) {
+    async function(selected_place, selected_year, data_api) {
+        var timer = window.rentsMetrics.start('tract_options');
         var selected_place = `${selected_place}`;
-        var options = masterfile_data.filter(x => x['YEAR'] === selected_year && x['PLACE'] === selected_place);
-        var tract_options = options.map(item => { return item.NAME });
-        return tract_options
+        var partition = await window.rentsData.partition(data_api, selected_place, selected_year);
+        // Tract names repeat across places and vintages, so the values are GEO_IDs
+        var options = partition.columns.NAME.map((name, row) => ({'label': name, 'value': partition.columns.GEO_ID[row]}));
+        return timer.end([options, options])
     }
     """,
-    Output('census-tract-dropdown', 'options'),
+    [Output('census-tract-dropdown', 'options'),
+     Output('compare-dropdown', 'options')
+    ],
     [Input('place-dropdown', 'value'),
      Input('year-dropdown', 'value'),
-     Input('masterfile_data', 'data')
+     Input('data_api', 'data')
     ]
 )
 
 
 
-# Census tract value based on click data
+# Compared and exported place options
+app.clientside_callback(
+    """
+    function(place_year_dict) {
+        var places = Object.keys(place_year_dict);
+        return [places, places]
+    }
+    """,
+    [Output('compare-places-dropdown', 'options'),
+     Output('export-places-dropdown', 'options')
+    ],
+    Input('place_year_dict', 'data')
+)
+
+
+
+# Census tract value based on click data. On the county-wide map the clicked tract
+# may lie in another place, so the place follows it (customdata is [NAME, PLACE, ..., GEO_ID])
 app.clientside_callback(
     """
-    function(clickData) {
-        return clickData['points']['0']['customdata']
+    function(clickData, map_mode) {
+        var customdata = clickData['points']['0']['customdata'];
+        var selected_place = map_mode === 'county' ? customdata[1] : window.dash_clientside.no_update;
+        return [customdata[6], selected_place]
     }
     """,
-    Output('census-tract-dropdown', 'value'),
-    Input('chloropleth_map', 'clickData')
+    [Output('census-tract-dropdown', 'value'),
+     Output('place-dropdown', 'value')
+    ],
+    Input('chloropleth_map', 'clickData'),
+    State('map-mode', 'value'),
+    prevent_initial_call=True
 )
 
 
@@ -402,8 +630,8 @@ app.clientside_callback(
 # Map title
 app.clientside_callback(
     """
-    function(selected_place, selected_year) {
-        var selected_place = `${selected_place}`;
+    function(selected_place, selected_year, map_mode, data_api) {
+        var selected_place = map_mode === 'county' ? Object.values(data_api.counties).join(', ') : `${selected_place}`;
         var selected_year = `${selected_year}`;
         return [selected_place, selected_year];
     }
@@ -412,7 +640,9 @@ app.clientside_callback(
      Output('map-title2', 'children')
     ],
     [Input('place-dropdown', 'value'),
-     Input('year-dropdown', 'value')
+     Input('year-dropdown', 'value'),
+     Input('map-mode', 'value'),
+     Input('data_api', 'data')
     ]
 )
 
@@ -420,17 +650,19 @@ app.clientside_callback(
 # Plot title
 app.clientside_callback(
     """
-    function(selected_place, selected_tract) {
-        if (selected_tract == undefined){
+    function(selected_place, selected_tract, tract_options) {
+        var option = (tract_options || []).find(x => x['value'] === selected_tract);
+        if (selected_tract == undefined || option == undefined){
             return "Please click on a tract.";
         } else {
-            return `${selected_place}, ${selected_tract}`;
+            return `${selected_place}, ${option['label']}`;
         }
     }
     """,
     Output('plot-title', 'children'),
     [Input('place-dropdown', 'value'),
-     Input('census-tract-dropdown', 'value')
+     Input('census-tract-dropdown', 'value'),
+     Input('census-tract-dropdown', 'options')
     ]
 )
 
@@ -440,80 +672,119 @@ app.clientside_callback(
 # Choropleth map
 app.clientside_callback(
     """
-    function(selected_place, selected_year, selected_tract, masterfile_data){
+    async function(selected_place, selected_year, selected_tract, map_mode, data_api, geometry_api){
+        var timer = window.rentsMetrics.start('choropleth');
         var selected_place = `${selected_place}`;
         var selected_year = Number(selected_year);
-        var my_array = masterfile_data.filter(item => item['PLACE'] === selected_place && item['YEAR'] === selected_year);
-        if ( selected_place.includes("Flintridge") ) {
-           var selected_place = 'La Ca' + \u00f1 + 'ada Flintridge';
-           return selected_place;
-        }
         
-        var place_string = selected_place.replaceAll(' ','');
-        var url_path = "https://raw.githubusercontent.com/ramindersinghdubb/Contract-Rents-in-LA-County/refs/heads/main/as" + "sets/" + selected_year + "/contract_rent_mastergeometry_" + selected_year + "_" + place_string + ".json";
+        var colorbar = {'outlinewidth': 2,
+                        'ticklabelposition': 'outside bottom',
+                        'tickprefix': '$',
+                        'title': {'font': {'color': '#020403', 'weight': 500}, 'text': 'Median Contract<br>Rents ($)'}};
+        var hoverlabel = {'bgcolor': '#FAFAFA', 'bordercolor': '#BEBEBE', 'font': {'color': '#020403'}};
+        // Short labels of each tract for the hovertemplate of schema.json
+        var hover_rows = function(payload, places) {
+            var columns = payload.columns;
+            var year = payload.YEAR;
+            return columns.NAME.map((name, row) => [name, places(row),
+                payload.label(columns.B25058_001E[row], year), payload.moe(columns.B25058_001M[row]),
+                payload.label(columns.B25057_001E[row], year), payload.label(columns.B25059_001E[row], year),
+                columns.GEO_ID[row]]);
+        };
         
-        var locations_array = my_array.map(({GEO_ID}) => GEO_ID);
-        var z_array = my_array.map(({B25058_001E})=>B25058_001E);
-        var customdata_array = my_array.map(({NAME}) => NAME);
+        // Every tract of the county, drawn from vector tiles and colored on the client.
+        // Hovering and clicking go through invisible markers on the tract centroids
+        if (map_mode === 'county' && geometry_api.tiles){
+            var counties = await Promise.all(Object.keys(data_api.counties).map(
+                county => window.rentsData.county(data_api, county, selected_year)));
+            // Built once per year; selecting a tract changes nothing on this map
+            var base = window.rentsFigures.cached(`${data_api.base}|county|${selected_year}`, function() {
+                var column = name => counties.flatMap(county => Array.from(county.columns[name]));
+                var z_array = column('B25058_001E');
+                return {'geo_ids': column('GEO_ID'), 'z': z_array, 'trace': {
+                    'type': 'scattermap',
+                    'uid': 'tracts',
+                    'lat': column('INTPTLAT'),
+                    'lon': column('INTPTLON'),
+                    'customdata': counties.flatMap(county => hover_rows(county, row => county.columns.PLACE[row])),
+                    'meta': [selected_year],
+                    'mode': 'markers',
+                    'marker': {'size': 12, 'opacity': 0, 'color': z_array, 'colorscale': 'YlOrRd', 'reversescale': true,
+                               'cmin': 0, 'cmax': 3500, 'showscale': true, 'colorbar': colorbar},
+                    'hoverlabel': hoverlabel,
+                    'hovertemplate': counties[0].hovertemplates.tract
+                }};
+            });
+            window.rentsTiles.restyle('chloropleth_map', geometry_api.tiles, base.geo_ids, base.z);
+            var viewport = counties[0].viewport;
+            
+            var county_layout = {
+                'autosize': true,
+                'hoverlabel': {'align': 'left'},
+                'map': {'center': viewport.center, 'style': 'streets', 'zoom': viewport.zoom,
+                        'layers': [{'sourcetype': 'vector',
+                                    'source': window.rentsTiles.source(geometry_api, selected_year),
+                                    'sourcelayer': geometry_api.tiles.layer,
+                                    'type': 'fill',
+                                    'color': 'rgba(0,0,0,0)',
+                                    'opacity': 0.4,
+                                    'fill': {'outlinecolor': '#020403'},
+                                    'below': 'traces'}]},
+                'margin': {'b': 0, 'l': 0, 'r': 0, 't': 0},
+                'paper_bgcolor': '#FEF9F3',
+                'plot_bgcolor': '#FEF9F3',
+                // Keep the user's pan and zoom when only the year changes
+                'uirevision': 'county'
+            };
+            return timer.end({'data': [base.trace], 'layout': county_layout})
+        }
+        window.rentsTiles.clear('chloropleth_map');
         
-        var long_array = my_array.map(({INTPTLON})=>INTPTLON);
-        var long_center = long_array.reduce((a, b) => a + b) / long_array.length;
-        const lon_center = parseFloat(long_center.toFixed(5));
+        var partition = await window.rentsData.partition(data_api, selected_place, selected_year);
+        var geometry = await window.rentsGeometry.place(geometry_api, selected_place, selected_year);
         
-        var lat_array = my_array.map(({INTPTLAT})=>INTPTLAT);
-        var lati_center = lat_array.reduce((a, b) => a + b) / lat_array.length;
-        const lat_center = parseFloat(lati_center.toFixed(5));
-
-        var strings = my_array.map(function(item) {
-            return "<b style='font-size:16px;'>" + item['NAME'] + "</b><br>" + item['PLACE'] + ", Los Angeles County<br><br>"
-            + "Median Contract Rent (" + item['YEAR'] + "): <br><b style='color:#800000; font-size:14px;'>" + item['Median'] + "</b> <br><br>"
-            + "25th Percentile Contract Rent (" + item['YEAR'] + "): <br><b style='color:#B22222; font-size:14px;'>" + item['25th'] + "</b> <br><br>"
-            + "75th Percentile Contract Rent (" + item['YEAR'] + "): <br><b style='color:#B22222; font-size:14px;'>" + item['75th'] + "</b> <br><br><extra></extra>";
-            });
-    
-    
-    
-        var main_data = [{
+        // The tracts of the place and year are built once; a new tract selection only
+        // replaces the highlight trace below
+        var main_trace = window.rentsFigures.cached(`${data_api.base}|place|${selected_place}|${selected_year}`, () => ({
             'type': 'choroplethmap',
-            'customdata': customdata_array,
-            'geojson': url_path,
-            'locations': locations_array,
-            'featureidkey': 'properties.GEO_ID',
+            'uid': 'tracts',
+            'customdata': hover_rows(partition, row => partition.PLACE),
+            'meta': [selected_year],
+            'geojson': geometry.geojson,
+            'locations': Array.from(partition.columns.GEO_ID, geometry.keyOf),
+            'featureidkey': geometry.featureidkey,
             'colorscale': 'YlOrRd',
             'reversescale': true,
-            'z': z_array,
+            'z': partition.columns.B25058_001E,
             'zmin': 0, 'zmax': 3500,
             'marker': {'line': {'color': '#020403', 'width': 1.75}, 'opacity': 0.4},
-            'text': strings,
-            'colorbar': {'outlinewidth': 2,
-                         'ticklabelposition': 'outside bottom',
-                         'tickprefix': '$',
-                         'title': {'font': {'color': '#020403', 'weight': 500}, 'text': 'Median Contract<br>Rents ($)'}},
-            'hoverlabel': {'bgcolor': '#FAFAFA', 'bordercolor': '#BEBEBE', 'font': {'color': '#020403'}},
-            'hovertemplate': '%{text}'
-        }];
+            'colorbar': colorbar,
+            'hoverlabel': hoverlabel,
+            'hovertemplate': partition.hovertemplates.tract
+        }));
+        var main_data = [main_trace];
+        
+        // Center and zoom fitted to the place's tracts by data_build.py
+        var viewport = partition.viewport;
     
         var layout = {
             'autosize': true,
             'hoverlabel': {'align': 'left'},
-            'map': {'center': {'lat': lat_center, 'lon': lon_center}, 'style': 'streets', 'zoom': 10},
+            'map': {'center': viewport.center, 'style': 'streets', 'zoom': viewport.zoom},
             'margin': {'b': 0, 'l': 0, 'r': 0, 't': 0},
             'paper_bgcolor': '#FEF9F3',
             'plot_bgcolor': '#FEF9F3',
         };
-        if (selected_tract != undefined){
-            var aux_array = my_array.filter(item => item['NAME'] === selected_tract);
-            var aux_locations_array = aux_array.map(({GEO_ID}) => GEO_ID);
-            var aux_z_array = aux_array.map(({dummy})=>dummy);
-        
+        if (selected_tract != undefined && selected_tract in partition.rowOf){
             var data_aux = {
                 'type': 'choroplethmap',
-                'geojson': url_path,
-                'locations': aux_locations_array,
-                'featureidkey': 'properties.GEO_ID',
+                'uid': 'selected',
+                'geojson': main_trace.geojson,
+                'locations': [main_trace.locations[partition.rowOf[selected_tract]]],
+                'featureidkey': geometry.featureidkey,
                 'colorscale': `[[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']]`,
                 'showscale': false,
-                'z': aux_z_array,
+                'z': [1],
                 'zmin': 0, 'zmax': 1,
                 'marker': {'line': {'color': '#04D9FF', 'width': 4}},
                 'hoverinfo': 'skip',
@@ -521,51 +792,90 @@ app.clientside_callback(
             main_data.push(data_aux);
         }
 
-        return {'data': main_data, 'layout': layout}
+        return timer.end({'data': main_data, 'layout': layout})
     }
     """,
     Output('chloropleth_map', 'figure'),
     [Input('place-dropdown', 'value'),
      Input('year-dropdown', 'value'),
      Input('census-tract-dropdown', 'value'),
-     Input('masterfile_data', 'data')
+     Input('map-mode', 'value'),
+     Input('data_api', 'data'),
+     Input('geometry_api', 'data')
     ]
 )
 
 # Plot
 app.clientside_callback(
     """
-    function(selected_place, selected_tract, masterfile_data){
+    async function(selected_place, selected_tract, compared_tracts, data_api){
+        var timer = window.rentsMetrics.start('rent_plot');
         if (selected_tract != undefined){
             var selected_place = `${selected_place}`;
-            var selected_tract = `${selected_tract}`;
-            var my_array = masterfile_data.filter(item => item['PLACE'] === selected_place && item['NAME'] === selected_tract);
+            var series = await window.rentsData.series(data_api, selected_place);
+            var tract = series.tract(selected_tract);
+            if (tract == undefined){
+                return timer.end(window.dash_clientside.no_update);
+            }
+            var x_array = series.YEAR;
+            // Open markers for the years filled in from the overlapping tracts of the other census boundaries
+            var symbols = flags => Array.from(flags, flag => flag ? 'circle-open' : 'circle');
             
-            var x_array = my_array.map(({YEAR})=>YEAR);
-            var y_array = my_array.map(({B25058_001E})=>B25058_001E);
-    
-            var customdata_array = my_array.map(({NAME}) => NAME);
-    
-            var strings = my_array.map(function(item) {
-                return "<b style='font-size:16px;'>" + item['YEAR'] + "</b><br>" + item['NAME'] + ", " + item['PLACE'] + " <br><br>" +
-                "Median Contract Rent: <br><b style='color:#800000; font-size:14px;'>" + item['Median'] + "</b> <br><br>" +
-                "25th Percentile Contract Rent: <br><b style='color:#B22222; font-size:14px;'>" + item['25th'] + "</b> <br><br>" +
-                "75th Percentile Contract Rent: <br><b style='color:#B22222; font-size:14px;'>" + item['75th'] + "</b> <br><br><extra></extra>";
-                });
-        
-        
-        
+            // The values of a tract's traces are built once, with short labels for the hovertemplates of schema.json
+            var tract_values = geo_id => window.rentsFigures.cached(`${data_api.base}|series|${selected_place}|${geo_id}`, function() {
+                var columns = series.tract(geo_id).columns;
+                var label = (col, index) => series.label(columns[col][index], x_array[index]);
+                return {
+                    'x': x_array,
+                    'y': columns.B25058_001E,
+                    'symbols': symbols(columns.INTERPOLATED),
+                    'moe': columns.B25058_001M,
+                    'customdata': x_array.map((year, i) => [columns.INTERPOLATED[i] ? series.notes.interpolated : "",
+                        label('B25058_001E', i), series.moe(columns.B25058_001M[i]),
+                        label('B25057_001E', i), series.moe(columns.B25057_001M[i]),
+                        label('B25059_001E', i), series.moe(columns.B25059_001M[i])]),
+                    'compared': x_array.map((year, i) => label('B25058_001E', i) + (columns.INTERPOLATED[i] ? " (interpolated)" : ""))
+                };
+            });
+            
+            var selected = tract_values(selected_tract);
             var data = [{
                 'type': 'scatter',
-                'x': x_array,
-                'y': y_array,
+                'name': tract.NAME,
+                'x': selected.x,
+                'y': selected.y,
                 'mode': 'lines+markers',
                 'line': {'color': '#800000'},
-                'marker': {'size': 10, 'line': {'width': 2, 'color': '#F5FBFF'}},
-                'text': strings,
+                'marker': {'size': 10, 'symbol': selected.symbols, 'line': {'width': 2, 'color': '#F5FBFF'}},
+                'error_y': {'type': 'data', 'array': selected.moe, 'color': '#800000', 'thickness': 1},
+                'customdata': selected.customdata,
+                'meta': [tract.NAME, selected_place],
                 'hoverlabel': {'bgcolor': '#FAFAFA', 'bordercolor': '#BEBEBE', 'font': {'color': '#020403'}},
-                'hovertemplate': '%{text}'
+                'hovertemplate': series.hovertemplates.series
             }];
+            
+            // Overlay the medians of the compared tracts, each read straight from the same series
+            var compare_colors = ['#2A9D8F', '#E9C46A', '#F4A261', '#264653', '#8AB17D', '#6D597A'];
+            (compared_tracts || []).filter(geo_id => geo_id !== selected_tract).forEach(function(geo_id, i) {
+                var name = (series.tract(geo_id) || {}).NAME;
+                if (name == undefined){
+                    return;
+                }
+                var other = tract_values(geo_id);
+                data.push({
+                    'type': 'scatter',
+                    'name': name,
+                    'x': other.x,
+                    'y': other.y,
+                    'mode': 'lines+markers',
+                    'line': {'color': compare_colors[i % compare_colors.length], 'width': 1.5},
+                    'marker': {'size': 6, 'symbol': other.symbols},
+                    'customdata': other.compared,
+                    'meta': [name],
+                    'hoverlabel': {'bgcolor': '#FAFAFA', 'bordercolor': '#BEBEBE', 'font': {'color': '#020403'}},
+                    'hovertemplate': series.hovertemplates.compared
+                });
+            });
         
             var layout = {
                 'font': {'color': '#020403'},
@@ -575,22 +885,141 @@ app.clientside_callback(
                 'uirevision': true,
                 'paper_bgcolor': '#FEF9F3',
                 'plot_bgcolor': '#FEF9F3',
+                'showlegend': data.length > 1,
+                'legend': {'orientation': 'h', 'y': -0.2},
                 'title': {'text': `Median Contract Rents, ${Math.min(...x_array)} to ${Math.max(...x_array)}`, 'x': 0.05},
                 'xaxis': {'title': {'text': 'Year', 'ticklabelstandoff': 10}, 'showgrid': false, 'tickvals': x_array},
                 'yaxis': {'title': {'text': 'Median Contract Rents ($)', 'standoff': 15}, 'tickprefix': '$', 'gridcolor': '#E0E0E0', 'ticklabelstandoff': 5},
             };
+            if (data.some(trace => trace.marker.symbol.includes('circle-open'))){
+                layout['annotations'] = [{'text': 'Open markers: interpolated across a change of tract boundaries',
+                                          'xref': 'paper', 'yref': 'paper', 'x': 1, 'y': 1.02, 'xanchor': 'right', 'yanchor': 'bottom',
+                                          'showarrow': false, 'font': {'size': 11, 'color': '#5A5A5A'}}];
+            }
             
-            return {'data': data, 'layout': layout};
+            return timer.end({'data': data, 'layout': layout});
         }
     }
     """,
     Output('rent_plot', 'figure'),
     [Input('place-dropdown', 'value'),
      Input('census-tract-dropdown', 'value'),
-     Input('masterfile_data', 'data')
+     Input('compare-dropdown', 'value'),
+     Input('data_api', 'data')
+    ]
+)
+
+# Compare places plot
+app.clientside_callback(
+    """
+    async function(selected_place, compared_places, metric, data_api){
+        var timer = window.rentsMetrics.start('places_plot');
+        var analytics = await window.rentsData.analytics(data_api);
+        var places = [selected_place].concat((compared_places || []).filter(place => place !== selected_place))
+            .filter(place => place in analytics.places);
+        
+        var money = value => value == null ? "n/a" : "$" + Math.round(value);
+        var percent = value => value == null ? "n/a" : (100 * value).toFixed(1) + "%";
+        var colors = ['#800000', '#2A9D8F', '#E9C46A', '#F4A261', '#264653', '#8AB17D', '#6D597A'];
+        var is_percent = ['yoy', 'cagr', 'changes'].includes(metric);
+        var y_metric = metric === 'changes' ? 'change_p50' : metric;
+        
+        var data = places.map(function(place, i) {
+            var metrics = analytics.places[place];
+            var color = colors[i % colors.length];
+            var strings = analytics.YEAR.map(function(year, col) {
+                if (metrics.tracts[col] == null){
+                    return "<b style='font-size:16px;'>" + year + "</b><br>" + place + "<br><br>No data for this year<extra></extra>";
+                }
+                var median = metrics.median_censored[col] ? "above the cap" : money(metrics.median[col]);
+                var rank = metrics.rank[col] == null ? "n/a" : metrics.rank[col] + " of " + metrics.ranked[col];
+                return "<b style='font-size:16px;'>" + year + "</b><br>" + place + "<br><br>" +
+                "Median of tract median rents: <br><b style='color:#800000; font-size:14px;'>" + median + "</b> <br><br>" +
+                "Year-over-year change: " + percent(metrics.yoy[col]) + "<br>" +
+                "Annual growth since " + (metrics.cagr_since[col] || year) + ": " + percent(metrics.cagr[col]) + "<br>" +
+                "Rank in county: " + rank + "<br>" +
+                "Tract changes, 25th to 75th percentile: " + percent(metrics.change_p25[col]) + " to " + percent(metrics.change_p75[col]) + "<br>" +
+                "Tracts: " + metrics.tracts[col] + " (" + metrics.capped[col] + " capped, " + (metrics.tracts[col] - metrics.reported[col]) + " not available)<extra></extra>";
+            });
+            var scale = value => (value == null ? null : (is_percent ? 100 * value : value));
+            var trace = {
+                'type': 'scatter',
+                'name': place,
+                'x': analytics.YEAR,
+                'y': metrics[y_metric].map(scale),
+                'mode': 'lines+markers',
+                'line': {'color': color, 'width': i == 0 ? 2.5 : 1.5},
+                'marker': {'size': i == 0 ? 9 : 6},
+                'text': strings,
+                'hoverlabel': {'bgcolor': '#FAFAFA', 'bordercolor': '#BEBEBE', 'font': {'color': '#020403'}},
+                'hovertemplate': '%{text}'
+            };
+            // The middle half of the tracts' changes around their median
+            if (metric === 'changes'){
+                trace['error_y'] = {'type': 'data', 'symmetric': false, 'color': color, 'thickness': 1,
+                                    'array': metrics.change_p75.map((value, col) => scale(value) - scale(metrics.change_p50[col])),
+                                    'arrayminus': metrics.change_p25.map((value, col) => scale(metrics.change_p50[col]) - scale(value))};
+            }
+            return trace;
+        });
+        
+        var titles = {'median': 'Median of Tract Median Contract Rents',
+                      'yoy': 'Year-over-Year Change of the Median',
+                      'cagr': 'Annual Growth of the Median since the First Year',
+                      'changes': 'Year-over-Year Change of Tract Medians (Median and Middle 50%)',
+                      'rank': 'Rank of the Median among Places in the County'};
+        var layout = {
+            'font': {'color': '#020403'},
+            'hoverlabel': {'align': 'left'},
+            'margin': {'b': 40, 't': 40, 'r': 20},
+            'autosize': true,
+            'paper_bgcolor': '#FEF9F3',
+            'plot_bgcolor': '#FEF9F3',
+            'showlegend': true,
+            'legend': {'orientation': 'h', 'y': -0.2},
+            'title': {'text': titles[metric], 'x': 0.05},
+            'xaxis': {'title': {'text': 'Year'}, 'showgrid': false, 'tickvals': analytics.YEAR},
+            'yaxis': {'tickprefix': metric === 'median' ? '$' : '', 'ticksuffix': is_percent ? '%' : '',
+                      'autorange': metric === 'rank' ? 'reversed' : true, 'gridcolor': '#E0E0E0',
+                      'zeroline': is_percent, 'zerolinecolor': '#BEBEBE'},
+        };
+        
+        return timer.end({'data': data, 'layout': layout});
+    }
+    """,
+    Output('places_plot', 'figure'),
+    [Input('place-dropdown', 'value'),
+     Input('compare-places-dropdown', 'value'),
+     Input('places-metric', 'value'),
+     Input('data_api', 'data')
+    ]
+)
+
+# ------------ Download ------------ #
+
+# Download link of the selection; the browser streams the export straight to a file
+app.clientside_callback(
+    """
+    function(selected_places, selected_years, selected_format, export_api) {
+        if (!export_api){
+            return window.dash_clientside.no_update;
+        }
+        var params = new URLSearchParams();
+        (selected_places || []).forEach(place => params.append('place', place));
+        params.append('from', selected_years[0]);
+        params.append('to', selected_years[1]);
+        return `${export_api.base}tracts.${selected_format}?${params}`;
+    }
+    """,
+    Output('export-link', 'href'),
+    [Input('export-places-dropdown', 'value'),
+     Input('export-years', 'value'),
+     Input('export-format', 'value'),
+     Input('export_api', 'data')
     ]
 )
 
+startup_mark('callbacks')
 
 
 
@@ -0,0 +1,143 @@
+// ------------ DATA API ------------ //
+// Helpers shared by the clientside callbacks in app.py. Each response is fetched
+// and decoded once per page load; later requests for the same URL reuse the
+// pending promise.
+//
+// Payloads are column-oriented (see data_api.py). Decoding turns dictionary codes
+// back into strings and numeric columns into typed arrays, with NaN for missing
+// values, and indexes partition rows by GEO_ID. Payloads carry estimates
+// only; label(value, year) formats one for display like data_build.rent_labels,
+// and moe(value) formats a margin of error. Decoded payloads also carry the
+// hovertemplates of schema.json, which take these labels as customdata.
+//
+// A place's series holds one fixed-length row per tract, with a column for each
+// year, so looking up a tract's history by GEO_ID is a single index lookup. Its
+// INTERPOLATED column flags the years filled in across a change of tract
+// boundaries (see data_build.py).
+//
+// While the server is still loading years, status() polls data/status.json, which
+// is never cached; payload URLs carry the data version, so a new version never
+// reuses an older response.
+
+window.rentsData = (function() {
+    var responses = new Map();
+
+    var TYPED_ARRAYS = {'int8': Int8Array, 'int16': Int16Array, 'int32': Int32Array, 'float32': Float32Array, 'float64': Float64Array};
+
+    function fetchJSON(url) {
+        return fetch(url).then(function(response) {
+            if (!response.ok) {
+                throw new Error(`${response.status} while fetching ${url}`);
+            }
+            return response.json();
+        });
+    }
+
+    function memoize(url, load) {
+        if (!responses.has(url)) {
+            var promise = load(url);
+            // Forget failed requests so that they can be retried
+            promise.catch(function() { responses.delete(url); });
+            responses.set(url, promise);
+        }
+        return responses.get(url);
+    }
+
+    function schema(data_api) {
+        return memoize(`${data_api.base}schema.json`, fetchJSON);
+    }
+
+    // Display label of a rent estimate; estimates at the cap of their year only say the rent exceeds it
+    function rentLabel(caps, value, year) {
+        if (isNaN(value)) {
+            return 'Not Available!';
+        }
+        var index = caps.FIRST_YEAR.filter(first_year => first_year <= year).length - 1;
+        var cap = caps.CAP[Math.max(index, 0)];
+        return value === cap ? `Not available. Exceeds $${cap - 1}!` : '$' + value.toFixed(0);
+    }
+
+    // Margin of error shown after a label, empty when there is none
+    function moeLabel(value) {
+        return isNaN(value) ? '' : ` (± $${Math.round(value)})`;
+    }
+
+    function decodeColumns(schema, payload) {
+        var columns = {};
+        for (const [col, values] of Object.entries(payload.columns)) {
+            if (col in schema.encodings) {
+                var dictionary = schema.dictionaries[schema.encodings[col]];
+                columns[col] = values.map(code => dictionary[code]);
+            } else if (col in schema.dtypes) {
+                columns[col] = TYPED_ARRAYS[schema.dtypes[col]].from(values, v => (v === null ? NaN : v));
+            } else {
+                columns[col] = values;
+            }
+        }
+        return columns;
+    }
+
+    // Split the flat row-major columns of a series into one view per tract
+    function indexSeries(schema, payload) {
+        var width = payload.YEAR.length;
+        var tracts = {};
+        payload.GEO_ID.forEach(function(geo_id, row) {
+            var name = schema.dictionaries.NAME[payload.NAME[row]];
+            var columns = {};
+            for (const [col, values] of Object.entries(payload.columns)) {
+                var start = row * width;
+                columns[col] = values.subarray ? values.subarray(start, start + width) : values.slice(start, start + width);
+            }
+            tracts[geo_id] = {'GEO_ID': geo_id, 'NAME': name, 'columns': columns};
+        });
+        payload.tract = geo_id => tracts[geo_id];
+        return payload;
+    }
+
+    function decode(data_api, url) {
+        return Promise.all([schema(data_api), fetchJSON(url)]).then(function([schema, payload]) {
+            payload.columns = decodeColumns(schema, payload);
+            payload.label = (value, year) => rentLabel(schema.caps, value, year);
+            payload.moe = moeLabel;
+            payload.hovertemplates = schema.hovertemplates;
+            payload.notes = schema.notes;
+            if ('GEO_ID' in payload.columns) {
+                payload.rowOf = {};
+                payload.columns.GEO_ID.forEach((geo_id, row) => { payload.rowOf[geo_id] = row; });
+            }
+            return payload;
+        });
+    }
+
+    return {
+        // Columns of one (place, year) partition
+        partition: function(data_api, place, year) {
+            var url = `${data_api.base}places/${year}/${encodeURIComponent(place)}.json`;
+            return memoize(url, url => decode(data_api, url));
+        },
+        // Every tract of a county in a year, each listed once
+        county: function(data_api, county, year) {
+            var url = `${data_api.base}counties/${year}/${county}.json`;
+            return memoize(url, url => decode(data_api, url));
+        },
+        // Metrics of every place, each an array over the years (see analytics.py)
+        analytics: function(data_api) {
+            return memoize(`${data_api.base}analytics/places.json`, fetchJSON);
+        },
+        // Current data version, years still loading or failed, and the years of each place
+        status: function(data_api) {
+            return fetch(data_api.status, {cache: 'no-store'}).then(function(response) {
+                if (!response.ok) {
+                    throw new Error(`${response.status} while fetching ${data_api.status}`);
+                }
+                return response.json();
+            });
+        },
+        // Every tract of a place across all years, looked up by GEO_ID with tract()
+        series: function(data_api, place) {
+            var url = `${data_api.base}series/${encodeURIComponent(place)}.json`;
+            return memoize(url, url => Promise.all([schema(data_api), decode(data_api, url)])
+                .then(([schema, payload]) => indexSeries(schema, payload)));
+        }
+    };
+})();
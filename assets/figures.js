@@ -0,0 +1,33 @@
+// ------------ FIGURES ------------ //
+// Traces built by the clientside callbacks in app.py, kept per key (e.g. the
+// data version, map mode, place and year of the choropleth) so that a callback
+// firing for another reason, such as a new tract selection, reuses the traces
+// it already built and only adds what changed. Plotly.react compares arrays by
+// reference, so reused traces are not recomputed either.
+//
+// The most recently used traces are kept, up to MAX_ENTRIES.
+
+window.rentsFigures = (function() {
+    var MAX_ENTRIES = 64;
+
+    // Key -> built value, least recently used first
+    var entries = new Map();
+
+    return {
+        // Value of build() for a key, built on the first call
+        cached: function(key, build) {
+            if (entries.has(key)) {
+                var value = entries.get(key);
+                entries.delete(key);
+                entries.set(key, value);
+                return value;
+            }
+            var value = build();
+            entries.set(key, value);
+            if (entries.size > MAX_ENTRIES) {
+                entries.delete(entries.keys().next().value);
+            }
+            return value;
+        }
+    };
+})();
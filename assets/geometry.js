@@ -0,0 +1,100 @@
+// ------------ GEOMETRY ------------ //
+// Loads the geometries served by geometry_api.py and decodes quantized ones
+// into GeoJSON for the choropleth map. Each file is fetched and decoded once per
+// page load.
+//
+// Built geometries live in a store holding every distinct polygon of a place in a
+// tract vintage, keyed by content. A small per-year reference file maps each
+// tract's GEO_ID to its key, so switching years within a vintage only fetches the
+// references and reuses the decoded store.
+
+window.rentsGeometry = (function() {
+    var collections = new Map();
+
+    // Undo the delta encoding of one ring and close it again
+    function decodeRing(steps, transform) {
+        var scale = transform.scale;
+        var x = 0, y = 0;
+        var ring = [];
+        for (var i = 0; i < steps.length; i += 2) {
+            x += steps[i];
+            y += steps[i + 1];
+            ring.push([transform.translate[0] + x * scale, transform.translate[1] + y * scale]);
+        }
+        ring.push(ring[0]);
+        return ring;
+    }
+
+    function decodePolygon(rings, transform) {
+        return rings.map(ring => decodeRing(ring, transform));
+    }
+
+    function fetchJSON(url) {
+        return fetch(url).then(function(response) {
+            if (!response.ok) {
+                throw new Error(`${response.status} while fetching ${url}`);
+            }
+            return response.json();
+        });
+    }
+
+    function memoize(url, load) {
+        if (!collections.has(url)) {
+            var promise = load(url);
+            // Forget failed requests so that they can be retried
+            promise.catch(function() { collections.delete(url); });
+            collections.set(url, promise);
+        }
+        return collections.get(url);
+    }
+
+    function decode(collection) {
+        // Unbuilt source files are plain GeoJSON already
+        if (collection.type === 'FeatureCollection') {
+            return collection;
+        }
+        var transform = collection.transform;
+        return {
+            'type': 'FeatureCollection',
+            'features': collection.features.map(function(feature) {
+                var coordinates = feature.type === 'Polygon'
+                    ? decodePolygon(feature.rings, transform)
+                    : feature.rings.map(polygon => decodePolygon(polygon, transform));
+                return {
+                    'type': 'Feature',
+                    'properties': {[collection.idkey]: feature.id},
+                    'geometry': {'type': feature.type, 'coordinates': coordinates}
+                };
+            })
+        };
+    }
+
+    function load(url) {
+        return memoize(url, url => fetchJSON(url).then(decode));
+    }
+
+    return {
+        load: load,
+        // GeoJSON of a place in a year, with the feature property to match on and
+        // the value of that property for each GEO_ID
+        place: function(geometry_api, place, year) {
+            var name = encodeURIComponent(place.replace(/ /g, ''));
+            if (!geometry_api.store) {
+                return load(`${geometry_api.base}source/${year}/${name}.json`).then(geojson => ({
+                    'geojson': geojson,
+                    'featureidkey': 'properties.GEO_ID',
+                    'keyOf': geo_id => geo_id
+                }));
+            }
+            var refs_url = `${geometry_api.base}refs/${year}/${name}.json`;
+            return memoize(refs_url, fetchJSON).then(function(refs) {
+                var store_url = `${geometry_api.base}store/${geometry_api.level}/${refs.vintage}/${name}.json`;
+                return load(store_url).then(geojson => ({
+                    'geojson': geojson,
+                    'featureidkey': 'properties.KEY',
+                    'keyOf': geo_id => refs.keys[geo_id]
+                }));
+            });
+        }
+    };
+})();
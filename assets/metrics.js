@@ -0,0 +1,64 @@
+// ------------ METRICS ------------ //
+// Times the clientside callbacks in app.py and reports the durations to
+// metrics.py in batches. Reporting is on only when the page carries the
+// rents-metrics meta tag (see metrics.client_meta_tags); otherwise, as on the
+// static site, timers do nothing but hand their value back.
+//
+// Usage inside a callback:
+//     var timer = window.rentsMetrics.start('choropleth');
+//     ...
+//     return timer.end(figure);
+
+window.rentsMetrics = (function() {
+    var FLUSH_INTERVAL_MS = 30000;
+    var MAX_PENDING = 50;
+
+    var meta = document.querySelector('meta[name="rents-metrics"]');
+    var url = meta ? new URL(meta.content, document.baseURI).href : null;
+    var pending = {};
+    var count = 0;
+
+    function flush() {
+        if (url === null || count === 0) {
+            return;
+        }
+        var body = JSON.stringify({'callbacks': pending});
+        pending = {};
+        count = 0;
+        fetch(url, {'method': 'POST', 'headers': {'Content-Type': 'application/json'}, 'body': body, 'keepalive': true})
+            .then(function(response) {
+                // Stop reporting to a server that does not take reports
+                if (!response.ok) {
+                    url = null;
+                }
+            })
+            .catch(function() { url = null; });
+    }
+
+    if (url !== null) {
+        setInterval(flush, FLUSH_INTERVAL_MS);
+        document.addEventListener('visibilitychange', function() {
+            if (document.visibilityState === 'hidden') {
+                flush();
+            }
+        });
+    }
+
+    return {
+        start: function(name) {
+            var start = performance.now();
+            return {
+                end: function(value) {
+                    if (url !== null) {
+                        (pending[name] = pending[name] || []).push(performance.now() - start);
+                        count += 1;
+                        if (count >= MAX_PENDING) {
+                            flush();
+                        }
+                    }
+                    return value;
+                }
+            };
+        }
+    };
+})();
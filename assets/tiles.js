@@ -0,0 +1,89 @@
+// ------------ VECTOR TILES ------------ //
+// Helpers for the county-wide view of the choropleth callback in app.py. Every
+// tract of the county is drawn from the vector tiles built by tile_build.py, as a
+// layer of the map. The tiles carry geometry only: the rents of the selected
+// year are joined to them on the client by feature id (the tract's GEO_ID), so
+// changing the year replaces a fill-color expression and reuses the tiles
+// already loaded.
+//
+// Plotly map layers take a single color, so the expression is set on the
+// underlying MapLibre map after every render of the graph.
+
+window.rentsTiles = (function() {
+    // The reversed YlOrRd colorscale of the place map, spread over the same range
+    var COLORS = ['rgb(255,255,204)', 'rgb(255,237,160)', 'rgb(254,217,118)', 'rgb(254,178,76)', 'rgb(253,141,60)',
+                  'rgb(252,78,42)', 'rgb(227,26,28)', 'rgb(189,0,38)', 'rgb(128,0,38)'];
+    var ZMAX = 3500;
+    var MISSING = 'rgba(0,0,0,0)';
+
+    // Graph id -> {'layer': source layer of the tiles, 'fill': fill-color expression}
+    var styles = new Map();
+
+    function vintageOf(tiles, year) {
+        return Math.max(...Object.keys(tiles.vintages).map(Number).filter(vintage => vintage <= year));
+    }
+
+    // Fill color of each tract from its rent; tracts without one stay transparent
+    function fillColor(geo_ids, values) {
+        var rents = ['match', ['id']];
+        geo_ids.forEach(function(geo_id, i) {
+            if (!isNaN(values[i])) {
+                rents.push(geo_id, values[i]);
+            }
+        });
+        rents.push(-1);
+        var stops = COLORS.flatMap((color, i) => [i * ZMAX / (COLORS.length - 1), color]);
+        // A match expression needs at least one label
+        return ['let', 'rent', rents.length > 3 ? rents : -1,
+                ['case', ['<', ['var', 'rent'], 0], MISSING, ['interpolate', ['linear'], ['var', 'rent'], ...stops]]];
+    }
+
+    function graphDiv(graph_id) {
+        var graph = document.getElementById(graph_id);
+        return graph && (graph.querySelector('.js-plotly-plot') || graph);
+    }
+
+    function paint(graph_id) {
+        var gd = graphDiv(graph_id);
+        var style = styles.get(graph_id);
+        var subplot = gd && gd._fullLayout && gd._fullLayout.map && gd._fullLayout.map._subplot;
+        if (!style || !subplot || !subplot.map) {
+            return;
+        }
+        subplot.map.getStyle().layers
+            .filter(layer => layer.type === 'fill' && layer['source-layer'] === style.layer)
+            .forEach(layer => subplot.map.setPaintProperty(layer.id, 'fill-color', style.fill));
+    }
+
+    return {
+        // Source of a map layer drawing the tiles of a year's vintage, as an inline
+        // TileJSON: it gives MapLibre the zoom range and bounds of the tiles, and
+        // absolute tile URLs, which MapLibre does not resolve on its own
+        source: function(geometry_api, year) {
+            var tiles = geometry_api.tiles;
+            var vintage = vintageOf(tiles, year);
+            var base = new URL(`${geometry_api.base}tiles/${vintage}/`, document.baseURI).href;
+            var tilejson = {'tilejson': '3.0.0',
+                            'tiles': [`${base}{z}/{x}/{y}.pbf`],
+                            'minzoom': tiles.minzoom,
+                            'maxzoom': tiles.maxzoom,
+                            'bounds': tiles.vintages[vintage],
+                            'vector_layers': [{'id': tiles.layer, 'fields': {}}]};
+            return 'data:application/json,' + encodeURIComponent(JSON.stringify(tilejson));
+        },
+        // Color the tiles of a graph by the given values, now and after every render
+        restyle: function(graph_id, tiles, geo_ids, values) {
+            styles.set(graph_id, {'layer': tiles.layer, 'fill': fillColor(geo_ids, values)});
+            var gd = graphDiv(graph_id);
+            if (gd && gd.on && !gd._rentsTiles) {
+                gd._rentsTiles = true;
+                gd.on('plotly_afterplot', () => paint(graph_id));
+            }
+            paint(graph_id);
+        },
+        // Stop coloring the tiles of a graph
+        clear: function(graph_id) {
+            styles.delete(graph_id);
+        }
+    };
+})();
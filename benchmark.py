@@ -0,0 +1,393 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import numpy as np
+import plotly.io
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import data_build
+from data_build import (load_masterfile, build_masterfile, load_years, build_series_index, read_tract_locations,
+                        masterfile_path, write_partitions, write_catalog, concat_rows, years,
+                        MASTERFILE_COLUMNS, MASTERFILE_DTYPES, SERIES_COLUMNS)
+from data_api import build_payloads, write_payloads
+from data_store import DataStore
+from analytics import place_metrics
+from crosswalk_build import read_crosswalk
+from geometry_api import write_geometry
+
+
+# ------------ BENCHMARK SUITE ------------ #
+# Measures startup, data build, payload sizes and interaction latency so that a
+# change can be compared against a baseline run:
+#
+#   python benchmark.py -o before.json
+#   python benchmark.py -o after.json --compare before.json
+#
+# Synthetic masterfiles at several multiples of the real row count (100x is
+# roughly every tract in California) show how each stage scales. Clientside
+# callbacks are run headless in Node.js against a static export of the data and
+# geometry endpoints; that section is skipped when node is not installed.
+
+DEFAULT_SCALES = [1, 10, 100]
+
+# Places whose callbacks are timed, by number of rows in the latest year
+LARGEST_PLACES = 3
+
+# Synthetic copies of the county get these state and county FIPS codes in turn
+SYNTHETIC_COUNTIES = [6000 + county for county in range(1, 1000, 2) if county != 37]
+
+
+# Purpose: Time a function, returning its result and the timings of each run
+def timed(function, repeat=1):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, {'seconds': min(timings), 'median_seconds': statistics.median(timings), 'runs': repeat}
+
+
+# Purpose: Size of a JSON-serializable object, raw and gzipped
+def json_size(data):
+    raw = plotly.io.json.to_json_plotly(data).encode()
+    return {'bytes': len(raw), 'gzip_bytes': len(gzip.compress(raw, mtime=0))}
+
+
+
+# ------------ DATA BUILD ------------ #
+
+# Purpose: Time each stage of building the masterfile from its sources
+def benchmark_data_build(repeat):
+    """
+    The stages mirror data_build.build_year, across every year; 'build_masterfile'
+    times building the years one after another, 'load_years' building them
+    across the process pool, and 'load_masterfile_cached' a boot with a warm cache.
+    """
+    build_years = list(years)
+    results = dict()
+
+    frames, results['read_csv'] = timed(lambda: [pd.read_csv(masterfile_path(year)) for year in build_years], repeat)
+    df, results['concat'] = timed(lambda: pd.concat(frames, ignore_index=True), repeat)
+    locations, results['read_tract_locations'] = timed(lambda: read_tract_locations(build_years), repeat)
+    df, results['merge_locations'] = timed(lambda: pd.merge(df, locations, on=['YEAR', 'GEO_ID'], how='left'), repeat)
+
+    _, results['compact_dtypes'] = timed(lambda: df[MASTERFILE_COLUMNS].astype(MASTERFILE_DTYPES), repeat)
+
+    _, results['build_masterfile'] = timed(lambda: build_masterfile(build_years), repeat)
+    _, results['load_years'] = timed(lambda: list(load_years(build_years)), repeat)
+    masterfile, results['load_masterfile_cached'] = timed(load_masterfile, repeat)
+    crosswalk = read_crosswalk()
+    _, results['build_series_index'] = timed(lambda: build_series_index(masterfile, crosswalk), repeat)
+    _, results['place_metrics'] = timed(lambda: place_metrics(masterfile), repeat)
+    results['rows'] = len(masterfile)
+    results['memory_bytes'] = int(masterfile.memory_usage(deep=True).sum())
+    return results
+
+
+# Purpose: Time a cold start of app.py in a fresh interpreter, with the startup stages recorded by metrics.py
+def benchmark_startup(repeat):
+    script = ('import json, time; start = time.perf_counter(); import app, metrics; '
+              'print(json.dumps([time.perf_counter() - start, metrics.startup_stages]))')
+    timings = []
+    stages = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, run_stages = json.loads(output.stdout.strip().splitlines()[-1])
+        timings.append(seconds)
+        stages.append(run_stages)
+    # Stages of the fastest run
+    fastest = stages[timings.index(min(timings))]
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings), 'runs': repeat,
+            'stages': fastest}
+
+
+
+# ------------ LAYOUT AND PAYLOADS ------------ #
+
+# Purpose: Find every dcc.Store in a layout
+def layout_stores(component):
+    stores = dict()
+    if type(component).__name__ == 'Store':
+        stores[component.id] = component.data
+    children = getattr(component, 'children', None)
+    for child in children if isinstance(children, list) else [children]:
+        if hasattr(child, 'to_plotly_json'):
+            stores.update(layout_stores(child))
+    return stores
+
+
+# Purpose: Measure the layout, its stores and the data API payloads
+def benchmark_payloads(app_module, repeat):
+    results = {'layout': json_size(app_module.app.layout),
+               'stores': {store_id: json_size(data) for store_id, data in layout_stores(app_module.app.layout).items()}
+              }
+
+    _, results['place_year_dictionary'] = timed(app_module.place_year_dictionary, repeat)
+    # Each run starts from an empty partition cache, as after a boot
+    catalog = app_module.store.catalog
+    payloads, results['build_payloads'] = timed(lambda: build_payloads(DataStore(catalog)), repeat)
+    results.update(payload_sizes(payloads))
+    return results, payloads
+
+
+# Purpose: Total and largest sizes of each kind of data API payload
+def payload_sizes(payloads):
+    sizes = dict()
+    for kind in ['partitions', 'series']:
+        raw = [len(payload['raw']) for payload in payloads[kind].values()]
+        compressed = [len(payload['gzip']) for payload in payloads[kind].values()]
+        sizes[kind] = {'count': len(raw),
+                       'bytes': sum(raw), 'gzip_bytes': sum(compressed),
+                       'max_bytes': max(raw), 'max_gzip_bytes': max(compressed)
+                      }
+    return sizes
+
+
+
+# ------------ CLIENTSIDE CALLBACKS ------------ #
+# The clientside callbacks of app.py are loaded into Node.js together with the
+# scripts in assets/, with fetch() reading from a static export of the data and
+# geometry endpoints. JSON parsing and decoding are therefore included, network
+# time is not. Each callback is timed cold (first request for its files) and warm
+# (files decoded and traces built).
+
+NODE_RUNNER = r"""
+const fs = require('fs');
+const path = require('path');
+const [root, bundle, places] = process.argv.slice(-3);
+globalThis.window = globalThis;
+// No rents-metrics meta tag, so the callbacks' timers stay silent, and no graph for the tiles to restyle
+globalThis.document = {'querySelector': () => null, 'getElementById': () => null, 'baseURI': 'http://localhost/'};
+globalThis.fetch = async function(url) {
+    try {
+        const body = fs.readFileSync(path.join(root, decodeURIComponent(url.split('?')[0])), 'utf8');
+        return {'ok': true, 'status': 200, 'json': async () => JSON.parse(body)};
+    } catch (error) {
+        return {'ok': false, 'status': 404};
+    }
+};
+eval(fs.readFileSync(bundle, 'utf8'));
+
+async function time(f) {
+    const start = performance.now();
+    const result = await f();
+    return [result, (performance.now() - start) / 1000];
+}
+
+(async function() {
+    const results = {};
+    for (const [place, year, previous_year] of JSON.parse(places)) {
+        const timings = {};
+        const [options, cold_options] = await time(() => CALLBACKS.options(place, year, DATA_API));
+        timings.tract_options = {'cold_seconds': cold_options};
+        const tract = options[0][0];
+        for (const [name, run] of Object.entries({
+            'map': () => CALLBACKS.map(place, year, tract, 'place', DATA_API, GEOMETRY_API),
+            // Only the highlight changes: the traces of the place and year are reused
+            'map_select_tract': () => CALLBACKS.map(place, year, options[0][1], 'place', DATA_API, GEOMETRY_API),
+            'plot': () => CALLBACKS.plot(place, tract, options[0].slice(1, 4), DATA_API),
+            'map_other_year': () => CALLBACKS.map(place, previous_year, tract, 'place', DATA_API, GEOMETRY_API)
+        })) {
+            const [, cold] = await time(run);
+            const [, warm] = await time(run);
+            timings[name] = {'cold_seconds': cold, 'warm_seconds': warm};
+        }
+        timings.tracts = options[0].length;
+        results[place] = timings;
+    }
+    // The county-wide map, when the vector tiles are built: only the rents are fetched
+    if (GEOMETRY_API.tiles) {
+        const [place, year, previous_year] = JSON.parse(places)[0];
+        const timings = {};
+        for (const [name, run] of Object.entries({
+            'map': () => CALLBACKS.map(place, year, null, 'county', DATA_API, GEOMETRY_API),
+            'map_other_year': () => CALLBACKS.map(place, previous_year, null, 'county', DATA_API, GEOMETRY_API)
+        })) {
+            const [figure, cold] = await time(run);
+            const [, warm] = await time(run);
+            timings[name] = {'cold_seconds': cold, 'warm_seconds': warm};
+            timings.tracts = figure.data[0].lat.length;
+        }
+        results['county'] = timings;
+    }
+    console.log(JSON.stringify(results));
+})().catch(error => { console.error(error); process.exit(1); });
+"""
+
+
+# Purpose: Collect the clientside callbacks of app.py as a script defining CALLBACKS
+def callback_bundle(app_module):
+    functions = {cb['output']: cb['clientside_function']['function_name']
+                 for cb in app_module.app._callback_list if cb.get('clientside_function')}
+
+    def find(output):
+        return next(name for key, name in functions.items() if output in key)
+
+    scripts = ['data_api.js', 'figures.js', 'geometry.js', 'metrics.js', 'tiles.js']
+    lines = [open(f'{data_build.assets_path}{script}').read() for script in scripts]
+    lines += app_module.app._inline_scripts
+    lines.append('var ns = window.dash_clientside._dashprivate_clientside_funcs;')
+    lines.append('globalThis.CALLBACKS = ' + json.dumps({'options': find('census-tract-dropdown.options'),
+                                                          'map': find('chloropleth_map.figure'),
+                                                          'plot': find('rent_plot.figure')}) + ';')
+    lines.append('for (const key in CALLBACKS) { CALLBACKS[key] = ns[CALLBACKS[key]]; }')
+    lines.append('globalThis.DATA_API = ' + json.dumps(app_module.app.layout['data_api'].data) + ';')
+    lines.append('globalThis.GEOMETRY_API = ' + json.dumps(app_module.app.layout['geometry_api'].data) + ';')
+    return '\n'.join(lines)
+
+
+# Purpose: Run the clientside callbacks headless for the largest places
+def benchmark_callbacks(app_module, payloads):
+    node = shutil.which('node')
+    if node is None:
+        return {'skipped': 'node is not installed'}
+
+    rows = {place: len(payload['raw']) for (place, year), payload in payloads['partitions'].items() if year == years[-1]}
+    places = [[place, years[-1], years[-1] - 1] for place in sorted(rows, key=rows.get, reverse=True)[:LARGEST_PLACES]]
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_payloads(payloads, folder)
+        write_geometry(folder)
+        bundle = f'{folder}/bundle.js'
+        with open(bundle, 'w') as file:
+            file.write(callback_bundle(app_module))
+        output = subprocess.run([node, '-e', NODE_RUNNER, folder, bundle, json.dumps(places)],
+                                capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+
+# ------------ SYNTHETIC SCALE-UP ------------ #
+
+# Purpose: Build a synthetic masterfile with `scale` times the rows of the real one
+def synthetic_masterfile(masterfile, scale, seed=0):
+    """
+    Every copy after the first stands for another county: place names get a
+    suffix, GEO_IDs move to a county of SYNTHETIC_COUNTIES, and estimates are
+    jittered by up to 10% so that payloads do not simply repeat.
+    """
+    rng = np.random.default_rng(seed)
+    copies = [masterfile]
+    for copy in range(1, scale):
+        df = masterfile.copy()
+        df['PLACE'] = df['PLACE'].cat.rename_categories(lambda place: f'{place} {copy}')
+        df['GEO_ID'] = df['GEO_ID'] % 10 ** 6 + SYNTHETIC_COUNTIES[copy - 1] * 10 ** 6
+        for col in SERIES_COLUMNS:
+            df[col] = np.round(df[col] * rng.uniform(0.9, 1.1, len(df)))
+        copies.append(df)
+    return concat_rows(copies)[MASTERFILE_COLUMNS].astype(MASTERFILE_DTYPES)
+
+
+# Purpose: Time the server-side stages on synthetic masterfiles of increasing size
+def benchmark_scaling(app_module, masterfile, scales):
+    """
+    Each synthetic masterfile is written to a partitioned cache in a temporary
+    folder and served from a fresh DataStore, as the app would.
+    """
+    results = dict()
+    for scale in scales:
+        df, generate = timed(lambda: synthetic_masterfile(masterfile, scale))
+        row = {'rows': len(df), 'places': int(df['PLACE'].nunique()), 'generate': generate}
+
+        row['memory_bytes'] = int(df.memory_usage(deep=True).sum())
+        _, row['build_series_index'] = timed(lambda: build_series_index(df, read_crosswalk()))
+
+        with tempfile.TemporaryDirectory() as folder:
+            folder += '/'
+            _, row['write_partitions'] = timed(lambda: write_partitions(df, folder))
+            catalog, row['write_catalog'] = timed(lambda: write_catalog(folder))
+            row['counties'] = len(catalog['counties'])
+            row['catalog'] = json_size(catalog)
+
+            store = DataStore(catalog, folder)
+            # place_year_dictionary reads the module-level store of app.py
+            app_store, app_module.store = app_module.store, store
+            try:
+                place_year_dict, row['place_year_dictionary'] = timed(app_module.place_year_dictionary)
+            finally:
+                app_module.store = app_store
+            row['place_year_dict_store'] = json_size(place_year_dict)
+
+            payloads, row['build_payloads'] = timed(lambda: build_payloads(store))
+            row['partition_cache'] = store.usage()
+        row.update(payload_sizes(payloads))
+        results[f'{scale}x'] = row
+        print(f"  {scale}x: {row['rows']} rows, payloads built in {row['build_payloads']['seconds']:.1f} s", flush=True)
+    return results
+
+
+
+# ------------ COMPARISON ------------ #
+
+# Purpose: Flatten nested results into {'a.b.c': number}
+def flatten(results, prefix=''):
+    flat = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+# Purpose: Print the relative change of every timing and size against a baseline run
+def compare(baseline, results):
+    before = flatten(baseline['results'])
+    after = flatten(results['results'])
+    for key in sorted(before.keys() & after.keys()):
+        if key.endswith(('seconds', 'bytes')) and before[key]:
+            change = after[key] / before[key] - 1
+            print(f'{key:<70} {before[key]:>14.4g} -> {after[key]:>14.4g}  ({change:+.1%})')
+
+
+
+# ------------ EXECUTE THE BENCHMARKS ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data build, payloads and callbacks of the app.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing; the fastest is reported')
+    parser.add_argument('--scales', type=int, nargs='*', default=DEFAULT_SCALES,
+                        help='multiples of the real row count to benchmark')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    args = parser.parse_args()
+
+    import app as app_module
+
+    results = dict()
+    print('Data build', flush=True)
+    results['data_build'] = benchmark_data_build(args.repeat)
+    print('Startup', flush=True)
+    results['startup'] = benchmark_startup(args.repeat)
+    print('Layout and payloads', flush=True)
+    results['payloads'], payloads = benchmark_payloads(app_module, args.repeat)
+    print('Clientside callbacks', flush=True)
+    results['callbacks'] = benchmark_callbacks(app_module, payloads)
+    print('Scaling', flush=True)
+    results['scaling'] = benchmark_scaling(app_module, load_masterfile(), args.scales)
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    report = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit': commit or None,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'results': results
+             }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f'Wrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
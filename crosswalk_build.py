@@ -0,0 +1,88 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import shapely
+import argparse
+import os
+
+from geometry_build import geometry_path, VINTAGES
+from tile_build import read_county_tracts
+
+
+# ------------ PATHS ------------ #
+crosswalk_path = f'{geometry_path}crosswalk.npz'
+
+
+# ------------ CROSSWALK ------------ #
+# Tracts are redrawn with every decennial census, so a tract drawn in 2020 has no
+# estimates before 2020 and a tract retired in 2020 none after. The crosswalk
+# lists every overlap between a tract of one vintage (SOURCE) and a tract of the
+# next (TARGET), as sparse COO entries:
+#
+#   VINTAGES                   the source and target vintages, e.g. [2010, 2020]
+#   SOURCE, TARGET             GEO_IDs of the overlapping tracts
+#   AREA                       area of their intersection, in square meters
+#   SOURCE_AREA, TARGET_AREA   areas of the whole tracts, in square meters
+#
+# The tracts of a vintage come from the per-place geometries of all of its years
+# in assets/{year}/. Areas are measured on a sinusoidal projection, which is
+# equal-area. data_build.py interpolates the series index across the boundary
+# change from these overlaps.
+
+# Earth radius of the sinusoidal projection, in meters
+EARTH_RADIUS = 6371008.8
+
+# Overlaps smaller than this, in square meters, are digitizing noise along shared boundaries
+MIN_AREA = 1
+
+
+# Purpose: Project longitude and latitude onto the sinusoidal equal-area projection, in meters
+def to_equal_area(geoms):
+    def project(coords):
+        lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        return np.column_stack([EARTH_RADIUS * lon * np.cos(lat), EARTH_RADIUS * lat])
+    return shapely.transform(geoms, project)
+
+
+# Purpose: Overlaps between the tracts of two vintages
+def build_crosswalk(source_vintage, target_vintage):
+    source_ids, source_geoms = read_county_tracts(source_vintage)
+    target_ids, target_geoms = read_county_tracts(target_vintage)
+    source_geoms = shapely.make_valid(to_equal_area(source_geoms))
+    target_geoms = shapely.make_valid(to_equal_area(target_geoms))
+
+    sources, targets = shapely.STRtree(target_geoms).query(source_geoms, predicate='intersects')
+    areas = shapely.area(shapely.intersection(source_geoms[sources], target_geoms[targets]))
+    keep = areas >= MIN_AREA
+    sources, targets = sources[keep], targets[keep]
+    return {'VINTAGES': np.array([source_vintage, target_vintage]),
+            'SOURCE': source_ids[sources],
+            'TARGET': target_ids[targets],
+            'AREA': areas[keep],
+            'SOURCE_AREA': shapely.area(source_geoms)[sources],
+            'TARGET_AREA': shapely.area(target_geoms)[targets]
+           }
+
+
+# Purpose: Read the crosswalk, or None if crosswalk_build.py has not been run
+def read_crosswalk():
+    if not os.path.exists(crosswalk_path):
+        return None
+    with np.load(crosswalk_path, allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+
+# ------------ EXECUTE THE BUILD ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the crosswalk between the tracts of consecutive vintages.')
+    args = parser.parse_args()
+
+    # Only two vintages so far; a third would need a crosswalk per pair
+    crosswalk = build_crosswalk(*VINTAGES[:2])
+    os.makedirs(geometry_path, exist_ok=True)
+    np.savez(crosswalk_path, **crosswalk)
+
+    share = crosswalk['AREA'] / crosswalk['TARGET_AREA']
+    print(f"{VINTAGES[0]} to {VINTAGES[1]}: {len(np.unique(crosswalk['SOURCE']))} tracts onto "
+          f"{len(np.unique(crosswalk['TARGET']))} in {len(share)} overlaps, "
+          f"{np.sum(share > 0.99)} of them covering at least 99% of their {VINTAGES[1]} tract")
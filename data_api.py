@@ -0,0 +1,386 @@
+# ------------ LIBRARIES ------------ #
+from flask import Response, abort, request
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import hashlib
+import json
+import gzip
+import os
+import unicodedata
+
+from data_build import RENT_CAPS, SERIES_COLUMNS
+
+
+# ------------ PAYLOADS ------------ #
+# The clientside callbacks fetch the masterfile one partition at a time instead of
+# receiving all of it in the layout. Payloads are built from the partitioned cache
+# (see data_store.py) on first request, serialized, compressed and hashed once,
+# and kept in an LRU. They are served from a URL carrying the data version so they
+# can be cached by the browser indefinitely.
+#
+# Payloads are column-oriented: each column is one array, so keys are not repeated
+# on every row. Strings are dictionary-encoded against the dictionaries in
+# schema.json, which the client fetches once and uses to decode every payload.
+# Partition and county payloads also carry the map viewport of their (place,
+# year) or (county, year) from the catalog (see data_build.py).
+#
+# Payloads carry estimates rather than display labels; the client formats them
+# with the rent caps listed in schema.json (see rentsData.label).
+#
+# The hover text of the graphs is not assembled per point either. schema.json
+# carries one Plotly hovertemplate per kind of point, and each point only gets
+# its short labels as customdata; values shared by a whole trace (the year, the
+# tract and place of a series) go in the trace's meta.
+
+PARTITION_COLUMNS = ['GEO_ID', 'NAME', 'INTPTLAT', 'INTPTLON', 'B25058_001E', 'B25058_001M', 'B25057_001E',
+                     'B25059_001E']
+
+# Columns of the county-wide payloads, which also say which place each tract is in
+COUNTY_COLUMNS = ['GEO_ID', 'NAME', 'PLACE', 'INTPTLAT', 'INTPTLON', 'B25058_001E', 'B25058_001M', 'B25057_001E',
+                  'B25059_001E']
+
+# Column -> dictionary used to encode it
+DICTIONARY_COLUMNS = {'PLACE':  'PLACE',
+                      'NAME':   'NAME'
+                     }
+
+# Column -> typed array the client decodes it into. Rents are whole dollars, which
+# float32 holds exactly
+COLUMN_DTYPES = {'YEAR':        'int16',
+                 'B25058_001E': 'float32',
+                 'B25058_001M': 'float32',
+                 'B25057_001E': 'float32',
+                 'B25057_001M': 'float32',
+                 'B25059_001E': 'float32',
+                 'B25059_001M': 'float32',
+                 'INTPTLAT':    'float64',
+                 'INTPTLON':    'float64',
+                 'INTERPOLATED': 'int8'
+                }
+
+# Kind of point -> hovertemplate. Tracts on the map take customdata [NAME, PLACE,
+# median, median MOE, 25th percentile, 75th percentile, GEO_ID] and meta [YEAR]; years of
+# a tract's series take customdata [interpolation note, median, median MOE, 25th
+# percentile, its MOE, 75th percentile, its MOE] and meta [NAME, PLACE]; years of
+# a compared tract take customdata [median] and meta [NAME]
+HOVER_TEMPLATES = {
+    'tract': "<b style='font-size:16px;'>%{customdata[0]}</b><br>%{customdata[1]}, Los Angeles County<br><br>"
+             "Median Contract Rent (%{meta[0]}): <br><b style='color:#800000; font-size:14px;'>%{customdata[2]}</b>%{customdata[3]} <br><br>"
+             "25th Percentile Contract Rent (%{meta[0]}): <br><b style='color:#B22222; font-size:14px;'>%{customdata[4]}</b> <br><br>"
+             "75th Percentile Contract Rent (%{meta[0]}): <br><b style='color:#B22222; font-size:14px;'>%{customdata[5]}</b> <br><br><extra></extra>",
+    'series': "<b style='font-size:16px;'>%{x}</b><br>%{meta[0]}, %{meta[1]} <br><br>%{customdata[0]}"
+              "Median Contract Rent: <br><b style='color:#800000; font-size:14px;'>%{customdata[1]}</b>%{customdata[2]} <br><br>"
+              "25th Percentile Contract Rent: <br><b style='color:#B22222; font-size:14px;'>%{customdata[3]}</b>%{customdata[4]} <br><br>"
+              "75th Percentile Contract Rent: <br><b style='color:#B22222; font-size:14px;'>%{customdata[5]}</b>%{customdata[6]} <br><br><extra></extra>",
+    'compared': "<b>%{x}</b><br>%{meta[0]}<br>Median Contract Rent: %{customdata}<extra></extra>"
+}
+
+# Note on the years of a series interpolated across a change of tract boundaries
+INTERPOLATED_NOTE = "<i>Interpolated by area from the overlapping tracts<br>of the other census tract boundaries</i> <br><br>"
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Bump whenever the layout of a payload changes, so that URLs are not reused for it
+PAYLOAD_FORMAT = 6
+
+# Encoded payloads kept in memory
+PAYLOAD_CACHE_SIZE = 2048
+
+
+# Purpose: Serialize, compress and hash a JSON payload
+def make_payload(data):
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return {'raw': raw,
+            'gzip': gzip.compress(raw, compresslevel=9, mtime=0),
+            'etag': hashlib.sha1(raw).hexdigest()
+           }
+
+
+# Purpose: Convert an array to a JSON-ready list, with missing values as null
+def column_values(array):
+    if array.dtype.kind == 'f':
+        return np.where(np.isnan(array), None, array).tolist()
+    return array.tolist()
+
+
+# Purpose: Normalize place names so that composed and decomposed accents match
+def place_key(place):
+    return unicodedata.normalize('NFC', place)
+
+
+# Purpose: Data version of the payloads of a catalog, from its data version and the payload format
+def catalog_version(catalog):
+    return hashlib.sha1(f"{catalog['data_version']}/{PAYLOAD_FORMAT}".encode()).hexdigest()[:12]
+
+
+# Purpose: Data version of the payloads of a store's current catalog
+def data_version(store):
+    return catalog_version(store.catalog)
+
+
+# Purpose: Build the string dictionaries from the distinct values listed in the catalog
+def build_dictionaries(values):
+    """
+    Dictionaries are kept as pandas Indexes so that their hash tables are built
+    once rather than for every payload encoded against them.
+    """
+    dictionaries = dict()
+    for name in sorted(set(DICTIONARY_COLUMNS.values())):
+        dictionaries[name] = pd.Index(sorted(set().union(*[values[col] for col, dictionary in DICTIONARY_COLUMNS.items()
+                                                           if dictionary == name])))
+    return dictionaries
+
+
+# Purpose: Encode columns of a DataFrame as a struct of arrays, dictionary-encoding strings
+def encode_columns(rows, names, dictionaries):
+    columns = dict()
+    for col in names:
+        if col in DICTIONARY_COLUMNS:
+            columns[col] = dictionaries[DICTIONARY_COLUMNS[col]].get_indexer(rows[col]).tolist()
+        else:
+            columns[col] = column_values(rows[col].to_numpy())
+    return columns
+
+
+# Purpose: Encode the series index rows of a place's tracts, one flat row-major array per column
+def encode_series(index, rows):
+    """
+    Each tract takes len(index['YEAR']) consecutive entries of every column,
+    including INTERPOLATED.
+    """
+    return {col: column_values(index[col][rows].ravel()) for col in SERIES_COLUMNS + ['INTERPOLATED']}
+
+
+# Purpose: Payload with the rows of one (place, year) partition, or None if it is empty
+def partition_payload(store, dictionaries, place, year):
+    rows = store.place_rows(place, year)
+    if rows is None:
+        return None
+    return make_payload({'PLACE': place,
+                         'YEAR': year,
+                         'length': len(rows),
+                         'viewport': store.catalog['places'][place]['viewports'][str(year)],
+                         'columns': encode_columns(rows, PARTITION_COLUMNS, dictionaries)
+                        })
+
+
+# Purpose: Payload with the rows of every tract of a county in a year, or None if there are none
+def county_payload(store, dictionaries, county, year):
+    """
+    A tract spanning several places is listed once, under the first of them, as
+    the county-wide map draws each tract once.
+    """
+    entry = store.catalog['counties'].get(county)
+    if entry is None or year not in entry['years']:
+        return None
+    rows = store.partition(county, year).drop_duplicates('GEO_ID')
+    return make_payload({'COUNTY': county,
+                         'YEAR': year,
+                         'length': len(rows),
+                         'viewport': entry['viewports'][str(year)],
+                         'columns': encode_columns(rows, COUNTY_COLUMNS, dictionaries)
+                        })
+
+
+# Purpose: Payload with the series index rows of every tract that belongs to a place in any year
+def series_payload(store, dictionaries, place):
+    entry = store.catalog['places'].get(place)
+    if entry is None:
+        return None
+    geo_ids = np.unique(np.concatenate([store.place_rows(place, year)['GEO_ID'].to_numpy()
+                                        for year in entry['years']]))
+
+    data = {'PLACE': place, 'YEAR': None, 'length': 0, 'GEO_ID': [], 'NAME': [],
+            'columns': {col: [] for col in SERIES_COLUMNS + ['INTERPOLATED']}}
+    for county in entry['counties']:
+        index = store.series_index(county)
+        rows = np.flatnonzero(np.isin(index['GEO_ID'], geo_ids))
+        data['YEAR'] = index['YEAR'].tolist()
+        data['length'] += len(rows)
+        data['GEO_ID'] += index['GEO_ID'][rows].tolist()
+        data['NAME'] += dictionaries['NAME'].get_indexer(index['NAME'][rows]).tolist()
+        for col, values in encode_series(index, rows).items():
+            data['columns'][col] += values
+    return make_payload(data)
+
+
+# Purpose: Data version, years still loading or failed, and the years of each place and county names, for data/status.json
+def data_status(store):
+    catalog = store.catalog
+    return {'version': data_version(store),
+            'loading': store.loading,
+            'failed': catalog.get('failed_years', dict()),
+            'places': {place: entry['years'] for place, entry in catalog['places'].items()},
+            'counties': {county: entry['name'] for county, entry in catalog['counties'].items()}
+           }
+
+
+# Purpose: Precompute every payload, for static exports and benchmarks
+def build_payloads(store):
+    dictionaries = build_dictionaries(store.catalog['values'])
+    partitions = dict()
+    series = dict()
+    counties = {(county, year): county_payload(store, dictionaries, county, year)
+                for county, entry in store.catalog['counties'].items() for year in entry['years']}
+    for place, entry in store.catalog['places'].items():
+        for year in entry['years']:
+            payload = partition_payload(store, dictionaries, place, year)
+            if payload is not None:
+                partitions[(place_key(place), year)] = payload
+        series[place_key(place)] = series_payload(store, dictionaries, place)
+
+    return {'version': data_version(store),
+            'schema': schema_payload(dictionaries),
+            'partitions': partitions,
+            'counties': counties,
+            'series': series
+           }
+
+
+# Purpose: Payload with the dictionaries, dtypes and rent caps for decoding the others, and the hovertemplates
+def schema_payload(dictionaries):
+    return make_payload({'dictionaries': {name: dictionary.tolist() for name, dictionary in dictionaries.items()},
+                         'encodings': DICTIONARY_COLUMNS,
+                         'dtypes': COLUMN_DTYPES,
+                         'caps': RENT_CAPS.to_dict(orient='list'),
+                         'hovertemplates': HOVER_TEMPLATES,
+                         'notes': {'interpolated': INTERPOLATED_NOTE}
+                        })
+
+
+
+# ------------ RESPONSES ------------ #
+
+# Purpose: Serve an encoded payload, honoring ETags and gzip support
+def payload_response(payload):
+    if request.if_none_match.contains(payload['etag']):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(payload['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(payload['raw'], mimetype='application/json')
+    response.set_etag(payload['etag'])
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+# Purpose: Register the data endpoints on the Flask server and return the data version
+def register_data_api(server, store, preload=False):
+    """
+    Endpoints (relative to the app's base path):
+
+    data/<version>/schema.json                  dictionaries, dtypes and rent caps for decoding payloads, hovertemplates
+    data/<version>/places/<year>/<place>.json   rows of one (place, year) partition
+    data/<version>/series/<place>.json          the series index rows of a place's tracts
+    data/<version>/counties/<year>/<county>.json  every tract of a county in a year, for the county-wide map
+    data/status.json                            current data version, years still loading or failed, years of each place
+
+    Payloads are built on first request, or all at once when preloading, so
+    that gunicorn workers forked afterwards share them.
+
+    While the store is still loading years (see data_store.open_data_store),
+    the data version changes with each of them: requests for an older version
+    get a 404, and data/status.json tells the client the current one.
+    """
+    # Purpose: Dictionaries, schema and places of a data version
+    @functools.lru_cache(maxsize=1)
+    def catalog_state(version):
+        catalog = store.catalog
+        if catalog_version(catalog) != version:
+            # The store moved on since the version was checked; aborting leaves nothing cached
+            abort(404)
+        dictionaries = build_dictionaries(catalog['values'])
+        return {'dictionaries': dictionaries,
+                'schema': schema_payload(dictionaries),
+                'places': {place_key(place): place for place in catalog['places']}
+               }
+
+    # The payload caches are keyed by data version, so an update of the store leaves the old ones unused
+    @functools.lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+    def cached_partition(version, place, year):
+        return partition_payload(store, catalog_state(version)['dictionaries'], place, year)
+
+    @functools.lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+    def cached_county(version, county, year):
+        return county_payload(store, catalog_state(version)['dictionaries'], county, year)
+
+    @functools.lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+    def cached_series(version, place):
+        return series_payload(store, catalog_state(version)['dictionaries'], place)
+
+    if preload:
+        payloads = build_payloads(store)
+        cached_partition = lambda version, place, year: payloads['partitions'].get((place_key(place), year))
+        cached_county = lambda version, county, year: payloads['counties'].get((county, year))
+        cached_series = lambda version, place: payloads['series'].get(place_key(place))
+
+    def check_version(requested):
+        if requested != data_version(store):
+            abort(404)
+        return catalog_state(requested)
+
+    @server.route('/data/<version_id>/schema.json')
+    def schema(version_id):
+        return payload_response(check_version(version_id)['schema'])
+
+    @server.route('/data/<version_id>/places/<int:year>/<path:place>.json')
+    def place_partition(version_id, year, place):
+        place = check_version(version_id)['places'].get(place_key(place))
+        payload = None if place is None else cached_partition(version_id, place, year)
+        if payload is None:
+            abort(404)
+        return payload_response(payload)
+
+    @server.route('/data/<version_id>/series/<path:place>.json')
+    def place_series(version_id, place):
+        place = check_version(version_id)['places'].get(place_key(place))
+        payload = None if place is None else cached_series(version_id, place)
+        if payload is None:
+            abort(404)
+        return payload_response(payload)
+
+    @server.route('/data/<version_id>/counties/<int:year>/<county>.json')
+    def county_rows(version_id, year, county):
+        check_version(version_id)
+        payload = cached_county(version_id, county, year)
+        if payload is None:
+            abort(404)
+        return payload_response(payload)
+
+    @server.route('/data/status.json')
+    def status():
+        response = Response(json.dumps(data_status(store)), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return data_version(store)
+
+
+
+# ------------ STATIC EXPORT ------------ #
+
+# Purpose: Write every payload as a static file, mirroring the endpoint paths
+def write_payloads(payloads, folder):
+    base = f"{folder}/data/{payloads['version']}/"
+    files = {'schema.json': payloads['schema']}
+    files.update({f'places/{year}/{place}.json': payload for (place, year), payload in payloads['partitions'].items()})
+    files.update({f'counties/{year}/{county}.json': payload for (county, year), payload in payloads['counties'].items()})
+    files.update({f'series/{place}.json': payload for place, payload in payloads['series'].items()})
+    for path, payload in files.items():
+        os.makedirs(os.path.dirname(base + path), exist_ok=True)
+        with open(base + path, 'wb') as file:
+            file.write(payload['raw'])
+
+
+if __name__ == '__main__':
+    from data_store import open_data_store
+
+    parser = argparse.ArgumentParser(description='Write the data API payloads as static files.')
+    parser.add_argument('folder', help='root folder of the static site')
+    args = parser.parse_args()
+
+    write_payloads(build_payloads(open_data_store()), args.folder)
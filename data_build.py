@@ -0,0 +1,858 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import glob
+import os
+import sys
+
+from geometry_build import vintage_of
+from crosswalk_build import crosswalk_path, read_crosswalk
+
+
+# ------------ PATHS ------------ #
+assets_path = "assets/"
+
+data_path = "masterfiles/"
+
+cache_path = "cache/"
+
+
+# ------------ CACHE LAYOUT ------------ #
+# The finished masterfile (tract centroids and bounding boxes included) is cached in
+# partitions of one county and one year, each an uncompressed .npz file:
+#
+#   cache/partitions/{STATEFP}/{COUNTYFP}/{year}.npz    rows of the county in that year
+#   cache/partitions/{STATEFP}/{COUNTYFP}/{year}.json   summary of the partition
+#   cache/partitions/{STATEFP}/{COUNTYFP}/series.npz    series index of the county
+#   cache/catalog.json                                  counties, places, years and map viewports, from the summaries
+#   cache/manifest.json                                 source files each year and the series indexes were built from
+#
+# The app reads the catalog at startup and loads partitions on first access (see
+# data_store.py). Bump CACHE_VERSION whenever the cached columns or layout change
+# so caches written by an older build are thrown away rather than misread.
+CACHE_VERSION = 10
+
+# Column -> in-memory dtype. Places and tract names repeat on every row of a
+# place, so they are categoricals. Rents and their margins of error are whole
+# dollars, which float32 holds exactly, with NaN for missing estimates. Display
+# labels are not stored: rent_labels formats them from the estimates on demand.
+MASTERFILE_DTYPES = {'YEAR':        'int16',
+                     'PLACE':       'category',
+                     'GEO_ID':      'int64',
+                     'NAME':        'category',
+                     'B25058_001E': 'float32',
+                     'B25058_001M': 'float32',
+                     'B25057_001E': 'float32',
+                     'B25057_001M': 'float32',
+                     'B25059_001E': 'float32',
+                     'B25059_001M': 'float32',
+                     'INTPTLAT':    'float64',
+                     'INTPTLON':    'float64',
+                     'MINLON':      'float64',
+                     'MINLAT':      'float64',
+                     'MAXLON':      'float64',
+                     'MAXLAT':      'float64'
+                    }
+
+MASTERFILE_COLUMNS = list(MASTERFILE_DTYPES)
+
+CATEGORICAL_COLUMNS = [col for col, dtype in MASTERFILE_DTYPES.items() if dtype == 'category']
+
+# String columns whose distinct values are listed in the catalog
+CATALOG_VALUE_COLUMNS = ['PLACE', 'NAME']
+
+# County names by five-digit state and county FIPS code
+COUNTY_NAMES = {'06037': 'Los Angeles County'}
+
+manifest_path = f'{cache_path}manifest.json'
+
+# Written by ingest.py alongside the masterfiles and per-place geometries it builds
+ingest_manifest_path = f'{data_path}ingest_manifest.json'
+
+
+
+# ------------ SOURCE FILES ------------ #
+
+# Purpose: Path to the masterfile CSV for a given year
+def masterfile_path(year):
+    return f'{data_path}contract_rent_masterfile_{year}.csv'
+
+
+# Purpose: Paths to the geometry files holding the tract centroids and polygons for a given year
+def geometry_paths(year):
+    """
+    The county-wide mastergeometry for a year is preferred when it exists. It is
+    too large to keep in the repository, so we otherwise fall back to the
+    per-place geometries in assets/{year}/, which carry the same properties.
+    """
+    county_path = f'{assets_path}contract_rent_mastergeometry_{year}.json'
+    if os.path.exists(county_path):
+        return [county_path]
+    return sorted(glob.glob(f'{assets_path}{year}/contract_rent_mastergeometry_{year}_*.json'))
+
+
+# Purpose: Fingerprint a file by its size, mtime and content hash
+def file_fingerprint(path, previous=None):
+    """
+    Hashing every geometry file on each boot would defeat the purpose of the
+    cache, so the hash from the previous manifest is reused whenever the size and
+    mtime of the file are unchanged.
+    """
+    stat = os.stat(path)
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        sha256 = previous['sha256']
+    else:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+    return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+
+# Purpose: Fingerprint every source file that goes into a year of the masterfile
+def source_fingerprints(year, previous=None):
+    previous_files = dict()
+    if previous is not None:
+        previous_files = {fp['path']: fp for fp in [previous['csv']] + previous['geometry']}
+
+    csv_path = masterfile_path(year)
+    return {'csv': file_fingerprint(csv_path, previous_files.get(csv_path)),
+            'geometry': [file_fingerprint(path, previous_files.get(path)) for path in geometry_paths(year)]
+           }
+
+
+# Purpose: Compare two sets of fingerprints by content only
+def same_sources(a, b):
+    def hashes(fingerprints):
+        return [(fp['path'], fp['sha256']) for fp in [fingerprints['csv']] + fingerprints['geometry']]
+    return hashes(a) == hashes(b)
+
+
+# Purpose: Read the manifest of ingest.py, if the masterfiles were built by it
+def read_ingest_manifest():
+    try:
+        with open(ingest_manifest_path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return dict()
+
+
+# Purpose: Years of data, from the masterfiles on disk and the years ingest.py started
+def data_years():
+    """
+    A year released since is picked up once ingest.py has run for it, without
+    editing any code. The years must run without gaps, as the series index and
+    the analytics keep one column per year from years.start.
+    """
+    found = {int(path[-len('2010.csv'):-len('.csv')]) for path in glob.glob(masterfile_path('[0-9]' * 4))}
+    found.update(int(year) for year in read_ingest_manifest().get('years', dict()))
+    if not found:
+        return range(2010, 2024)
+    return range(min(found), max(found) + 1)
+
+
+years = data_years()
+
+
+# Purpose: Check the source files of a year against what ingest.py wrote for it
+def check_ingested(year, sources, ingest_manifest):
+    """
+    Years ingest.py never wrote are taken as they are. Raises a RuntimeError
+    when the ingestion of the year did not finish, or when a file it wrote has
+    changed since, rather than caching a half-written or hand-edited year.
+    """
+    entry = ingest_manifest.get('years', dict()).get(str(year))
+    if entry is None:
+        return
+    if entry['status'] != 'complete':
+        raise RuntimeError(f'The ingestion of {year} did not finish; run ingest.py --years {year} again.')
+    found = {fp['path']: fp['sha256'] for fp in [sources['csv']] + sources['geometry']}
+    changed = [output['path'] for output in entry['outputs']
+               if found.get(output['path'], output['sha256']) != output['sha256']]
+    if changed:
+        raise RuntimeError(f'{len(changed)} source file(s) of {year} changed since ingest.py wrote them '
+                           f'(e.g. {changed[0]}); run ingest.py --years {year} again.')
+
+
+
+# ------------ MASTERFILE CONSTRUCTION ------------ #
+
+# This is done because the ACS data caps values at $3501 (for data years
+# after 2014) and $2001 (for data years 2014 and prior). Thus, if a certain
+# metric indicates that number, it means the selected metric is obviously much
+# higher.
+
+# cc. Example: https://data.census.gov/table/ACSDT5Y2015.B25061?q=Renter+Costs&g=160XX00US0643000$1400000
+# Compare the highest price bin in 2023 ('$3500 or more') to the highest price
+# bin in 2014 ('$2000 or more') or any year prior to 2014 for that matter.
+
+# As a side, it appears that max price was revised up from $2000 to $3500,
+# corresponding to the transition from 2014 to 2015. This possibly reflects
+# the sentiment that ACS data would not adequately capture the entire spectrum
+# of variation in rents especially as they occur along the higher end of the spectrum.
+# Nonetheless, it is curious as to why ACS data does not display or provide higher price bins
+# for data years prior to 2014.
+
+# Each row gives the first data year a cap applies to; it holds until the next row
+RENT_CAPS = pd.DataFrame({'FIRST_YEAR': [2010, 2015],
+                          'CAP':        [2001, 3501]
+                         })
+
+# Purpose: Look up the ACS cap in effect for each entry of an array of years
+def rent_caps(year_array):
+    index = np.searchsorted(RENT_CAPS['FIRST_YEAR'].to_numpy(), year_array, side='right') - 1
+    return RENT_CAPS['CAP'].to_numpy()[np.clip(index, 0, None)]
+
+
+# Purpose: Turn an array of rent estimates into display labels
+def rent_labels(values, caps):
+    """
+    Rents take a few thousand distinct values at most, so each distinct value is
+    formatted once and the labels are gathered back by index. Values equal to the
+    cap for their year are reported as exceeding it. rentsData.label in
+    assets/data_api.js formats labels the same way on the client.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    formatted = np.array(['Not Available!' if np.isnan(value) else f'${value:.0f}'
+                          for value in uniques], dtype=object)
+    labels = formatted[inverse.reshape(-1)]
+
+    capped = values == caps
+    labels[capped] = [f'Not available. Exceeds ${cap - 1}!' for cap in caps[capped]]
+    return labels
+
+
+# Purpose: Bounding box (MINLON, MINLAT, MAXLON, MAXLAT) of a GeoJSON polygon or multipolygon
+def feature_bounds(geometry):
+    if geometry is None:
+        return (np.nan,) * 4
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    # Holes lie inside their exterior ring
+    points = np.concatenate([np.asarray(polygon[0], dtype=float)[:, :2] for polygon in polygons])
+    return (*points.min(axis=0), *points.max(axis=0))
+
+
+# Purpose: Collect the tract centroids (INTPTLAT, INTPTLON) and bounding boxes for the given years
+def read_tract_locations(build_years):
+    # Only properties and raw coordinates are needed, so the GeoJSON is parsed as
+    # plain JSON rather than paying for geometry construction in gpd.read_file
+    records = []
+    for year in build_years:
+        for path in geometry_paths(year):
+            with open(path) as file:
+                features = json.load(file)['features']
+            records.extend((year, f['properties']['GEO_ID'], f['properties']['INTPTLAT'], f['properties']['INTPTLON'],
+                            *feature_bounds(f['geometry']))
+                           for f in features)
+    locations = pd.DataFrame.from_records(records, columns=['YEAR', 'GEO_ID', 'INTPTLAT', 'INTPTLON',
+                                                            'MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'])
+    # A tract spanning several places shows up once per place; its centroid and polygon are the same
+    return locations.drop_duplicates(['YEAR', 'GEO_ID'])
+
+
+# Purpose: Build the finished rows of one year
+def build_year(year):
+    df = pd.read_csv(masterfile_path(year))
+    df = pd.merge(df, read_tract_locations([year]), on=['YEAR', 'GEO_ID'], how='left')
+    # A tract without a polygon still counts towards its place's viewport through its centroid
+    for col, centroid in BOUNDS_CENTROIDS.items():
+        df[col] = df[col].fillna(df[centroid])
+    return df[MASTERFILE_COLUMNS].astype(MASTERFILE_DTYPES)
+
+
+# Purpose: Build the finished masterfile for the given years, one after another
+def build_masterfile(build_years):
+    return concat_rows(build_year(year) for year in build_years)
+
+
+# Purpose: Build the rows of the given years across a process pool, yielding each year as it finishes
+def load_years(build_years, workers=None):
+    """
+    Parsing the CSV and the geometry files of a year is CPU-bound, so years are
+    built in separate processes. Yields (year, rows, error) in the order the
+    years finish, with rows None and error a message when a year could not be
+    built; years are submitted in the order given.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_year, year): year for year in build_years}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                rows, error = future.result(), None
+            except Exception as exception:
+                rows, error = None, f'{type(exception).__name__}: {exception}'
+            yield futures[future], rows, error
+
+
+# Purpose: Concatenate masterfile rows, keeping the categorical columns categorical
+def concat_rows(frames):
+    """
+    pandas turns categoricals with different categories (e.g. of two partitions)
+    into object columns, so the categories are unioned instead.
+    """
+    frames = list(frames)
+    df = pd.concat(frames, ignore_index=True)
+    for col in CATEGORICAL_COLUMNS:
+        df[col] = union_categoricals([frame[col] for frame in frames], sort_categories=True)
+    return df
+
+
+
+
+# ------------ MAP VIEWPORTS ------------ #
+# The map opens on the bounding box of the selected place's tracts, or of the
+# whole county in the county-wide view. Boxes are computed here once per (place,
+# year) and (county, year) and listed in the catalog along with the center and
+# zoom that fit them, so the choropleth callback reads its viewport instead of
+# averaging centroids on every render.
+#
+# Zoom levels follow the map's Web Mercator tiles: the world is TILE_SIZE pixels
+# wide at zoom 0 and doubles with each level. The box is fitted into MAP_SIZE,
+# the size of the map in the app's two-column layout, with VIEWPORT_PADDING of
+# the box's extent added on each side.
+
+# Bounding box column -> centroid column it falls back to
+BOUNDS_CENTROIDS = {'MINLON': 'INTPTLON',
+                    'MINLAT': 'INTPTLAT',
+                    'MAXLON': 'INTPTLON',
+                    'MAXLAT': 'INTPTLAT'
+                   }
+
+TILE_SIZE = 512
+
+# Width and height of the map, in pixels
+MAP_SIZE = (520, 450)
+
+VIEWPORT_PADDING = 0.05
+
+MAX_ZOOM = 15
+
+# Viewport of a place whose tracts have no location at all: the whole county
+DEFAULT_VIEWPORT = {'bounds': None, 'center': {'lat': 34.2, 'lon': -118.26}, 'zoom': 7.5}
+
+
+# Purpose: Bounding box [MINLON, MINLAT, MAXLON, MAXLAT] of each place's tracts in a partition
+def place_bounds(df):
+    bounds = df.groupby('PLACE', sort=False, observed=True).agg(MINLON=('MINLON', 'min'), MINLAT=('MINLAT', 'min'),
+                                                 MAXLON=('MAXLON', 'max'), MAXLAT=('MAXLAT', 'max'))
+    return {place: [None if np.isnan(value) else float(value) for value in row]
+            for place, row in zip(bounds.index, bounds.to_numpy())}
+
+
+# Purpose: Combine bounding boxes, e.g. of the parts of a place in several counties
+def union_bounds(a, b):
+    if a is None or None in a:
+        return b
+    if b is None or None in b:
+        return a
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+
+# Purpose: Web Mercator y of a latitude, in radians
+def mercator_y(lat):
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+# Purpose: Center and zoom fitting a bounding box into the map
+def fit_viewport(bounds):
+    if bounds is None or None in bounds:
+        return DEFAULT_VIEWPORT
+    min_lon, min_lat, max_lon, max_lat = bounds
+    south, north = mercator_y(min_lat), mercator_y(max_lat)
+
+    # Fraction of the world's width and height the padded box takes up, kept
+    # above zero for a place of a single point
+    scale = 1 + 2 * VIEWPORT_PADDING
+    width = max((max_lon - min_lon) / 360 * scale, 1e-9)
+    height = max((north - south) / (2 * np.pi) * scale, 1e-9)
+    zoom = np.log2(min(MAP_SIZE[0] / (TILE_SIZE * width), MAP_SIZE[1] / (TILE_SIZE * height)))
+
+    center_lat = np.degrees(2 * np.arctan(np.exp((south + north) / 2)) - np.pi / 2)
+    return {'bounds': [round(value, 5) for value in bounds],
+            'center': {'lat': round(float(center_lat), 5), 'lon': round((min_lon + max_lon) / 2, 5)},
+            'zoom': round(float(min(zoom, MAX_ZOOM)), 2)
+           }
+
+
+
+# ------------ CACHE ------------ #
+
+# Purpose: Five-digit state and county FIPS code of each GEO_ID
+def county_fips(geo_ids):
+    """
+    Tract GEO_IDs are the state (2 digits), county (3) and tract (6) codes with
+    the leading zero of the state dropped, e.g. 6037542402.
+    """
+    return np.char.zfill((np.asarray(geo_ids) // 10 ** 6).astype(str), 5)
+
+
+# Purpose: Folder holding the partitions of a county
+def county_path(county, folder=cache_path):
+    return f'{folder}partitions/{county[:2]}/{county[2:]}/'
+
+
+# Purpose: Path to the cached rows of a county in a given year
+def partition_path(county, year, folder=cache_path):
+    return f'{county_path(county, folder)}{year}.npz'
+
+
+# Purpose: Path to the cached series index of a county
+def series_index_path(county, folder=cache_path):
+    return f'{county_path(county, folder)}series.npz'
+
+
+# Purpose: Path to the catalog of a cache folder
+def catalog_path(folder=cache_path):
+    return f'{folder}catalog.json'
+
+
+# Purpose: Write a file atomically through a temporary file in the same folder
+def write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    base, extension = os.path.splitext(path)
+    tmp_path = f'{base}.{os.getpid()}.tmp{extension}'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Purpose: Write a JSON file atomically
+def write_json(path, data, indent=None):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file, indent=indent)
+    write_atomic(path, write)
+
+
+# Purpose: Write the rows of a county in a given year, with a summary for the catalog
+def write_partition(df, county, year, folder=cache_path):
+    # Categoricals are stored as their codes and a fixed-width unicode array of
+    # categories, narrowed to the partition, so that loading never needs pickle
+    df = df.assign(**{col: df[col].cat.remove_unused_categories() for col in CATEGORICAL_COLUMNS})
+    arrays = dict()
+    for col in MASTERFILE_COLUMNS:
+        if col in CATEGORICAL_COLUMNS:
+            arrays[col] = df[col].cat.codes.to_numpy()
+            arrays[f'{col}_categories'] = df[col].cat.categories.to_numpy(dtype=str)
+        else:
+            arrays[col] = df[col].to_numpy()
+    path = partition_path(county, year, folder)
+    write_atomic(path, lambda tmp_path: np.savez(tmp_path, **arrays))
+
+    with open(path, 'rb') as file:
+        sha256 = hashlib.sha256(file.read()).hexdigest()
+    summary = {'county': county, 'year': int(year), 'rows': len(df), 'bytes': os.path.getsize(path),
+               'sha256': sha256,
+               'places': {place: int(rows) for place, rows in df['PLACE'].value_counts(sort=False).items()},
+               'bounds': place_bounds(df),
+               'values': {col: sorted(df[col].unique().tolist()) for col in CATALOG_VALUE_COLUMNS}
+              }
+    write_json(path[:-len('.npz')] + '.json', summary)
+
+
+# Purpose: Read the rows of a county in a given year
+def read_partition(county, year, folder=cache_path):
+    with np.load(partition_path(county, year, folder), allow_pickle=False) as npz:
+        return pd.DataFrame({col: pd.Categorical.from_codes(npz[col], npz[f'{col}_categories'].astype(object))
+                                  if col in CATEGORICAL_COLUMNS else npz[col]
+                             for col in MASTERFILE_COLUMNS})
+
+
+# Purpose: Split a masterfile into county-year partitions and rebuild the affected series indexes
+def write_partitions(df, folder=cache_path):
+    """
+    Returns the counties written for each year. The series index of a county
+    spans all of its years, so it is rebuilt from every partition of the county
+    on disk once the new ones are written.
+    """
+    counties = county_fips(df['GEO_ID'].to_numpy())
+    written = dict()
+    for (county, year), rows in df.groupby([counties, 'YEAR'], sort=False):
+        write_partition(rows.reset_index(drop=True), county, year, folder)
+        written.setdefault(int(year), []).append(county)
+
+    write_series_indexes(set(counties), folder)
+    return {year: sorted(year_counties) for year, year_counties in written.items()}
+
+
+# Purpose: Rebuild the series index of each county from all of its partitions on disk
+def write_series_indexes(counties, folder=cache_path):
+    crosswalk = read_crosswalk()
+    for county in counties:
+        county_years = [year for year in years if os.path.exists(partition_path(county, year, folder))]
+        if not county_years:
+            # Every year of the county failed to build (see PartitionBuild)
+            if os.path.exists(series_index_path(county, folder)):
+                os.remove(series_index_path(county, folder))
+            continue
+        masterfile = concat_rows(read_partition(county, year, folder) for year in county_years)
+        index = build_series_index(masterfile, crosswalk)
+        write_atomic(series_index_path(county, folder), lambda tmp_path: np.savez(tmp_path, **index))
+
+
+# Purpose: Gather the partition summaries of a cache folder into its catalog
+def write_catalog(folder=cache_path, failures=None):
+    """
+    The catalog is all the app reads at startup: which counties, places and years
+    exist, the size and content hash of each partition, the distinct values of
+    the string columns (for the dictionaries of the data API), and a data version
+    that changes whenever any partition or series index does. Each place also gets the map
+    viewport of each of its years, fitted to its tracts across all its counties,
+    and each county the viewport of each of its years. Years that failed to
+    build are listed with their errors.
+    """
+    summaries = []
+    for path in sorted(glob.glob(f'{folder}partitions/*/*/*.json')):
+        with open(path) as file:
+            summaries.append(json.load(file))
+
+    counties, places, partitions = dict(), dict(), dict()
+    values = {col: set() for col in CATALOG_VALUE_COLUMNS}
+    bounds = dict()
+    version = hashlib.sha1(str(CACHE_VERSION).encode())
+    for summary in summaries:
+        county, year = summary['county'], summary['year']
+        partitions[f'{county}/{year}'] = {'rows': summary['rows'], 'bytes': summary['bytes'], 'sha256': summary['sha256']}
+        entry = counties.setdefault(county, {'name': COUNTY_NAMES.get(county, f'County {county}'), 'years': []})
+        entry['years'].append(year)
+        for place in summary['places']:
+            entry = places.setdefault(place, {'counties': [], 'years': []})
+            if county not in entry['counties']:
+                entry['counties'].append(county)
+            if year not in entry['years']:
+                entry['years'].append(year)
+            bounds[(place, year)] = union_bounds(bounds.get((place, year)), summary['bounds'][place])
+            bounds[(county, year)] = union_bounds(bounds.get((county, year)), summary['bounds'][place])
+        for col in CATALOG_VALUE_COLUMNS:
+            values[col].update(summary['values'][col])
+        version.update(summary['sha256'].encode())
+
+    for county, entry in sorted(counties.items()):
+        # Series indexes also depend on the crosswalk, so they are hashed on their own
+        with open(series_index_path(county, folder), 'rb') as file:
+            entry['series_sha256'] = hashlib.sha256(file.read()).hexdigest()
+        version.update(entry['series_sha256'].encode())
+    for entry in list(counties.values()) + list(places.values()):
+        entry['years'].sort()
+    for name, entry in list(counties.items()) + list(places.items()):
+        entry['viewports'] = {str(year): fit_viewport(bounds[(name, year)]) for year in entry['years']}
+    catalog = {'version': CACHE_VERSION,
+               'data_version': version.hexdigest()[:12],
+               'counties': counties,
+               'places': places,
+               'partitions': partitions,
+               'values': {col: sorted(col_values) for col, col_values in values.items()},
+               'failed_years': {str(year): error for year, error in sorted((failures or dict()).items())}
+              }
+    write_json(catalog_path(folder), catalog)
+    return catalog
+
+
+# Purpose: Read the catalog of a cache folder
+def read_catalog(folder=cache_path):
+    with open(catalog_path(folder)) as file:
+        return json.load(file)
+
+
+# Purpose: Read the cache manifest, discarding it if it was written by another cache version
+def read_manifest():
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'version': CACHE_VERSION, 'years': dict(), 'counties': dict()}
+    if manifest.get('version') != CACHE_VERSION:
+        return {'version': CACHE_VERSION, 'years': dict(), 'counties': dict()}
+    return manifest
+
+
+# Purpose: Write the cache manifest
+def write_manifest(manifest):
+    write_json(manifest_path, manifest, indent=1)
+
+
+class PartitionBuild:
+    """
+    Brings the partitioned cache up to date, a year at a time.
+
+    Each year is left as is when its CSV and geometry files match the
+    fingerprints recorded in the manifest and its partitions exist. The other
+    years are built across a process pool (see load_years) and written as they
+    finish, each with the series indexes of its counties; every series index is
+    rebuilt when the crosswalk changes. A year that cannot be built (a missing
+    or malformed file, an unfinished ingestion) is reported in `failures` and in
+    the catalog and left out of the cache, and is retried by the next build.
+
+    run() can return once some years are written and be called again for the
+    rest, e.g. from a background thread while the app serves the years written
+    so far (see data_store.open_data_store).
+    """
+
+    def __init__(self, force=False, first_years=(), workers=None):
+        self.manifest = read_manifest()
+        self.failures = dict()
+        self.changed = False
+        self.rewrite_catalog = not os.path.exists(catalog_path())
+        ingest_manifest = read_ingest_manifest()
+
+        stale = []
+        for year in years:
+            previous = self.manifest['years'].get(str(year))
+            try:
+                sources = source_fingerprints(year, previous)
+                check_ingested(year, sources, ingest_manifest)
+            except (OSError, RuntimeError) as error:
+                self.fail(year, f'{type(error).__name__}: {error}')
+                continue
+            counties = self.manifest['counties'].get(str(year))
+            fresh = (not force and previous is not None and same_sources(previous, sources) and counties is not None
+                     and all(os.path.exists(partition_path(county, year)) for county in counties))
+            if not fresh:
+                stale.append(year)
+                # The counties of a year are only recorded once it is written
+                self.manifest['counties'].pop(str(year), None)
+                for path in glob.glob(f'{cache_path}partitions/*/*/{year}.*'):
+                    os.remove(path)
+                # The catalog must stop listing its partitions before anyone reads it
+                self.rewrite_catalog = True
+
+            if previous != sources:
+                self.manifest['years'][str(year)] = sources
+                self.changed = True
+
+        if stale:
+            # An interrupted build then leaves the years it did not finish to be rebuilt
+            write_manifest(self.manifest)
+
+        self.built = list()
+        self.pending = sorted(stale, key=lambda year: year not in first_years)
+        self.results = load_years(list(self.pending), workers) if stale else iter(())
+
+    # Purpose: Leave a year out of the cache, removing its partitions and reporting it
+    def fail(self, year, error):
+        self.failures[year] = error
+        print(f'{year}: not loaded ({error})', file=sys.stderr, flush=True)
+        counties = self.manifest['counties'].pop(str(year), None)
+        if counties is not None:
+            for path in glob.glob(f'{cache_path}partitions/*/*/{year}.*'):
+                os.remove(path)
+            write_series_indexes(counties)
+        self.changed = True
+        self.rewrite_catalog = True
+
+    # Purpose: Write the catalog if anything changed since it was last written, or read it
+    def catalog(self):
+        if self.rewrite_catalog:
+            self.rewrite_catalog = False
+            return write_catalog(failures=self.failures)
+        return read_catalog()
+
+    # Purpose: Write years as they finish and return the catalog
+    def run(self, until=(), on_catalog=None):
+        """
+        Returns once every year in `until` has been written or has failed, or
+        once every year has when `until` is empty. With on_catalog, the catalog
+        is rewritten after each year but the last and passed to it along with
+        the years still pending.
+        """
+        # Checked before each year, so that nothing is waited for when `until` is already written
+        while self.pending and not (until and not set(until) & set(self.pending)):
+            year, rows, error = next(self.results)
+            self.pending.remove(year)
+            if error is None:
+                written = write_partitions(rows)
+                self.manifest['counties'][str(year)] = written.get(year, [])
+                self.built.append(year)
+                self.changed = True
+                self.rewrite_catalog = True
+            else:
+                self.fail(year, error)
+            if on_catalog is not None and self.pending:
+                on_catalog(self.catalog(), list(self.pending))
+
+        if not self.pending:
+            previous = self.manifest.get('crosswalk')
+            crosswalk = file_fingerprint(crosswalk_path, previous) if os.path.exists(crosswalk_path) else None
+            if (crosswalk or {}).get('sha256') != (previous or {}).get('sha256'):
+                # Counties whose series indexes were just rebuilt are done again, which is cheap
+                write_series_indexes({county for counties in self.manifest['counties'].values() for county in counties})
+                self.rewrite_catalog = True
+            if previous != crosswalk:
+                self.manifest['crosswalk'] = crosswalk
+                self.changed = True
+
+        if self.changed:
+            write_manifest(self.manifest)
+            self.changed = False
+        return self.catalog()
+
+
+# Purpose: Bring the partitioned cache up to date, rebuilding only the years whose sources changed
+def build_partitions(force=False, verbose=False, workers=None):
+    """
+    Stale years are built concurrently, and years that fail are reported and
+    left out rather than stopping the build (see PartitionBuild). Returns the
+    catalog.
+    """
+    build = PartitionBuild(force, workers=workers)
+    catalog = build.run()
+    if verbose:
+        for year in years:
+            status = ('built' if year in build.built else f'failed ({build.failures[year]})' if year in build.failures
+                      else 'cached')
+            print(f'{year}: {status} ({len(build.manifest["counties"].get(str(year), []))} counties)')
+    return catalog
+
+
+# Purpose: Load the whole finished masterfile into memory
+def load_masterfile(force=False, verbose=False):
+    """
+    The app loads partitions lazily through data_store.py; this is for scripts
+    that want every row at once.
+    """
+    catalog = build_partitions(force, verbose)
+    return concat_rows(read_partition(county, year) for year in years for county in sorted(catalog['counties'])
+                       if year in catalog['counties'][county]['years'])
+
+
+
+# ------------ SERIES INDEX ------------ #
+# Every tract's estimates and margins of error laid out as one fixed-length row
+# per tract, with a column for each year in `years` and NaN where the tract has
+# no data. The rent plot reads a tract's history as a single row instead of
+# filtering the masterfile. Each county has its own, rebuilt whenever one of its
+# partitions is.
+#
+# A tract drawn in 2020 has no data for 2010 to 2019, and a tract retired in 2020
+# none after. With the crosswalk of crosswalk_build.py, those years are filled
+# by areal interpolation from the overlapping tracts of the other vintage: the
+# estimate of a tract is the average of the overlapping tracts' estimates,
+# weighted by the share of the tract each one covers, and its margin of error
+# the root of their weighted squared margins, as for any ACS average. Filled
+# entries are flagged in INTERPOLATED.
+
+# Estimate and margin-of-error columns for each percentile
+SERIES_MEASURES = {'Median': ('B25058_001E', 'B25058_001M'),
+                   '25th':   ('B25057_001E', 'B25057_001M'),
+                   '75th':   ('B25059_001E', 'B25059_001M')
+                  }
+
+SERIES_COLUMNS = [col for measure in SERIES_MEASURES.values() for col in measure]
+
+# Overlaps covering less than this share of a tract are left out of its interpolation
+MIN_SHARE = 0.01
+
+# Share of a tract that overlapping tracts with data must cover for it to be interpolated
+MIN_COVERAGE = 0.5
+
+# Share of that covered area that capped estimates must cover for the tract to get the cap
+MIN_CAPPED_SHARE = 0.5
+
+
+# Purpose: Lay out every tract's history as fixed-length rows keyed by GEO_ID
+def build_series_index(masterfile, crosswalk=None):
+    """
+    Returns GEO_ID (sorted, one per row), NAME (one per row), YEAR (one per
+    column), a (tracts, years) array for each column in SERIES_COLUMNS and the
+    INTERPOLATED flags. A tract spanning several places has the same values in
+    each of them. Nothing is interpolated without a crosswalk.
+    """
+    geo_ids, first = np.unique(masterfile['GEO_ID'].to_numpy(), return_index=True)
+    rows = np.searchsorted(geo_ids, masterfile['GEO_ID'].to_numpy())
+    cols = masterfile['YEAR'].to_numpy() - years.start
+
+    index = {'GEO_ID': geo_ids,
+             'NAME': masterfile['NAME'].to_numpy(dtype=str)[first],
+             'YEAR': np.arange(years.start, years.stop)
+            }
+    for col in SERIES_COLUMNS:
+        values = np.full((len(geo_ids), len(years)), np.nan, dtype=np.float32)
+        values[rows, cols] = masterfile[col].to_numpy()
+        index[col] = values
+
+    index['INTERPOLATED'] = np.zeros((len(geo_ids), len(years)), dtype=np.int8)
+    if crosswalk is not None:
+        present = np.zeros((len(geo_ids), len(years)), dtype=bool)
+        present[rows, cols] = True
+        vintages = crosswalk['VINTAGES'].tolist()
+        interpolate_vintages(index, present, crosswalk['SOURCE'], crosswalk['TARGET'], crosswalk['AREA'],
+                             crosswalk['TARGET_AREA'], vintages[0])
+        interpolate_vintages(index, present, crosswalk['TARGET'], crosswalk['SOURCE'], crosswalk['AREA'],
+                             crosswalk['SOURCE_AREA'], vintages[1])
+    return index
+
+
+# Purpose: Fill the years of one vintage for the tracts of the other, from the overlaps between them
+def interpolate_vintages(index, present, sources, targets, areas, target_areas, vintage):
+    """
+    `sources` and `targets` are the GEO_IDs of each overlap, `vintage` that of
+    the sources. Only tracts absent from the source vintage are filled, in the
+    years they have no row for. The weighted sums of every tract and year are
+    computed at once: each overlap is scattered into its target's row with
+    np.bincount, over the flattened (tract, year) grid.
+
+    Overlaps with a capped estimate only give a lower bound, so a tract gets the
+    cap of the year when they cover at least MIN_CAPPED_SHARE of the area with
+    an estimate, and otherwise counts them at the cap. Overlaps with an estimate
+    but no margin of error leave the interpolated margin unknown.
+    """
+    geo_ids = index['GEO_ID']
+    cols = np.flatnonzero(np.array([vintage_of(year) for year in index['YEAR']]) == vintage)
+    shares = areas / target_areas
+    keep = np.isin(sources, geo_ids) & np.isin(targets, geo_ids) & ~np.isin(targets, sources) & (shares >= MIN_SHARE)
+    if not keep.any() or len(cols) == 0:
+        return
+    source_rows = np.searchsorted(geo_ids, sources[keep])
+    target_rows = np.searchsorted(geo_ids, targets[keep])
+    shares = shares[keep][:, None]
+
+    # Flat index of each (overlap, year) in the (tract, year) grid
+    size = len(geo_ids) * len(cols)
+    cells = (target_rows[:, None] * len(cols) + np.arange(len(cols))).ravel()
+    caps = rent_caps(index['YEAR'][cols])
+
+    def scatter(weights):
+        return np.bincount(cells, weights=np.broadcast_to(weights, (len(target_rows), len(cols))).ravel(),
+                           minlength=size).reshape(len(geo_ids), len(cols))
+
+    filled = np.zeros((len(geo_ids), len(cols)), dtype=bool)
+    for estimate_col, moe_col in SERIES_MEASURES.values():
+        values = index[estimate_col][source_rows][:, cols].astype(float)
+        moes = index[moe_col][source_rows][:, cols].astype(float)
+        reported = ~np.isnan(values)
+        weights = np.where(reported, shares, 0)
+
+        covered = scatter(weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            estimate = scatter(weights * np.nan_to_num(values)) / covered
+            moe = np.sqrt(scatter((weights * np.nan_to_num(moes)) ** 2)) / covered
+            capped = scatter(np.where(reported & (values >= caps), shares, 0)) / covered >= MIN_CAPPED_SHARE
+        estimate[capped] = np.broadcast_to(caps, capped.shape)[capped]
+        moe[capped | (scatter(reported & np.isnan(moes)) > 0)] = np.nan
+
+        fill = (covered >= MIN_COVERAGE) & ~present[:, cols]
+        index[estimate_col][:, cols] = np.where(fill, estimate, index[estimate_col][:, cols])
+        index[moe_col][:, cols] = np.where(fill, moe, index[moe_col][:, cols])
+        filled |= fill
+    index['INTERPOLATED'][:, cols] = filled
+
+
+# Purpose: Read the series index of a county
+def read_series_index(county, folder=cache_path):
+    with np.load(series_index_path(county, folder), allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+
+# ------------ EXECUTE THE BUILD ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the partitioned masterfile cache used by app.py.')
+    parser.add_argument('--force', action='store_true', help='rebuild every year, ignoring the cache')
+    parser.add_argument('--workers', type=int, default=None, help='size of the process pool')
+    args = parser.parse_args()
+
+    build_partitions(force=args.force, verbose=True, workers=args.workers)
@@ -0,0 +1,290 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import numpy as np
+import collections
+import glob
+import json
+import os
+import shutil
+import threading
+
+from data_build import (PartitionBuild, read_partition, read_series_index, concat_rows, county_fips, cache_path,
+                        write_json, years, MASTERFILE_COLUMNS, CATEGORICAL_COLUMNS)
+
+
+# ------------ PARTITION STORE ------------ #
+# The app keeps only the catalog in memory from the start. County-year partitions
+# and county series indexes are read from the cache on first access and kept in a
+# least-recently-used cache bounded by an approximate memory cap, so a dashboard
+# covering every county holds only the counties people are looking at.
+
+# Memory cap of the partition cache, in megabytes
+PARTITION_CACHE_MB = int(os.environ.get('RENTS_PARTITION_CACHE_MB', 512))
+
+# Preload mode, set by gunicorn.conf.py: the data is mapped from a shared dataset
+# and every payload is built before the workers fork (see below)
+PRELOAD = os.environ.get('RENTS_PRELOAD', '0') == '1'
+
+
+# Purpose: Approximate in-memory size of a cached partition, row index or series index
+def memory_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return sum(array.nbytes for array in value.values())
+
+
+# Purpose: Rows of each place in a partition
+def place_index(df):
+    return {place: rows for place, rows in df.groupby('PLACE', sort=False, observed=True).indices.items()}
+
+
+class DataStore:
+    """
+    Lazy access to a partitioned cache folder written by data_build.py.
+
+    partition(county, year)   rows of a county in a year
+    series_index(county)      the series index of a county
+    place_index(county, year) place -> rows of the county's partition in a year
+    place_rows(place, year)   rows of a place in a year, across its counties
+
+    While years are still being built in the background (see open_data_store),
+    `loading` lists them and update() swaps in each new catalog.
+    """
+
+    def __init__(self, catalog, folder=cache_path, max_bytes=PARTITION_CACHE_MB * 2 ** 20):
+        self.catalog = catalog
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.loading = []
+        self.cache = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    # The data version always matches the catalog, even while update() swaps it
+    @property
+    def version(self):
+        return self.catalog['data_version']
+
+    # Purpose: Swap in the catalog of a cache that has new years, dropping every cached value
+    def update(self, catalog, loading=()):
+        with self.lock:
+            # Partitions are only ever added or removed, but a series index covers every year
+            self.cache.clear()
+            self.bytes = 0
+            self.catalog = catalog
+            self.loading = list(loading)
+
+    # Purpose: Return a cached value, loading it and evicting the least recently used ones as needed
+    def cached(self, key, load):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.cache[key][0]
+            self.stats['misses'] += 1
+
+        # Loaded outside the lock, so a slow read does not hold up other requests
+        value = load()
+        size = memory_size(value)
+        with self.lock:
+            if key in self.cache:
+                # Another request loaded it in the meantime
+                return self.cache[key][0]
+            self.cache[key] = (value, size)
+            self.bytes += size
+            # The newest entry stays even when it alone exceeds the cap
+            while self.bytes > self.max_bytes and len(self.cache) > 1:
+                _, (_, evicted_size) = self.cache.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats['evictions'] += 1
+            return value
+
+    def partition(self, county, year):
+        return self.cached(('partition', county, year), lambda: read_partition(county, year, self.folder))
+
+    def place_index(self, county, year):
+        return self.cached(('places', county, year), lambda: place_index(self.partition(county, year)))
+
+    def series_index(self, county):
+        return self.cached(('series', county), lambda: read_series_index(county, self.folder))
+
+    def place_rows(self, place, year):
+        """
+        Returns None when the place has no data that year.
+        """
+        entry = self.catalog['places'].get(place)
+        if entry is None or year not in entry['years']:
+            return None
+        frames = []
+        for county in entry['counties']:
+            if year in self.catalog['counties'][county]['years']:
+                rows = self.place_index(county, year).get(place)
+                if rows is not None:
+                    frames.append(self.partition(county, year).take(rows))
+        if not frames:
+            return None
+        return concat_rows(frames)
+
+    def tract_rows(self, year, geo_ids):
+        """
+        Returns the rows of every partition of that year the GEO_IDs fall in, or
+        None when there are none.
+        """
+        frames = []
+        for county in np.unique(county_fips(geo_ids)):
+            if year in self.catalog['counties'].get(county, {'years': []})['years']:
+                frames.append(self.partition(county, year))
+        if not frames:
+            return None
+        return concat_rows(frames)
+
+    def usage(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.cache), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+
+
+# ------------ SHARED DATASET ------------ #
+# Each worker of a DataStore reads partitions into its own heap, so memory grows
+# with the number of workers. In preload mode every partition and series index is
+# instead written once per data version into plain .npy files:
+#
+#   cache/shared/{data_version}/{column}.npy              the column across every partition, in index order
+#   cache/shared/{data_version}/{column}_categories.npy   categories of a categorical column, across every partition
+#   cache/shared/{data_version}/series_{column}.npy       the series indexes of every county, stacked
+#   cache/shared/{data_version}/index.json                row range of each partition and series index
+#
+# Workers map the files read-only (np.load with mmap_mode='r'), and partitions
+# are DataFrames over slices of the maps. The pages are shared by every process
+# through the OS page cache instead of copied into each heap, and a new worker
+# maps the files without reading them.
+
+# Purpose: Folder of the shared dataset of a data version
+def shared_path(version, folder=cache_path):
+    return f'{folder}shared/{version}/'
+
+
+# Purpose: Write the shared dataset of a catalog, unless it already exists
+def write_shared_dataset(catalog, folder=cache_path):
+    """
+    The files are written to a temporary folder that is renamed into place, so
+    a process never maps a partial dataset. Datasets of other data versions are
+    removed; processes still mapping them keep their files until they exit.
+    """
+    path = shared_path(catalog['data_version'], folder)
+    if os.path.exists(f'{path}index.json'):
+        return path
+
+    keys = [(county, year) for county, entry in sorted(catalog['counties'].items()) for year in entry['years']]
+    frames = [read_partition(county, year, folder) for county, year in keys]
+    masterfile = concat_rows(frames)
+    ends = np.cumsum([len(frame) for frame in frames]).tolist()
+    index = {'partitions': {f'{county}/{year}': [start, end]
+                            for (county, year), start, end in zip(keys, [0] + ends[:-1], ends)},
+             'series': dict()}
+
+    indexes = [read_series_index(county, folder) for county in sorted(catalog['counties'])]
+    ends = np.cumsum([len(series['GEO_ID']) for series in indexes]).tolist()
+    index['series'] = {county: [start, end]
+                       for county, start, end in zip(sorted(catalog['counties']), [0] + ends[:-1], ends)}
+
+    tmp_path = f'{path[:-1]}.{os.getpid()}.tmp/'
+    os.makedirs(tmp_path, exist_ok=True)
+    for col in MASTERFILE_COLUMNS:
+        if col in CATEGORICAL_COLUMNS:
+            np.save(f'{tmp_path}{col}.npy', masterfile[col].cat.codes.to_numpy())
+            np.save(f'{tmp_path}{col}_categories.npy', masterfile[col].cat.categories.to_numpy(dtype=str))
+        else:
+            np.save(f'{tmp_path}{col}.npy', masterfile[col].to_numpy())
+    for key in indexes[0]:
+        if key == 'YEAR':
+            np.save(f'{tmp_path}series_YEAR.npy', indexes[0]['YEAR'])
+        else:
+            np.save(f'{tmp_path}series_{key}.npy', np.concatenate([series[key] for series in indexes]))
+    write_json(f'{tmp_path}index.json', index)
+
+    try:
+        os.rename(tmp_path[:-1], path[:-1])
+    except OSError:
+        # Another process wrote it in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    for stale in glob.glob(f'{folder}shared/*/'):
+        if os.path.normpath(stale) != os.path.normpath(path) and not stale.endswith('.tmp/'):
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+
+class SharedDataStore(DataStore):
+    """
+    A DataStore whose partitions and series indexes are read-only views into the
+    shared dataset of its catalog, written by write_shared_dataset. Only the place
+    indexes go through the LRU.
+    """
+
+    def __init__(self, catalog, folder=cache_path, max_bytes=PARTITION_CACHE_MB * 2 ** 20):
+        super().__init__(catalog, folder, max_bytes)
+        path = write_shared_dataset(catalog, folder)
+        with open(f'{path}index.json') as file:
+            self.index = json.load(file)
+        self.arrays = {os.path.basename(name)[:-len('.npy')]: np.load(name, mmap_mode='r')
+                       for name in glob.glob(f'{path}*.npy') if not name.endswith('_categories.npy')}
+        self.categories = {col: pd.Index(np.load(f'{path}{col}_categories.npy').astype(object))
+                           for col in CATEGORICAL_COLUMNS}
+
+    def partition(self, county, year):
+        start, end = self.index['partitions'][f'{county}/{year}']
+        return pd.DataFrame({col: pd.Categorical.from_codes(self.arrays[col][start:end], self.categories[col])
+                                  if col in CATEGORICAL_COLUMNS else self.arrays[col][start:end]
+                             for col in MASTERFILE_COLUMNS}, copy=False)
+
+    def series_index(self, county):
+        start, end = self.index['series'][county]
+        return {key[len('series_'):]: array if key == 'series_YEAR' else array[start:end]
+                for key, array in self.arrays.items() if key.startswith('series_')}
+
+
+
+# ------------ OPENING ------------ #
+# Years whose sources changed are rebuilt before the app can serve them, which
+# on a cold cache means every year. Stale years are built across a process pool
+# (see data_build.PartitionBuild), and with background=True the store opens as
+# soon as FIRST_YEARS are written: the other years are written by a daemon
+# thread, and the store is updated with the catalog after each of them. Years
+# that fail to build are left out and listed in catalog['failed_years'].
+#
+# Preload mode always waits for every year, as the shared dataset and the
+# payloads are built once before the workers fork.
+
+# Years the app needs first: the latest, which the dashboard opens on
+FIRST_YEARS = [years[-1]]
+
+
+# Purpose: Bring the cache up to date and open it, from the shared dataset in preload mode
+def open_data_store(force=False, max_bytes=PARTITION_CACHE_MB * 2 ** 20, preload=PRELOAD, background=False):
+    if preload or not background:
+        catalog = PartitionBuild(force).run()
+        if preload:
+            return SharedDataStore(catalog, max_bytes=max_bytes)
+        return DataStore(catalog, max_bytes=max_bytes)
+
+    build = PartitionBuild(force, first_years=FIRST_YEARS)
+    store = DataStore(build.run(until=FIRST_YEARS), max_bytes=max_bytes)
+    if not build.pending:
+        return store
+    store.loading = list(build.pending)
+
+    def load_rest():
+        try:
+            catalog = build.run(on_catalog=store.update)
+        except Exception as error:
+            # E.g. a worker of the pool died: leave the years that were not written out
+            for year in list(build.pending):
+                build.pending.remove(year)
+                build.fail(year, f'{type(error).__name__}: {error}')
+            catalog = build.run()
+        store.update(catalog)
+
+    threading.Thread(target=load_rest, name='load_years', daemon=True).start()
+    return store
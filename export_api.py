@@ -0,0 +1,286 @@
+# ------------ LIBRARIES ------------ #
+from flask import Response, abort, request
+import pandas as pd
+import numpy as np
+import shapely
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+import argparse
+import functools
+import json
+import os
+
+from data_build import years, read_partition
+from geometry_build import source_paths, source_slug, place_slug
+
+
+# ------------ BULK EXPORT ------------ #
+# Tract rows of a selection of places and years, with or without geometry, as a
+# download:
+#
+#   csv          one row per (year, place, tract)
+#   parquet      the same rows, typed
+#   geojson      one feature per row, with the tract polygon of that year
+#   geoparquet   the same features as Parquet, with WKB geometry and GeoParquet metadata
+#
+# The response is streamed: rows are read one county-year partition at a time,
+# straight from the cache rather than through the store's LRU (so that a large
+# export does not evict what the app is serving), filtered to the selected places
+# and written out before the next partition is read. Geometry is read from the
+# per-place files in assets/{year}/ of the places in the partition, one file at a
+# time. Memory stays bounded by a single partition however large the selection.
+#
+# Parquet needs the pyarrow module; without it only csv and geojson are offered.
+#
+# A tract spanning several places has one row per place, as in the masterfile.
+
+EXPORT_ENABLED = os.environ.get('RENTS_EXPORT', '1') != '0'
+
+EXPORT_COLUMNS = ['YEAR', 'PLACE', 'GEO_ID', 'NAME', 'B25058_001E', 'B25058_001M', 'B25057_001E', 'B25057_001M',
+                  'B25059_001E', 'B25059_001M', 'INTPTLAT', 'INTPTLON']
+
+# Format -> (media type, whether it carries geometry, whether it needs pyarrow)
+FORMATS = {'csv':        ('text/csv', False, False),
+           'parquet':    ('application/vnd.apache.parquet', False, True),
+           'geojson':    ('application/geo+json', True, False),
+           'geoparquet': ('application/vnd.apache.parquet', True, True)
+          }
+
+# File extension of each format
+EXTENSIONS = {'csv': 'csv', 'parquet': 'parquet', 'geojson': 'geojson', 'geoparquet': 'parquet'}
+
+
+# Purpose: Formats that can be exported with the installed modules
+def export_formats():
+    return [name for name, (_, _, arrow) in FORMATS.items() if pyarrow is not None or not arrow]
+
+
+# Purpose: Per-place geometry file of each place slug in a year
+@functools.lru_cache(maxsize=None)
+def source_files(year):
+    return {source_slug(path): path for path in source_paths(year)}
+
+
+# Purpose: GeoJSON geometry of each tract of a place in a year, by GEO_ID
+def place_geometry(place, year):
+    """
+    Geometries are passed through as GeoJSON text rather than parsed into
+    polygons, which GeoJSON exports would only serialize back.
+    """
+    path = source_files(year).get(place_slug(place))
+    if path is None:
+        return dict()
+    with open(path) as file:
+        features = json.load(file)['features']
+    return {int(f['properties']['GEO_ID']): json.dumps(f['geometry']) for f in features}
+
+
+# Purpose: Rows of the selection, one county-year partition at a time
+def selection_chunks(store, places, first_year, last_year):
+    """
+    places is a set of place names, or None for every place. Chunks are
+    DataFrames with EXPORT_COLUMNS and PLACE and NAME as plain strings; empty
+    partitions are skipped.
+    """
+    for year in range(first_year, last_year + 1):
+        for county, entry in sorted(store.catalog['counties'].items()):
+            if year not in entry['years']:
+                continue
+            if places is not None and not any(county in store.catalog['places'][place]['counties']
+                                              and year in store.catalog['places'][place]['years'] for place in places):
+                continue
+            df = read_partition(county, year, store.folder)
+            if places is not None:
+                df = df[df['PLACE'].isin(places)]
+            if len(df):
+                yield df[EXPORT_COLUMNS].astype({'PLACE': object, 'NAME': object}).reset_index(drop=True)
+
+
+# Purpose: GeoJSON geometry of each row of a chunk, None where its place's file lacks the tract
+def chunk_geometry(chunk):
+    geoms = np.full(len(chunk), None, dtype=object)
+    for (place, year), rows in chunk.groupby(['PLACE', 'YEAR'], sort=False).indices.items():
+        polygons = place_geometry(place, int(year))
+        geoms[rows] = [polygons.get(geo_id) for geo_id in chunk['GEO_ID'].to_numpy()[rows]]
+    return geoms
+
+
+
+# ------------ WRITERS ------------ #
+# Each writer turns the chunks of a selection into the pieces of the response
+# body, holding no more than one chunk at a time.
+
+# Purpose: Stream chunks as CSV, with a single header
+def write_csv(chunks):
+    yield ','.join(EXPORT_COLUMNS) + '\n'
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=False)
+
+
+# Purpose: Stream chunks as a GeoJSON feature collection
+def write_geojson(chunks):
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for chunk in chunks:
+        geometry = [geom if geom is not None else 'null' for geom in chunk_geometry(chunk)]
+        # NaN is not valid JSON
+        records = chunk.astype(object).where(chunk.notna(), None).to_dict(orient='records')
+        features = [f'{{"type": "Feature", "properties": {json.dumps(record)}, "geometry": {geom}}}'
+                    for record, geom in zip(records, geometry)]
+        yield separator + ',\n'.join(features)
+        separator = ',\n'
+    yield ']}\n'
+
+
+class ChunkSink:
+    """
+    Write-only file that keeps what is written until take() is called, so a
+    Parquet writer can be streamed out one row group at a time.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Purpose: Arrow schema of the exported rows, plus a WKB geometry column for GeoParquet
+def arrow_schema(geometry):
+    fields = [pyarrow.field('YEAR', pyarrow.int16()),
+              pyarrow.field('PLACE', pyarrow.string()),
+              pyarrow.field('GEO_ID', pyarrow.int64()),
+              pyarrow.field('NAME', pyarrow.string())]
+    fields += [pyarrow.field(col, pyarrow.float32()) for col in EXPORT_COLUMNS[4:10]]
+    fields += [pyarrow.field(col, pyarrow.float64()) for col in ['INTPTLAT', 'INTPTLON']]
+    if not geometry:
+        return pyarrow.schema(fields)
+    # Coordinates are longitude and latitude, the GeoParquet default (OGC:CRS84)
+    geo = {'version': '1.0.0',
+           'primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Polygon', 'MultiPolygon']}}}
+    return pyarrow.schema(fields + [pyarrow.field('geometry', pyarrow.binary())],
+                          metadata={'geo': json.dumps(geo)})
+
+
+# Purpose: Stream chunks as Parquet, one row group per chunk
+def write_parquet(chunks, geometry=False):
+    schema = arrow_schema(geometry)
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+    try:
+        for chunk in chunks:
+            if geometry:
+                chunk = chunk.assign(geometry=shapely.to_wkb(shapely.from_geojson(chunk_geometry(chunk))))
+            writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+# Purpose: Pieces of the body of an export in a given format
+def write_export(chunks, export_format):
+    if export_format == 'csv':
+        return write_csv(chunks)
+    if export_format == 'geojson':
+        return write_geojson(chunks)
+    return write_parquet(chunks, geometry=export_format == 'geoparquet')
+
+
+
+# ------------ ROUTES ------------ #
+
+# Purpose: Parse a selection of places and years, raising ValueError when it is invalid
+def parse_selection(store, places, first_year, last_year):
+    unknown = [place for place in places if place not in store.catalog['places']]
+    if unknown:
+        raise ValueError(f'Unknown places: {", ".join(unknown)}.')
+    if not (years.start <= first_year <= last_year < years.stop):
+        raise ValueError(f'Years must run from {years.start} to {years.stop - 1}, with "from" no later than "to".')
+    return set(places) or None, first_year, last_year
+
+
+# Purpose: Register the bulk export on the Flask server
+def register_export_api(server, store, url_for):
+    """
+    Endpoint (relative to the app's base path):
+
+    GET export/tracts.<format>?place=...&place=...&from=2015&to=2023
+
+    format is one of FORMATS (parquet and geoparquet only with pyarrow). Every
+    place is exported when none is given, and every year when from and to are
+    left out. Returns the export settings for the layout, or None when exports
+    are off.
+    """
+    if not EXPORT_ENABLED:
+        return None
+
+    @server.route('/export/tracts.<export_format>')
+    def export_tracts(export_format):
+        if export_format not in FORMATS:
+            abort(404)
+        if export_format not in export_formats():
+            abort(501, f'{export_format} exports need the pyarrow module.')
+        try:
+            places, first_year, last_year = parse_selection(store, request.args.getlist('place'),
+                                                            request.args.get('from', years.start, type=int),
+                                                            request.args.get('to', years.stop - 1, type=int))
+        except ValueError as error:
+            abort(400, str(error))
+
+        body = write_export(selection_chunks(store, places, first_year, last_year), export_format)
+        filename = f'contract_rents_{first_year}_{last_year}.{EXTENSIONS[export_format]}'
+        return Response(body, mimetype=FORMATS[export_format][0],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+    return {'base': url_for('/export/'), 'formats': export_formats()}
+
+
+
+# ------------ EXECUTE AN EXPORT ------------ #
+if __name__ == '__main__':
+    from data_store import open_data_store
+
+    parser = argparse.ArgumentParser(description='Export the tract rents of a selection of places and years.')
+    parser.add_argument('output', help='file to write')
+    parser.add_argument('--format', choices=list(FORMATS), help='defaults to the extension of the output')
+    parser.add_argument('--place', action='append', default=[], help='place to export, repeatable (default: every place)')
+    parser.add_argument('--from', dest='first_year', type=int, default=years.start)
+    parser.add_argument('--to', dest='last_year', type=int, default=years.stop - 1)
+    args = parser.parse_args()
+
+    export_format = args.format or os.path.splitext(args.output)[1].lstrip('.')
+    if export_format not in export_formats():
+        parser.error(f'cannot write {export_format}; choose one of {", ".join(export_formats())}')
+    store = open_data_store()
+    try:
+        selection = parse_selection(store, args.place, args.first_year, args.last_year)
+    except ValueError as error:
+        parser.error(str(error))
+
+    mode = 'wb' if 'parquet' in export_format else 'w'
+    with open(args.output, mode) as file:
+        for piece in write_export(selection_chunks(store, *selection), export_format):
+            file.write(piece)
@@ -0,0 +1,337 @@
+# ------------ LIBRARIES ------------ #
+import argparse
+import concurrent.futures
+import hashlib
+import importlib
+import json
+import os
+import re
+import shutil
+import urllib.parse
+
+from dash.fingerprint import check_fingerprint
+
+from data_api import (build_dictionaries, partition_payload, county_payload, series_payload, schema_payload, place_key,
+                      PAYLOAD_FORMAT)
+from data_store import DataStore
+from analytics import analytics_payload, ANALYTICS_FORMAT
+from geometry_api import write_geometry
+
+
+# ------------ STATIC EXPORT ------------ #
+# Builds the static site (for GitHub Pages) straight from the app definition,
+# without running a server. The index page, layout and callback dependencies are
+# rendered through Flask's test client with the site's base path set as Dash's
+# requests_pathname_prefix, so every URL the app builds already points at the
+# right place. Files the index page loads are renamed after their content hash
+# and the index is rewritten to match in a single pass; the chunks that the
+# component bundles load by name (async-*.js, plotly.min.js) keep their names.
+#
+# The figures are drawn by the clientside callbacks, so what gets prerendered for
+# each (place, year) and each place's tract time series are the data API payloads
+# the callbacks read. They are built across a process pool, and only when the
+# cache partitions they come from changed since the previous export, as recorded
+# in the folder's manifest.
+
+DEFAULT_BASE_PATH = '/Contract-Rents-in-LA-County/'
+
+# Bump whenever the layout of the export changes, so that the next one starts over
+EXPORT_FORMAT = 1
+
+MANIFEST_NAME = '.export.json'
+
+# Length of the content hashes in fingerprinted file names
+HASH_LENGTH = 12
+
+# Endpoints the renderer fetches and the static files holding them, as static hosts
+# pick the content type from the extension
+ENDPOINTS = {'_dash-layout': '_dash-layout.json',
+             '_dash-dependencies': '_dash-dependencies.json'
+            }
+
+COMPONENT_SUITES = '_dash-component-suites/'
+
+# Path of the place analytics among the data payloads, which are built from every partition at once
+ANALYTICS_PAYLOAD = 'analytics/places.json'
+
+
+# Purpose: Content hash of some bytes
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+
+
+# Purpose: Insert the content hash of a file before its extension
+def fingerprinted(path, data):
+    stem, extension = os.path.splitext(path)
+    return f'{stem}.{content_hash(data)}{extension}'
+
+
+# Purpose: Build a function replacing every key of a table found in a text, in a single pass
+def rewriter(table):
+    if not table:
+        return lambda text: text
+    pattern = re.compile('|'.join(re.escape(old) for old in sorted(table, key=len, reverse=True)))
+    return lambda text: pattern.sub(lambda match: table[match.group(0)], text)
+
+
+# Purpose: Write a file unless it already holds the same bytes
+def write_file(path, data):
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as file:
+            if file.read() == data:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+
+# ------------ SITE ------------ #
+
+# Purpose: Import app.py with the site's base path as its requests prefix
+def load_app(base_path):
+    os.environ['DASH_REQUESTS_PATHNAME_PREFIX'] = base_path
+    # A static site has no server to report metrics to
+    os.environ['RENTS_METRICS'] = '0'
+    # ... nor to stream exports from
+    os.environ['RENTS_EXPORT'] = '0'
+    app_module = importlib.import_module('app')
+    if app_module.app.config.requests_pathname_prefix != base_path:
+        raise ValueError(f'app.py was already imported with the base path '
+                         f'{app_module.app.config.requests_pathname_prefix}')
+    return app_module
+
+
+# Purpose: Render the index page and every file it loads, keyed by their path in the site
+def site_files(app):
+    prefix = app.config.requests_pathname_prefix
+    client = app.server.test_client()
+
+    def get(url):
+        response = client.get(app.config.routes_pathname_prefix + url[len(prefix):])
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.status_code} while rendering {url}')
+        return response.get_data()
+
+    index = get(prefix).decode()
+    files = {path: get(prefix + endpoint) for endpoint, path in ENDPOINTS.items()}
+    rewrite_bundle = rewriter({f'"{endpoint}"': f'"{path}"' for endpoint, path in ENDPOINTS.items()})
+
+    # Files referenced by the index page get fingerprinted names
+    index_table = dict()
+    referenced = set()
+    for reference in set(re.findall(r'(?:src|href)="([^"]+)"', index)):
+        url = urllib.parse.urlsplit(urllib.parse.urljoin(prefix, reference))
+        if url.netloc or not url.path.startswith(prefix):
+            continue
+        path = url.path[len(prefix):]
+        if path.startswith(COMPONENT_SUITES):
+            namespace, _, package_path = path[len(COMPONENT_SUITES):].partition('/')
+            package_path, _ = check_fingerprint(package_path)
+            referenced.add((namespace, package_path))
+            path = f'{COMPONENT_SUITES}{namespace}/{package_path}'
+        data = get(urllib.parse.urlunsplit(url))
+        if path.endswith('.js'):
+            data = rewrite_bundle(data.decode()).encode()
+        path = fingerprinted(path, data)
+        files[path] = data
+        index_table[f'"{reference}"'] = f'"{prefix}{path}"'
+
+    # Chunks loaded by the bundles themselves, next to the bundle that loads them
+    for namespace, package_paths in app.registered_paths.items():
+        for package_path in package_paths:
+            if (namespace, package_path) not in referenced and not package_path.endswith('.map'):
+                path = f'{COMPONENT_SUITES}{namespace}/{package_path}'
+                files[path] = get(prefix + path)
+
+    files['index.html'] = rewriter(index_table)(index).encode()
+    # GitHub Pages would otherwise skip every path starting with an underscore
+    files['.nojekyll'] = b''
+    return files
+
+
+
+# ------------ PAYLOADS ------------ #
+
+# Data store and dictionaries of each worker process
+worker = dict()
+
+
+# Purpose: Open the data store of a worker process
+def start_worker(catalog):
+    worker['store'] = DataStore(catalog)
+    worker['dictionaries'] = build_dictionaries(catalog['values'])
+
+
+# Purpose: Build and write the payloads of one place or county in a worker process
+def write_place_payloads(place, paths, base):
+    store, dictionaries = worker['store'], worker['dictionaries']
+    for path in paths:
+        if path.startswith('series/'):
+            payload = series_payload(store, dictionaries, place)
+        elif path.startswith('counties/'):
+            payload = county_payload(store, dictionaries, place, int(path.split('/')[1]))
+        else:
+            payload = partition_payload(store, dictionaries, place, int(path.split('/')[1]))
+        write_file(base + path, payload['raw'])
+    return len(paths)
+
+
+# Purpose: Key of the cache partitions and settings each payload is built from
+def payload_keys(catalog):
+    """
+    A payload is rebuilt when its key differs from the previous export's: the
+    partitions of a place in a year and its viewport for its (place, year)
+    payload, every partition and series index of its counties for its series
+    (the series indexes change with the crosswalk too), a county's partition
+    and viewport for its (county, year) payload, every partition and the
+    metrics format for the place analytics, and the payload format and
+    dictionaries for all of them.
+    """
+    shared = hashlib.sha1(json.dumps([PAYLOAD_FORMAT, catalog['values']]).encode()).hexdigest()
+
+    def key(partitions, viewport=None, counties=()):
+        digest = hashlib.sha1(shared.encode())
+        for partition in partitions:
+            digest.update(catalog['partitions'][partition]['sha256'].encode())
+        if viewport is not None:
+            digest.update(json.dumps(viewport, sort_keys=True).encode())
+        for county in counties:
+            digest.update(catalog['counties'][county]['series_sha256'].encode())
+        return digest.hexdigest()
+
+    keys = {'schema.json': key([]), ANALYTICS_PAYLOAD: key(sorted(catalog['partitions']), {'format': ANALYTICS_FORMAT})}
+    for place, entry in catalog['places'].items():
+        county_partitions = [partition for partition in sorted(catalog['partitions'])
+                             if partition.split('/')[0] in entry['counties']]
+        for year in entry['years']:
+            keys[f'places/{year}/{place_key(place)}.json'] = key([partition for partition in county_partitions
+                                                                   if partition.endswith(f'/{year}')],
+                                                                  entry['viewports'][str(year)])
+        keys[f'series/{place_key(place)}.json'] = key(county_partitions, counties=sorted(entry['counties']))
+    for county, entry in catalog['counties'].items():
+        for year in entry['years']:
+            keys[f'counties/{year}/{county}.json'] = key([f'{county}/{year}'], entry['viewports'][str(year)])
+    return keys
+
+
+# Purpose: Write the data API payloads whose inputs changed, across a process pool
+def write_payloads(catalog, version, folder, previous, workers=None):
+    """
+    Payloads that did not change are moved over from the previous export's data
+    version folder rather than rebuilt. Returns the keys of every payload and the
+    number built.
+    """
+    base = f'{folder}/data/{version}/'
+    previous_base = f"{folder}/data/{previous.get('data_version')}/"
+    previous_keys = previous.get('payloads', dict())
+    keys = payload_keys(catalog)
+
+    stale = dict()
+    for path, key in keys.items():
+        if previous_keys.get(path) == key and os.path.exists(previous_base + path):
+            if previous_base != base:
+                os.makedirs(os.path.dirname(base + path), exist_ok=True)
+                os.replace(previous_base + path, base + path)
+        elif path not in ('schema.json', ANALYTICS_PAYLOAD):
+            place = path.split('/')[-1][:-len('.json')]
+            stale.setdefault(place, []).append(path)
+
+    if previous_keys.get('schema.json') != keys['schema.json'] or not os.path.exists(base + 'schema.json'):
+        write_file(base + 'schema.json', schema_payload(build_dictionaries(catalog['values']))['raw'])
+    if previous_keys.get(ANALYTICS_PAYLOAD) != keys[ANALYTICS_PAYLOAD] or not os.path.exists(base + ANALYTICS_PAYLOAD):
+        write_file(base + ANALYTICS_PAYLOAD, analytics_payload(DataStore(catalog))['raw'])
+
+    places = {place_key(place): place for place in catalog['places']}
+    places.update((county, county) for county in catalog['counties'])
+    built = 0
+    if stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                                                    initargs=(catalog,)) as executor:
+            futures = [executor.submit(write_place_payloads, places[place], paths, base)
+                       for place, paths in stale.items()]
+            for future in concurrent.futures.as_completed(futures):
+                built += future.result()
+
+    # Payloads of places or years that no longer exist
+    if previous_base == base:
+        for path in set(previous_keys) - set(keys):
+            if os.path.exists(base + path):
+                os.remove(base + path)
+    elif os.path.isdir(previous_base):
+        shutil.rmtree(previous_base)
+
+    return keys, built
+
+
+
+# ------------ MANIFEST ------------ #
+
+# Purpose: Read the manifest of the previous export to a folder
+def read_manifest(folder):
+    try:
+        with open(f'{folder}/{MANIFEST_NAME}') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+    if manifest.get('format') != EXPORT_FORMAT:
+        return dict()
+    return manifest
+
+
+# Purpose: Record what an export wrote, for the next one
+def write_manifest(folder, manifest):
+    with open(f'{folder}/{MANIFEST_NAME}', 'w') as file:
+        json.dump(manifest, file, indent=1)
+
+
+
+# ------------ EXPORT ------------ #
+
+# Purpose: Export the static site to a folder, rebuilding only what changed since the previous export
+def export_site(folder, base_path=DEFAULT_BASE_PATH, force=False, workers=None):
+    previous = read_manifest(folder)
+    if force:
+        previous['payloads'] = dict()
+    app_module = load_app(base_path)
+    store = app_module.store
+
+    files = site_files(app_module.app)
+    for path, data in files.items():
+        write_file(f'{folder}/{path}', data)
+    files = sorted(files) + write_geometry(folder)
+
+    # Files of the previous export that this one no longer has, like old fingerprinted bundles
+    for path in set(previous.get('files', [])) - set(files):
+        if os.path.exists(f'{folder}/{path}'):
+            os.remove(f'{folder}/{path}')
+            # Along with the folders this leaves empty, like those of an older geometry version
+            try:
+                os.removedirs(os.path.dirname(f'{folder}/{path}'))
+            except OSError:
+                pass
+
+    keys, built = write_payloads(store.catalog, app_module.data_version, folder, previous, workers)
+    write_manifest(folder, {'format': EXPORT_FORMAT,
+                            'base_path': base_path,
+                            'data_version': app_module.data_version,
+                            'files': files,
+                            'payloads': keys
+                           })
+    return {'files': len(files), 'payloads': len(keys), 'built': built}
+
+
+
+# ------------ EXECUTE THE EXPORT ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the app as a static site.')
+    parser.add_argument('folder', help='root folder of the static site')
+    parser.add_argument('--base-path', default=DEFAULT_BASE_PATH, help='path the site is served from')
+    parser.add_argument('--workers', type=int, default=None, help='size of the process pool')
+    parser.add_argument('--force', action='store_true', help='rebuild every payload, ignoring the previous export')
+    args = parser.parse_args()
+
+    base_path = '/' + args.base_path.strip('/') + '/' if args.base_path.strip('/') else '/'
+    summary = export_site(args.folder, base_path, force=args.force, workers=args.workers)
+    print(f"Exported {summary['files']} files and {summary['payloads']} payloads "
+          f"({summary['built']} built) to {args.folder}")
@@ -0,0 +1,189 @@
+# ------------ LIBRARIES ------------ #
+from flask import abort, request, send_file
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+
+from geometry_build import geometry_path, years, source_paths, source_slug, place_slug, store_path, refs_path, DEFAULT_LEVEL
+from tile_build import tiles_path, tile_path, read_metadata
+
+
+# ------------ FILES ------------ #
+# Geometries are served by the app itself rather than fetched from GitHub. Built
+# files come with precompressed .br/.gz variants (see geometry_build.py); the
+# right one is picked per request and sent with a strong ETag, Range support and
+# an immutable Cache-Control. Every path carries the geometry version, a hash of
+# the path, size and modification time of every file served, so rebuilding the
+# geometries or tiles moves them to new URLs instead of leaving browsers and CDNs
+# with the old ones.
+
+CACHE_MAX_AGE = 31536000
+
+# Encodings in order of preference, with the suffix of their precompressed variant
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# (path, size, mtime) -> content hash, so each file is hashed once per process
+file_hashes = dict()
+
+
+# Purpose: Content hash of a file, memoized on its size and mtime
+def file_hash(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        file_hashes[key] = digest.hexdigest()[:32]
+    return file_hashes[key]
+
+
+# Purpose: Map (year, place slug) to the source GeoJSON in assets/{year}/
+def source_index():
+    return {(year, source_slug(path)): path for year in years for path in source_paths(year)}
+
+
+# Purpose: Whether geometry_build.py has built the store the map loads
+def store_built():
+    return os.path.isdir(f'{geometry_path}store/{DEFAULT_LEVEL}')
+
+
+# Purpose: Every geometry file the map loads, mapped to its path under the geometry base
+def geometry_files():
+    if store_built():
+        files = glob.glob(f'{geometry_path}store/{DEFAULT_LEVEL}/*/*.json') + glob.glob(f'{geometry_path}refs/*/*.json')
+        paths = {path: path[len(geometry_path):] for path in files}
+    else:
+        paths = {source: f'source/{year}/{slug}.json' for (year, slug), source in source_index().items()}
+    paths.update((path, path[len(geometry_path):]) for path in glob.glob(f'{tiles_path}*/*/*/*.pbf'))
+    return paths
+
+
+# Purpose: Geometry version, from the path, size and modification time of every file served
+def geometry_version(paths):
+    """
+    Stats are enough: every build rewrites the files it changes, along with
+    their precompressed variants, and hashing the contents of every file would
+    slow down startup.
+    """
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f'{path}/{stat.st_size}/{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()[:12]
+
+
+
+# ------------ ROUTES ------------ #
+
+# Purpose: Send a geometry file in the best precompressed encoding the client accepts
+def geometry_response(path, mimetype='application/json'):
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if name in request.accept_encodings and os.path.exists(path + suffix):
+            encoding, path = name, path + suffix
+            break
+
+    # Strong ETags must differ between encodings of the same file
+    etag = file_hash(path) if encoding is None else f'{file_hash(path)}-{encoding}'
+    response = send_file(os.path.abspath(path), mimetype=mimetype, etag=etag, conditional=True,
+                         max_age=CACHE_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Purpose: Describe the vector tiles for the client, or None if tile_build.py has not been run
+def tiles_description():
+    metadata = read_metadata()
+    if metadata is None:
+        return None
+    return {'layer': metadata['layer'], 'minzoom': metadata['minzoom'], 'maxzoom': metadata['maxzoom'],
+            'vintages': {vintage: entry['bounds'] for vintage, entry in metadata['vintages'].items()}}
+
+
+# Purpose: Serve the tract geometries and describe them for the client
+def register_geometry_api(server, get_relative_path):
+    """
+    Endpoints (relative to the app's base path):
+
+    geometry/<version>/store/<level>/<vintage>/<place>.json   every distinct tract polygon of a place in a vintage
+    geometry/<version>/refs/<year>/<place>.json               GEO_ID -> store key for the tracts of a year
+    geometry/<version>/source/<year>/<place>.json             the unbuilt source GeoJSON
+    geometry/<version>/tiles/<vintage>/<z>/<x>/<y>.pbf        vector tile of every tract of the county in a vintage
+
+    The map loads the DEFAULT_LEVEL store when geometry_build.py has been run, and
+    the source files in assets/{year}/ otherwise. The county-wide map is offered
+    only when tile_build.py has been run. Requests for another geometry version
+    get a 404.
+    """
+    sources = source_index()
+    version = geometry_version(geometry_files())
+
+    def existing(version_id, path, mimetype='application/json'):
+        if version_id != version or not os.path.exists(path):
+            abort(404)
+        return geometry_response(path, mimetype)
+
+    @server.route('/geometry/<version_id>/store/<level>/<int:vintage>/<path:place>.json')
+    def geometry_store(version_id, level, vintage, place):
+        return existing(version_id, store_path(level, vintage, place_slug(place)))
+
+    @server.route('/geometry/<version_id>/refs/<int:year>/<path:place>.json')
+    def geometry_refs(version_id, year, place):
+        return existing(version_id, refs_path(year, place_slug(place)))
+
+    @server.route('/geometry/<version_id>/source/<int:year>/<path:place>.json')
+    def geometry_source(version_id, year, place):
+        path = sources.get((year, place_slug(place)))
+        if version_id != version or path is None:
+            abort(404)
+        return geometry_response(path)
+
+    @server.route('/geometry/<version_id>/tiles/<int:vintage>/<int:z>/<int:x>/<int:y>.pbf')
+    def geometry_tile(version_id, vintage, z, x, y):
+        return existing(version_id, tile_path(vintage, z, x, y), 'application/x-protobuf')
+
+    return {'base': get_relative_path(f'/geometry/{version}/'), 'level': DEFAULT_LEVEL, 'store': store_built(),
+            'tiles': tiles_description()}
+
+
+
+# ------------ STATIC EXPORT ------------ #
+
+# Purpose: Whether a copy of a file is already up to date
+def same_file(path, destination):
+    if not os.path.exists(destination):
+        return False
+    source, copy = os.stat(path), os.stat(destination)
+    return source.st_size == copy.st_size and source.st_mtime_ns == copy.st_mtime_ns
+
+
+# Purpose: Copy the geometries the map loads into a static site, mirroring the endpoint paths
+def write_geometry(folder):
+    """
+    Files already copied by an earlier run are left alone unless their source
+    changed. Returns the paths of the copies, relative to the folder.
+    """
+    files = geometry_files()
+    version = geometry_version(files)
+    paths = {path: f'geometry/{version}/{destination}' for path, destination in files.items()}
+    for path, destination in paths.items():
+        destination = f'{folder}/{destination}'
+        if not same_file(path, destination):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(path, destination)
+    return list(paths.values())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy the map geometries into a static site.')
+    parser.add_argument('folder', help='root folder of the static site')
+    args = parser.parse_args()
+
+    write_geometry(args.folder)
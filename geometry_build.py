@@ -0,0 +1,364 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import shapely
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import argparse
+import concurrent.futures
+import glob
+import gzip
+import hashlib
+import json
+import os
+import unicodedata
+
+
+# ------------ PATHS ------------ #
+assets_path = "assets/"
+
+geometry_path = "geometry/"
+
+
+# Purpose: Years of the per-place geometries written by ingest.py into assets/{year}/
+def geometry_years():
+    found = [int(os.path.basename(os.path.dirname(path))) for path in glob.glob(f'{assets_path}{"[0-9]" * 4}/')]
+    if not found:
+        return range(2010, 2024)
+    return range(min(found), max(found) + 1)
+
+
+years = geometry_years()
+
+
+# ------------ VINTAGES ------------ #
+# Tract boundaries follow the decennial census: 2010 to 2019 use the 2010 tracts
+# and 2020 onwards the 2020 tracts. Each entry is the first data year of a
+# vintage, which holds until the next entry.
+VINTAGES = [2010, 2020]
+
+
+# Purpose: Decennial tract vintage of a data year
+def vintage_of(year):
+    return max(vintage for vintage in VINTAGES if vintage <= year)
+
+
+# ------------ RESOLUTION LEVELS ------------ #
+# Each level is simplified with the given tolerance and then snapped to a grid of
+# the given size (both in degrees; 0.00001 degrees is roughly one meter). The map
+# loads DEFAULT_LEVEL; 'low' suits county-wide zooms and 'high' close-ups of a
+# handful of tracts. 'full' is not simplified, and its grid matches the six
+# decimals of the source files.
+RESOLUTION_LEVELS = {'full':   {'tolerance': 0,       'grid': 0.000001},
+                     'high':   {'tolerance': 0.00002, 'grid': 0.000001},
+                     'medium': {'tolerance': 0.0001,  'grid': 0.00001},
+                     'low':    {'tolerance': 0.0005,  'grid': 0.00005}
+                    }
+
+DEFAULT_LEVEL = 'medium'
+
+# Rough length of a degree, used to report errors in meters
+METERS_PER_DEGREE = 111320
+
+
+
+# ------------ SOURCE FILES ------------ #
+
+# Purpose: File-name form of a place, e.g. 'La Cañada Flintridge' -> 'LaCañadaFlintridge'
+def place_slug(place):
+    return unicodedata.normalize('NFC', place).replace(' ', '')
+
+
+# Purpose: Per-place geometry files for a given year
+def source_paths(year):
+    return sorted(glob.glob(f'{assets_path}{year}/contract_rent_mastergeometry_{year}_*.json'))
+
+
+# Purpose: Place slug of a per-place geometry file
+def source_slug(path):
+    """
+    File names in assets/ may spell accents in decomposed form; the slug is NFC
+    like the place names in the masterfile.
+    """
+    prefix_length = len('contract_rent_mastergeometry_YYYY_')
+    return place_slug(os.path.basename(path)[prefix_length:-len('.json')])
+
+
+# Purpose: Read the tract GEO_IDs and polygons of a per-place geometry file
+def read_source(path):
+    with open(path) as file:
+        collection = json.load(file)
+    features = collection['features']
+    geo_ids = [f['properties']['GEO_ID'] for f in features]
+    geoms = np.array([shapely.geometry.shape(f['geometry']) for f in features], dtype=object)
+    return geo_ids, geoms
+
+
+# Purpose: Path of a place's file in the geometry store
+def store_path(level, vintage, slug):
+    return f'{geometry_path}store/{level}/{vintage}/{slug}.json'
+
+
+# Purpose: Path of the file mapping a place's tracts in a year to store keys
+def refs_path(year, slug):
+    return f'{geometry_path}refs/{year}/{slug}.json'
+
+
+# Purpose: Write a built file together with its precompressed variants
+def write_output(destination, data):
+    """
+    The .gz (and, when the brotli module is installed, .br) variants are served as
+    is by geometry_api.py, so nothing is compressed per request. Each file is
+    written aside and moved into place, so a running server never reads half of one.
+    """
+    variants = {'': data, '.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    for suffix, content in variants.items():
+        tmp_path = f'{destination}.{os.getpid()}.tmp{suffix}'
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, destination + suffix)
+    return variants['.gz']
+
+
+
+# ------------ CONTENT ADDRESSING ------------ #
+# Every tract polygon is keyed by a hash of its GEO_ID and its normalized shape, so
+# a tract whose boundary is unchanged from one year to the next keeps its key and
+# is stored once per vintage. Normalizing first makes the key independent of ring
+# orientation and starting vertex, which vary between TIGER releases.
+
+# Purpose: Content keys of a set of tract polygons
+def geometry_keys(geo_ids, geoms):
+    wkbs = shapely.to_wkb(shapely.normalize(geoms))
+    return [hashlib.sha1(str(geo_id).encode() + wkb).hexdigest()[:12] for geo_id, wkb in zip(geo_ids, wkbs)]
+
+
+
+# ------------ SIMPLIFICATION ------------ #
+
+# Purpose: Simplify a place's tracts without opening gaps or overlaps between neighbors
+def simplify_tracts(geoms, tolerance):
+    """
+    Tracts in a place form a coverage, so shared edges are simplified once with
+    shapely.coverage_simplify (GEOS >= 3.12) and stay shared. Older GEOS builds fall
+    back to simplifying each polygon on its own, which preserves the topology of
+    each tract but not of the boundaries between them.
+    """
+    if tolerance == 0:
+        return geoms
+    if hasattr(shapely, 'coverage_simplify'):
+        return shapely.coverage_simplify(geoms, tolerance)
+    return shapely.simplify(geoms, tolerance, preserve_topology=True)
+
+
+# Purpose: Snap coordinates to a grid, keeping any tract the grid would collapse
+def quantize_tracts(geoms, grid):
+    snapped = shapely.set_precision(geoms, grid)
+    collapsed = shapely.is_empty(snapped)
+    snapped[collapsed] = geoms[collapsed]
+    return snapped
+
+
+
+# ------------ ENCODING ------------ #
+# Store files are delta-encoded quantized GeoJSON, decoded on the client by
+# assets/geometry.js:
+#
+#   {"type": "QuantizedFeatureCollection",
+#    "idkey": "KEY",
+#    "transform": {"scale": grid, "translate": [x0, y0]},
+#    "features": [{"id": ..., "type": "Polygon" | "MultiPolygon", "rings": ...}]}
+#
+# Every ring is a flat list [x, y, dx, dy, dx, dy, ...] of integer grid steps, the
+# first pair relative to the translate and the rest relative to the previous
+# vertex. The closing vertex is dropped and restored by the decoder, which also
+# puts each feature's id in properties[idkey].
+
+# Purpose: Delta-encode one ring as a flat list of integers
+def encode_ring(ring, translate, grid):
+    steps = np.rint((np.asarray(ring.coords)[:-1] - translate) / grid).astype(np.int64)
+    steps[1:] = np.diff(steps, axis=0)
+    return steps.ravel().tolist()
+
+
+# Purpose: Delta-encode the rings of a polygon
+def encode_polygon(polygon, translate, grid):
+    return [encode_ring(ring, translate, grid) for ring in [polygon.exterior, *polygon.interiors]]
+
+
+# Purpose: Encode tract polygons as a quantized feature collection
+def encode_tracts(ids, geoms, grid, idkey='KEY'):
+    # The bounds of no geometries are NaN, which JSON cannot hold
+    if len(geoms) == 0:
+        translate = np.zeros(2)
+    else:
+        translate = np.floor(shapely.total_bounds(geoms)[:2] / grid) * grid
+
+    features = []
+    for id_, geom in zip(ids, geoms):
+        if geom.geom_type == 'Polygon':
+            rings = encode_polygon(geom, translate, grid)
+        else:
+            rings = [encode_polygon(part, translate, grid) for part in geom.geoms]
+        features.append({'id': id_, 'type': geom.geom_type, 'rings': rings})
+
+    return {'type': 'QuantizedFeatureCollection',
+            'idkey': idkey,
+            'transform': {'scale': grid, 'translate': translate.tolist()},
+            'features': features
+           }
+
+
+# Purpose: Decode a quantized feature collection back into ids and polygons
+def decode_tracts(collection):
+    scale = collection['transform']['scale']
+    translate = np.array(collection['transform']['translate'])
+
+    def ring(steps):
+        coords = np.cumsum(np.reshape(steps, (-1, 2)), axis=0) * scale + translate
+        return np.vstack([coords, coords[:1]])
+
+    def polygon(rings):
+        return shapely.Polygon(ring(rings[0]), [ring(steps) for steps in rings[1:]])
+
+    ids, geoms = [], []
+    for feature in collection['features']:
+        ids.append(feature['id'])
+        if feature['type'] == 'Polygon':
+            geoms.append(polygon(feature['rings']))
+        else:
+            geoms.append(shapely.MultiPolygon([polygon(rings) for rings in feature['rings']]))
+    return ids, np.array(geoms, dtype=object)
+
+
+
+# ------------ BUILD ------------ #
+
+# Purpose: Build the store and the year references of one place in one vintage
+def build_place(vintage, slug, paths, levels, force=False):
+    """
+    paths maps each data year of the vintage to the place's source file. Each year
+    gets a small {GEO_ID: key} reference file, and each level a store holding every
+    distinct polygon once. A polygon is simplified within the coverage of the first
+    year that draws it.
+    """
+    newest_source = max(os.path.getmtime(path) for path in paths.values())
+    def up_to_date(path):
+        return os.path.exists(path) and os.path.getmtime(path) >= newest_source
+    if not force and all(up_to_date(store_path(level, vintage, slug) + '.gz') for level in levels):
+        return []
+
+    sources = {year: read_source(path) for year, path in sorted(paths.items())}
+    keys = {year: geometry_keys(geo_ids, geoms) for year, (geo_ids, geoms) in sources.items()}
+
+    for year, (geo_ids, geoms) in sources.items():
+        refs = {'vintage': vintage, 'keys': dict(zip(map(str, geo_ids), keys[year]))}
+        write_output(refs_path(year, slug), json.dumps(refs, separators=(',', ':')).encode())
+
+    source_size = sum(os.path.getsize(path) for path in paths.values())
+    features = sum(len(year_keys) for year_keys in keys.values())
+
+    report = []
+    for level in levels:
+        settings = RESOLUTION_LEVELS[level]
+        store = dict()
+        error = 0.0
+        for year, (geo_ids, geoms) in sources.items():
+            new = np.array([key not in store for key in keys[year]])
+            if not new.any():
+                continue
+            simplified = quantize_tracts(simplify_tracts(geoms, settings['tolerance']), settings['grid'])
+            error = max(error, float(np.max(shapely.hausdorff_distance(geoms[new], simplified[new]))))
+            store.update((key, geom) for key, geom, is_new in zip(keys[year], simplified, new) if is_new)
+
+        collection = encode_tracts(list(store), np.array(list(store.values()), dtype=object), settings['grid'])
+        data = json.dumps(collection, separators=(',', ':'), allow_nan=False).encode()
+        compressed = write_output(store_path(level, vintage, slug), data)
+        report.append({'level': level, 'vintage': vintage, 'place': slug,
+                       'years': len(paths), 'features': features, 'polygons': len(store),
+                       'source_bytes': source_size, 'bytes': len(data), 'gzip_bytes': len(compressed),
+                       'max_hausdorff_degrees': error,
+                       'max_hausdorff_meters': error * METERS_PER_DEGREE
+                      })
+    return report
+
+
+# Purpose: Summarize the deduplication, size reduction and worst-case error of each level
+def summarize(report):
+    summary = dict()
+    for level in RESOLUTION_LEVELS:
+        rows = [row for row in report if row['level'] == level]
+        if not rows:
+            continue
+        source = sum(row['source_bytes'] for row in rows)
+        built = sum(row['bytes'] for row in rows)
+        features = sum(row['features'] for row in rows)
+        polygons = sum(row['polygons'] for row in rows)
+        worst = max(rows, key=lambda row: row['max_hausdorff_degrees'])
+        summary[level] = {'files': len(rows),
+                          'features': features, 'polygons': polygons, 'deduplication': 1 - polygons / features,
+                          'source_bytes': source, 'bytes': built, 'reduction': 1 - built / source,
+                          'gzip_bytes': sum(row['gzip_bytes'] for row in rows),
+                          'max_hausdorff_meters': worst['max_hausdorff_meters'],
+                          'worst_file': f"{worst['vintage']} {worst['place']}"
+                         }
+    return summary
+
+
+# Purpose: Entries of the report of the previous builds, by level, vintage and place
+def read_report():
+    try:
+        with open(f'{geometry_path}report.json') as file:
+            rows = json.load(file)['files']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return dict()
+    return {(row['level'], row['vintage'], row['place']): row for row in rows}
+
+
+# Purpose: Build the store for the vintages covering the given years across a process pool
+def build_geometry(build_years=years, levels=tuple(RESOLUTION_LEVELS), force=False, workers=None):
+    vintages = {vintage_of(year) for year in build_years}
+    groups = dict()
+    for year in years:
+        if vintage_of(year) in vintages:
+            for path in source_paths(year):
+                groups.setdefault((vintage_of(year), source_slug(path)), dict())[year] = path
+
+    # Places that were up to date keep their entries from the build that wrote them
+    report = read_report()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_place, vintage, slug, paths, list(levels), force)
+                   for (vintage, slug), paths in groups.items()]
+        for future in concurrent.futures.as_completed(futures):
+            report.update(((row['level'], row['vintage'], row['place']), row) for row in future.result())
+    report = [row for key, row in sorted(report.items()) if os.path.exists(store_path(*key))]
+
+    summary = summarize(report)
+    os.makedirs(geometry_path, exist_ok=True)
+    with open(f'{geometry_path}report.json', 'w') as file:
+        json.dump({'summary': summary, 'files': report}, file, indent=1)
+    return summary
+
+
+
+# ------------ EXECUTE THE BUILD ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the deduplicated, simplified tract geometry store for the map.')
+    parser.add_argument('--years', type=int, nargs='+', default=list(years),
+                        help='rebuild the vintages covering these years')
+    parser.add_argument('--levels', nargs='+', choices=list(RESOLUTION_LEVELS), default=list(RESOLUTION_LEVELS))
+    parser.add_argument('--workers', type=int, default=None, help='size of the process pool')
+    parser.add_argument('--force', action='store_true', help='rebuild places that are already up to date')
+    args = parser.parse_args()
+
+    summary = build_geometry(args.years, args.levels, force=args.force, workers=args.workers)
+    for level, row in summary.items():
+        print(f"{level:>6}: {row['features']} tract-years stored as {row['polygons']} polygons "
+              f"({row['deduplication']:.0%} deduplicated), {row['source_bytes'] / 1e6:.1f} MB -> "
+              f"{row['bytes'] / 1e6:.1f} MB ({row['gzip_bytes'] / 1e6:.1f} MB gzipped), "
+              f"max Hausdorff error {row['max_hausdorff_meters']:.1f} m ({row['worst_file']})")
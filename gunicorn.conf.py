@@ -0,0 +1,40 @@
+# ------------ GUNICORN ------------ #
+# Serves app.py with many workers sharing one copy of the data:
+#
+#   gunicorn -c gunicorn.conf.py app:server
+#
+# The app is imported once, in the master process, in preload mode (see
+# data_store.py): partitions and series indexes are mapped read-only from the
+# shared dataset, and the layout and every data API payload are built before
+# the workers fork, so workers share them instead of building their own and
+# start without loading anything.
+import gc
+import multiprocessing
+import os
+import tempfile
+
+os.environ.setdefault('RENTS_PRELOAD', '1')
+
+# Every worker writes its request metrics here, and /metrics adds them up (see metrics.py)
+os.environ.setdefault('RENTS_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'rents-metrics'))
+
+bind = os.environ.get('RENTS_BIND', '0.0.0.0:8050')
+
+workers = int(os.environ.get('RENTS_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+preload_app = True
+
+# A sync worker is restarted when a request outlasts this, and exports of the
+# whole county with geometry stream for several seconds
+timeout = int(os.environ.get('RENTS_TIMEOUT', 120))
+
+
+# Purpose: Keep the garbage collector from touching, and so copying, the objects built before the fork
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+# Purpose: Start the metrics of every worker from zero
+def on_starting(server):
+    import metrics
+    metrics.clear_snapshots()
@@ -0,0 +1,277 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import re
+from functools import reduce
+
+from data_build import (assets_path, masterfile_path, file_fingerprint, write_atomic, write_json,
+                        read_ingest_manifest, ingest_manifest_path)
+from geometry_build import place_slug
+
+
+# ------------ PATHS ------------ #
+censusdata_path = "censusdata/"
+
+places_path = f'{assets_path}LosAngelesCounty_2020_FIPS.csv'
+
+
+# ------------ RAW INPUTS ------------ #
+# The pipeline reads raw files kept on disk rather than calling the Census APIs:
+#
+#   censusdata/acs/{year}/{ACS_ID}_{PLACE_FIPS}.json   ACS 5-year table of the tracts in a place, as returned by
+#                                                      api.census.gov/data/{year}/acs/acs5?get=group({ACS_ID})
+#                                                      &ucgid=pseudo(1600000US{PLACE_FIPS}$1400000)
+#   censusdata/tiger/tl_{year}_{STATEFP}_tract.*       TIGER/Line tract shapefile of the state (.shp with its
+#                                                      sidecar files, or the .zip as downloaded); decennial
+#                                                      releases are named tl_2010_{STATEFP}_tract10.* and so on
+#   assets/LosAngelesCounty_2020_FIPS.csv              the places to ingest, with their FIPS codes
+#
+# and writes, for each year, masterfiles/contract_rent_masterfile_{year}.csv and
+# assets/{year}/contract_rent_mastergeometry_{year}_{place}.json.
+#
+# A year is ingested again only when one of its raw files changed, so a newly
+# released ACS year is the only one processed. The manifest records the inputs
+# and the fingerprints of the outputs of every year; data_build.py checks the
+# masterfiles against it before building its cache from them. data_build.py and
+# geometry_build.py take the range of years from these outputs, so a new year
+# needs no change elsewhere.
+
+ACS_TABLES = ['B25057', 'B25058', 'B25059']
+
+MASTERFILE_CSV_COLUMNS = ['YEAR', 'FIPS', 'PLACE', 'GEO_ID', 'NAME',
+                          'B25057_001E', 'B25057_001M', 'B25058_001E', 'B25058_001M', 'B25059_001E', 'B25059_001M']
+
+GEOMETRY_COLUMNS = ['YEAR', 'FIPS', 'PLACE', 'GEO_ID', 'NAME', 'INTPTLAT', 'INTPTLON', 'geometry']
+
+# Columns shared by the tables of a place, on which they are joined
+KEY_COLUMNS = ['YEAR', 'FIPS', 'PLACE', 'GEO_ID', 'NAME']
+
+# Values the ACS reports in place of an estimate or margin of error that cannot be given
+ANNOTATION_VALUES = [-222222222, -333333333, -666666666]
+
+# Suffixes of the TIGER/Line tract layers: none for annual releases, the census year for decennial ones
+TIGER_SUFFIXES = ['', '10', '20']
+
+# Columns of the tract layers that carry the suffix in decennial releases
+TIGER_COLUMNS = ['GEOID', 'STATEFP', 'COUNTYFP', 'TRACTCE', 'ALAND', 'AWATER', 'INTPTLAT', 'INTPTLON',
+                 'NAME', 'NAMELSAD', 'MTFCC', 'FUNCSTAT']
+
+# Bump whenever the outputs change for the same inputs, so that every year is ingested again
+INGEST_VERSION = 1
+
+
+# Purpose: Path to the raw ACS table of a place in a given year
+def acs_path(year, table, place_fips):
+    return f'{censusdata_path}acs/{year}/{table}_{place_fips}.json'
+
+
+# Purpose: Paths to the TIGER/Line tract shapefile of a state in a given year
+def tiger_paths(year, state):
+    # Decennial releases name the layer after the census, e.g. tl_2010_06_tract10
+    for suffix in TIGER_SUFFIXES:
+        paths = sorted(glob.glob(f'{censusdata_path}tiger/tl_{year}_{state}_tract{suffix}.*'))
+        if paths:
+            return paths
+    return []
+
+
+# Purpose: Path to the geometry file of a place in a given year
+def place_geometry_path(year, place):
+    return f'{assets_path}{year}/contract_rent_mastergeometry_{year}_{place_slug(place)}.json'
+
+
+# Purpose: Years with raw ACS tables on disk
+def raw_years():
+    return sorted(int(os.path.basename(folder)) for folder in glob.glob(f'{censusdata_path}acs/*')
+                  if os.path.basename(folder).isdigit())
+
+
+# Purpose: Read the places to ingest, as {PLACE_FIPS: PLACENAME}
+def read_places():
+    # FIPS codes must stay strings, lest their leading zero be dropped
+    places = pd.read_csv(places_path, converters={'STATEFP': str, 'PLACEFP': str, 'PLACE_FIPS': str})
+    return places.set_index('PLACE_FIPS')['PLACENAME'].to_dict()
+
+
+
+# ------------ ACS TABLES ------------ #
+
+# Purpose: Read and clean a raw ACS table of the tracts in a place
+def read_acs_table(path, table, year, place_fips, place):
+    """
+    Returns None when the API had no tracts for the place, in which case it
+    responds with an empty body. Annotation columns are dropped, GEO_IDs lose
+    their '1400000US' summary level prefix, and NAME keeps only the tract.
+    """
+    with open(path) as file:
+        text = file.read()
+    if not text.strip():
+        return None
+    rows = json.loads(text)
+    if len(rows) < 2:
+        return None
+
+    df = pd.DataFrame(rows[1:], columns=rows[0])
+    value_columns = [col for col in df.columns if re.fullmatch(f'{table}_\\d{{3}}[EM]', col)]
+    df = df[['GEO_ID', 'NAME'] + value_columns]
+    df[value_columns] = df[value_columns].apply(pd.to_numeric, errors='coerce').replace(ANNOTATION_VALUES, np.nan)
+    df['GEO_ID'] = df['GEO_ID'].str.replace('1400000US', '').astype('int64')
+    # 'Census Tract 4810.01, Los Angeles County, California' (';' from 2020 on)
+    df['NAME'] = df['NAME'].str.split(',').str[0].str.split(';').str[0]
+    df['YEAR'] = year
+    df['FIPS'] = int(place_fips)
+    df['PLACE'] = place
+    return df[KEY_COLUMNS + value_columns]
+
+
+# Purpose: Join the ACS tables of a place in a given year into its masterfile rows
+def read_place(year, place_fips, place):
+    tables = [read_acs_table(acs_path(year, table, place_fips), table, year, place_fips, place)
+              for table in ACS_TABLES if os.path.exists(acs_path(year, table, place_fips))]
+    tables = [df for df in tables if df is not None]
+    if not tables:
+        return None
+    df = reduce(lambda left, right: pd.merge(left, right, on=KEY_COLUMNS, how='outer'), tables)
+    return df.reindex(columns=MASTERFILE_CSV_COLUMNS).sort_values('GEO_ID', ignore_index=True)
+
+
+
+# ------------ GEOMETRIES ------------ #
+
+# Purpose: Read the tract boundaries and centroids of a state in a given year
+def read_tracts(year, state):
+    paths = tiger_paths(year, state)
+    path = next((path for path in paths if path.endswith('.shp')), None) or next(path for path in paths
+                                                                                  if path.endswith('.zip'))
+    tracts = gpd.read_file(path)
+    # Decennial column names carry the census suffix (GEOID10, INTPTLAT20, ...)
+    tracts = tracts.rename(columns={column + suffix: column for column in TIGER_COLUMNS for suffix in TIGER_SUFFIXES[1:]})
+    tracts = tracts.rename(columns={'GEOID': 'GEO_ID'})
+    tracts['GEO_ID'] = tracts['GEO_ID'].astype('int64')
+    tracts['INTPTLAT'] = tracts['INTPTLAT'].astype(float)
+    tracts['INTPTLON'] = tracts['INTPTLON'].astype(float)
+    return tracts[['GEO_ID', 'INTPTLAT', 'INTPTLON', 'geometry']]
+
+
+# Purpose: Write the GeoJSON of a place's tracts in a given year and return its fingerprint
+def write_place_geometry(rows, tracts, year, place):
+    gdf = gpd.GeoDataFrame(pd.merge(rows, tracts, on='GEO_ID', how='left'), geometry='geometry', crs=tracts.crs)
+    path = place_geometry_path(year, place)
+    layer = os.path.basename(path)[:-len('.json')]
+    write_atomic(path, lambda tmp_path: gdf[GEOMETRY_COLUMNS].to_file(tmp_path, driver='GeoJSON', layer=layer))
+    return file_fingerprint(path)
+
+
+
+# ------------ INGESTION ------------ #
+
+# Purpose: Fingerprint every raw file that goes into a year
+def input_fingerprints(year, places, states, previous=None):
+    previous_files = dict()
+    if previous is not None:
+        previous_files = {fp['path']: fp for fp in previous['inputs']}
+    paths = [places_path] + [path for state in states for path in tiger_paths(year, state)]
+    paths += [acs_path(year, table, place_fips) for place_fips in places for table in ACS_TABLES
+              if os.path.exists(acs_path(year, table, place_fips))]
+    return [file_fingerprint(path, previous_files.get(path)) for path in paths]
+
+
+# Purpose: Whether a year's outputs are up to date with its inputs
+def ingested(entry, inputs):
+    if entry is None or entry['status'] != 'complete':
+        return False
+    if [(fp['path'], fp['sha256']) for fp in entry['inputs']] != [(fp['path'], fp['sha256']) for fp in inputs]:
+        return False
+    for output in entry['outputs']:
+        if not os.path.exists(output['path']) or file_fingerprint(output['path'], output)['sha256'] != output['sha256']:
+            return False
+    return True
+
+
+# Purpose: Write a year's masterfile and remove the geometry files of places it no longer has
+def write_year(year, frames, geometry_outputs):
+    masterfile = pd.concat(frames, ignore_index=True)[MASTERFILE_CSV_COLUMNS]
+    write_atomic(masterfile_path(year), lambda tmp_path: masterfile.to_csv(tmp_path, index=False))
+
+    written = {output['path'] for output in geometry_outputs}
+    for path in glob.glob(f'{assets_path}{year}/contract_rent_mastergeometry_{year}_*.json'):
+        if path not in written:
+            os.remove(path)
+    return [file_fingerprint(masterfile_path(year))] + sorted(geometry_outputs, key=lambda output: output['path'])
+
+
+# Purpose: Ingest the given years across a process pool, skipping those already up to date
+def ingest(ingest_years=None, force=False, workers=None):
+    """
+    Places are read in parallel, then each year's masterfile is written and the
+    geometry files of its places are written in parallel. A year is marked as
+    pending in the manifest until all of its files are written, so an
+    interrupted run is never mistaken for a complete one. Returns the status of
+    every year.
+    """
+    places = read_places()
+    states = sorted({place_fips[:2] for place_fips in places})
+    manifest = read_ingest_manifest()
+    if manifest.get('version') != INGEST_VERSION:
+        manifest = {'version': INGEST_VERSION, 'years': dict()}
+
+    report = dict()
+    stale = dict()
+    for year in ingest_years or raw_years():
+        entry = manifest['years'].get(str(year))
+        inputs = input_fingerprints(year, places, states, entry)
+        if not force and ingested(entry, inputs):
+            report[year] = 'up to date'
+        else:
+            stale[year] = inputs
+            manifest['years'][str(year)] = {'status': 'pending', 'inputs': inputs, 'outputs': []}
+    if not stale:
+        return report
+    write_json(ingest_manifest_path, manifest, indent=1)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(read_place, year, place_fips, place): year
+                   for year in stale for place_fips, place in places.items()}
+        frames = {year: [] for year in stale}
+        for future in concurrent.futures.as_completed(futures):
+            df = future.result()
+            if df is not None:
+                frames[futures[future]].append(df)
+
+        for year in stale:
+            if not frames[year]:
+                raise FileNotFoundError(f'No ACS tables found for {year} in {censusdata_path}acs/{year}/')
+            # Places in file-name order, each place's tracts by GEO_ID
+            frames[year].sort(key=lambda df: place_slug(df['PLACE'].iloc[0]))
+            tracts = pd.concat([read_tracts(year, state) for state in states], ignore_index=True)
+            futures = [executor.submit(write_place_geometry, df, tracts[tracts['GEO_ID'].isin(df['GEO_ID'])],
+                                       year, df['PLACE'].iloc[0])
+                       for df in frames[year]]
+            outputs = write_year(year, frames[year], [future.result() for future in futures])
+
+            manifest['years'][str(year)].update({'status': 'complete', 'outputs': outputs})
+            write_json(ingest_manifest_path, manifest, indent=1)
+            report[year] = f'ingested ({len(frames[year])} places)'
+
+    return report
+
+
+
+# ------------ EXECUTE THE INGESTION ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the masterfiles and per-place geometries from raw ACS '
+                                                 'tables and TIGER/Line tract shapefiles.')
+    parser.add_argument('--years', type=int, nargs='+', default=None,
+                        help=f'years to ingest (default: every year in {censusdata_path}acs/)')
+    parser.add_argument('--workers', type=int, default=None, help='size of the process pool')
+    parser.add_argument('--force', action='store_true', help='ingest years that are already up to date')
+    args = parser.parse_args()
+
+    for year, status in sorted(ingest(args.years, force=args.force, workers=args.workers).items()):
+        print(f'{year}: {status}')
@@ -0,0 +1,214 @@
+# ------------ LIBRARIES ------------ #
+from flask import abort, jsonify, request
+import pandas as pd
+import numpy as np
+import shapely
+import argparse
+import glob
+import json
+import threading
+
+from data_build import rent_caps, rent_labels, county_fips, years, SERIES_MEASURES, SERIES_COLUMNS
+from geometry_build import source_paths, read_source, geometry_keys, decode_tracts, store_path, refs_path, vintage_of
+
+
+# ------------ SPATIAL INDEX ------------ #
+# Points are matched to tracts with one shapely STRtree per tract vintage, built
+# over every distinct tract polygon drawn in the vintage's years. Polygons come
+# from the unsimplified 'full' level of the geometry store when
+# geometry_build.py has been run, and from the source files in assets/{year}/
+# otherwise (slower, as every year has to be parsed and hashed). Each year keeps
+# a mask of the polygons it draws, so a point only matches the boundaries in
+# effect that year.
+#
+# Trees are built on the first request for a vintage and kept for the life of
+# the process, or all at startup when preloading.
+
+LOOKUP_LEVEL = 'full'
+
+# Largest batch accepted by the endpoint
+MAX_POINTS = 100000
+
+tract_indexes = dict()
+tract_indexes_lock = threading.Lock()
+
+
+# Purpose: Distinct tract polygons of a vintage and the content key of every (year, GEO_ID)
+def read_vintage(vintage):
+    vintage_years = [year for year in years if vintage_of(year) == vintage]
+    polygons = dict()
+    year_keys = {year: dict() for year in vintage_years}
+
+    store_files = sorted(glob.glob(store_path(LOOKUP_LEVEL, vintage, '*')))
+    if store_files:
+        for path in store_files:
+            with open(path) as file:
+                keys, geoms = decode_tracts(json.load(file))
+            polygons.update(zip(keys, geoms))
+        for year in vintage_years:
+            for path in glob.glob(refs_path(year, '*')):
+                with open(path) as file:
+                    year_keys[year].update(json.load(file)['keys'])
+    else:
+        for year in vintage_years:
+            for path in source_paths(year):
+                geo_ids, geoms = read_source(path)
+                keys = geometry_keys(geo_ids, geoms)
+                polygons.update(zip(keys, geoms))
+                year_keys[year].update(zip(map(str, geo_ids), keys))
+
+    return polygons, year_keys
+
+
+# Purpose: Build the STRtree of a vintage with the GEO_ID of each polygon and a per-year mask
+def build_tract_index(vintage):
+    polygons, year_keys = read_vintage(vintage)
+    keys = list(polygons)
+    row_of = {key: row for row, key in enumerate(keys)}
+    geoms = np.array([polygons[key] for key in keys], dtype=object)
+
+    geo_ids = np.zeros(len(keys), dtype=np.int64)
+    masks = dict()
+    for year, refs in year_keys.items():
+        rows = np.array([row_of[key] for key in refs.values()], dtype=np.int64)
+        geo_ids[rows] = np.array(list(refs), dtype=np.int64)
+        masks[year] = np.zeros(len(keys), dtype=bool)
+        masks[year][rows] = True
+
+    return {'tree': shapely.STRtree(geoms), 'geo_ids': geo_ids, 'masks': masks}
+
+
+# Purpose: STRtree of the vintage covering a year, built on first use
+def tract_index(year):
+    vintage = vintage_of(year)
+    with tract_indexes_lock:
+        if vintage not in tract_indexes:
+            tract_indexes[vintage] = build_tract_index(vintage)
+        return tract_indexes[vintage]
+
+
+# Purpose: GEO_ID of the tract containing each point in a given year (0 where none does)
+def locate_points(lat, lon, year):
+    """
+    Points on a boundary shared by two tracts go to the first tract found.
+    """
+    index = tract_index(year)
+    points = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+    point_rows, tract_rows = index['tree'].query(points, predicate='intersects')
+
+    drawn = index['masks'][year][tract_rows]
+    point_rows, tract_rows = point_rows[drawn], tract_rows[drawn]
+    point_rows, first = np.unique(point_rows, return_index=True)
+
+    geo_ids = np.zeros(len(points), dtype=np.int64)
+    geo_ids[point_rows] = index['geo_ids'][tract_rows[first]]
+    return geo_ids
+
+
+
+# ------------ JOIN ------------ #
+
+# Purpose: Join located GEO_IDs to their places and that year's rents from the series indexes
+def join_rents(geo_ids, year, store):
+    """
+    Returns a dict of columns, one entry per point. Points outside every tract
+    get None throughout, and tracts without data that year get None rents.
+    """
+    col = year - years.start
+    located = geo_ids != 0
+    found = np.zeros(len(geo_ids), dtype=bool)
+    names = np.full(len(geo_ids), None, dtype=object)
+    values = {col_name: np.full(len(geo_ids), np.nan) for col_name in SERIES_COLUMNS}
+
+    counties = county_fips(geo_ids)
+    for county in np.unique(counties[located]):
+        if county not in store.catalog['counties']:
+            continue
+        index = store.series_index(county)
+        points = np.flatnonzero(located & (counties == county))
+        rows = np.clip(np.searchsorted(index['GEO_ID'], geo_ids[points]), 0, len(index['GEO_ID']) - 1)
+        matched = index['GEO_ID'][rows] == geo_ids[points]
+        points, rows = points[matched], rows[matched]
+        found[points] = True
+        names[points] = index['NAME'][rows]
+        for col_name in SERIES_COLUMNS:
+            values[col_name][points] = index[col_name][rows, col]
+
+    rows = store.tract_rows(year, geo_ids[located])
+    places = dict() if rows is None else rows.groupby('GEO_ID', sort=False)['PLACE'].agg(list).to_dict()
+
+    columns = {'GEO_ID': [int(g) if g else None for g in geo_ids],
+               'NAME': [str(name) if f else None for name, f in zip(names, found)],
+               'PLACE': [places.get(int(g)) if g else None for g in geo_ids]
+              }
+    for col_name in SERIES_COLUMNS:
+        columns[col_name] = np.where(np.isnan(values[col_name]), None, values[col_name]).tolist()
+    caps = rent_caps(np.full(len(geo_ids), year))
+    for label, (estimate, _) in SERIES_MEASURES.items():
+        labels = rent_labels(values[estimate], caps)
+        columns[label] = [value if f else None for value, f in zip(labels, found)]
+    return columns
+
+
+
+# ------------ ROUTES ------------ #
+
+# Purpose: Register the batch point-to-tract lookup on the Flask server
+def register_lookup_api(server, store, preload=False):
+    """
+    Endpoint (relative to the app's base path):
+
+    POST lookup/tracts   {"year": 2023, "lat": [...], "lon": [...]}
+
+    Responds with {"year", "length", "columns"}, one entry per point in every
+    column: GEO_ID, NAME, PLACE (a list, as a tract can span several places), the
+    estimates and margins of error of the series index, and their labels.
+    """
+    if preload:
+        # tract_index takes a census year, so each vintage is built through its first year
+        for year in sorted({vintage_of(year): year for year in reversed(years)}.values()):
+            tract_index(year)
+
+    @server.route('/lookup/tracts', methods=['POST'])
+    def lookup_tracts():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400, 'Expected a JSON object with "lat" and "lon" arrays.')
+        year = body.get('year', years[-1])
+        lat, lon = body.get('lat'), body.get('lon')
+        if not isinstance(year, int) or year not in years:
+            abort(400, f'"year" must be between {years.start} and {years.stop - 1}.')
+        if not isinstance(lat, list) or not isinstance(lon, list) or len(lat) != len(lon):
+            abort(400, '"lat" and "lon" must be arrays of the same length.')
+        if len(lat) > MAX_POINTS:
+            abort(413, f'At most {MAX_POINTS} points per request.')
+        try:
+            geo_ids = locate_points(lat, lon, year)
+        except (TypeError, ValueError):
+            abort(400, '"lat" and "lon" must hold numbers.')
+
+        return jsonify({'year': year,
+                        'length': len(geo_ids),
+                        'columns': join_rents(geo_ids, year, store)
+                       })
+
+
+
+# ------------ EXECUTE A BATCH JOIN ------------ #
+if __name__ == '__main__':
+    from data_store import open_data_store
+
+    parser = argparse.ArgumentParser(description='Join a CSV of points to the tract rents of a year.')
+    parser.add_argument('points', help='CSV file with latitude and longitude columns')
+    parser.add_argument('output', help='CSV file to write')
+    parser.add_argument('--year', type=int, default=years[-1])
+    parser.add_argument('--lat', default='lat', help='name of the latitude column')
+    parser.add_argument('--lon', default='lon', help='name of the longitude column')
+    args = parser.parse_args()
+
+    points = pd.read_csv(args.points)
+    geo_ids = locate_points(points[args.lat], points[args.lon], args.year)
+    joined = pd.DataFrame(join_rents(geo_ids, args.year, open_data_store()))
+    joined['PLACE'] = joined['PLACE'].map(lambda places: '; '.join(places) if places else None)
+    joined.index = points.index
+    pd.concat([points, joined], axis=1).to_csv(args.output, index=False)
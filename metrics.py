@@ -0,0 +1,272 @@
+# ------------ LIBRARIES ------------ #
+from flask import Response, abort, g, request
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+
+# ------------ METRICS ------------ #
+# Instrumentation of the Flask server behind the app, exposed in the Prometheus
+# text format on /metrics:
+#
+#   rents_startup_stage_seconds            time spent in each startup stage of app.py
+#   rents_http_request_duration_seconds    latency of each route, as a histogram
+#   rents_http_response_size_bytes         size of each route's responses, as a histogram
+#   rents_clientside_callback_seconds      clientside callback durations reported by assets/metrics.js
+#
+# Routes are labelled by their rule (e.g. /geometry/refs/<int:year>/<path:place>.json)
+# rather than their path, so the number of series stays bounded. Every response
+# also carries a Server-Timing header with the time the server spent on it.
+#
+# Recording takes a lock and a bisect, and setting RENTS_METRICS=0 turns all of
+# it off: nothing is registered on the server and the client hook stays silent.
+#
+# Each process records its own histograms. Under gunicorn, whichever worker
+# answers a scrape would only report its own share, so with RENTS_METRICS_DIR
+# set (gunicorn.conf.py does) each process also writes a snapshot of its
+# histograms to {RENTS_METRICS_DIR}/{process}.json, at most every FLUSH_SECONDS
+# and only when they changed, and /metrics adds up the snapshots of every
+# process. Snapshots of workers that exited are kept, so counts never go
+# backwards between scrapes; they are cleared when the server starts.
+
+METRICS_ENABLED = os.environ.get('RENTS_METRICS', '1') != '0'
+
+# Folder of the per-process snapshots, unset for a single process
+METRICS_DIR = os.environ.get('RENTS_METRICS_DIR')
+
+# How often a process writes its snapshot when its histograms changed
+FLUSH_SECONDS = 1
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [2 ** 10 * 4 ** i for i in range(10)]
+
+# Clientside callbacks the client hook may report, and the most timings accepted per report
+CLIENT_CALLBACKS = ['choropleth', 'places_plot', 'rent_plot', 'tract_options']
+MAX_CLIENT_TIMINGS = 100
+
+# Where assets/metrics.js sends its reports, relative to the app's base path
+CLIENT_ENDPOINT = 'metrics/client'
+
+lock = threading.Lock()
+startup_stages = dict()
+histograms = dict()
+
+# Startup stages are timed from one mark to the next
+last_mark = [time.perf_counter()]
+
+# Name of this process's snapshot and whether its histograms changed since it was
+# written; the name is per process start, as a forked worker or a reused pid must not reuse it
+snapshot_state = {'pid': None, 'name': None, 'dirty': False}
+
+
+# Purpose: Record the time since the previous startup stage ended
+def startup_mark(stage):
+    now = time.perf_counter()
+    if METRICS_ENABLED:
+        startup_stages[stage] = now - last_mark[0]
+    last_mark[0] = now
+
+
+# Purpose: Add an observation to the histogram of a metric and a set of labels
+def observe(name, labels, buckets, value):
+    key = (name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0}
+        histogram['counts'][bisect.bisect_left(buckets, value)] += 1
+        histogram['sum'] += value
+        snapshot_state['dirty'] = True
+
+
+
+# ------------ SNAPSHOTS ------------ #
+
+# Purpose: Copy of the histograms of this process
+def snapshot():
+    with lock:
+        return {key: {'buckets': histogram['buckets'], 'counts': list(histogram['counts']), 'sum': histogram['sum']}
+                for key, histogram in histograms.items()}
+
+
+# Purpose: Write the snapshot of this process to the metrics folder
+def write_snapshot():
+    with lock:
+        snapshot_state['dirty'] = False
+    entries = [[name, [list(pair) for pair in labels], histogram['buckets'], histogram['counts'], histogram['sum']]
+               for (name, labels), histogram in snapshot().items()]
+    path = f"{METRICS_DIR}/{snapshot_state['name']}.json"
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(entries, file)
+    os.replace(f'{path}.tmp', path)
+
+
+# Purpose: Write the snapshot of this process whenever its histograms changed, every FLUSH_SECONDS
+def flush_snapshots():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        if snapshot_state['dirty']:
+            write_snapshot()
+
+
+# Purpose: Start writing snapshots from this process, once per process
+def start_snapshots():
+    if METRICS_DIR is None or snapshot_state['pid'] == os.getpid():
+        return
+    with lock:
+        if snapshot_state['pid'] == os.getpid():
+            return
+        # Threads do not survive a fork, so each worker starts its own on its first request
+        snapshot_state['pid'] = os.getpid()
+        snapshot_state['name'] = f'{os.getpid()}-{time.time_ns()}'
+    threading.Thread(target=flush_snapshots, name='metrics_snapshots', daemon=True).start()
+
+
+# Purpose: Histograms of every process writing to the metrics folder, added up
+def merged_snapshot():
+    merged = snapshot()
+    if METRICS_DIR is None:
+        return merged
+    for path in glob.glob(f'{METRICS_DIR}/*.json'):
+        if os.path.basename(path) == f"{snapshot_state['name']}.json":
+            continue
+        try:
+            with open(path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for name, labels, buckets, counts, total in entries:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            histogram = merged.setdefault(key, {'buckets': buckets, 'counts': [0] * len(counts), 'sum': 0.0})
+            histogram['counts'] = [a + b for a, b in zip(histogram['counts'], counts)]
+            histogram['sum'] += total
+    return merged
+
+
+# Purpose: Clear the snapshots of a previous run of the server
+def clear_snapshots():
+    if METRICS_DIR is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for path in glob.glob(f'{METRICS_DIR}/*.json'):
+        os.remove(path)
+
+
+
+# ------------ EXPOSITION ------------ #
+
+HELP = {'rents_startup_stage_seconds': ('gauge', 'Time spent in each startup stage of the app.'),
+        'rents_http_request_duration_seconds': ('histogram', 'Time spent serving requests, by route.'),
+        'rents_http_response_size_bytes': ('histogram', 'Size of response bodies, by route.'),
+        'rents_clientside_callback_seconds': ('histogram', 'Duration of clientside callbacks, as reported by browsers.')
+       }
+
+
+# Purpose: Format a set of labels, e.g. {route="/",method="GET"}
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+# Purpose: Render every metric in the Prometheus text format
+def exposition():
+    with lock:
+        stages = dict(startup_stages)
+    histogram_snapshot = merged_snapshot()
+
+    lines = []
+    metric_type, help_text = HELP['rents_startup_stage_seconds']
+    lines += [f'# HELP rents_startup_stage_seconds {help_text}', f'# TYPE rents_startup_stage_seconds {metric_type}']
+    lines += [f'rents_startup_stage_seconds{format_labels([("stage", stage)])} {seconds:.6f}'
+              for stage, seconds in stages.items()]
+
+    for name in ['rents_http_request_duration_seconds', 'rents_http_response_size_bytes',
+                 'rents_clientside_callback_seconds']:
+        metric_type, help_text = HELP[name]
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+        for (key_name, labels), histogram in sorted(histogram_snapshot.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]:.6f}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+
+# ------------ ROUTES ------------ #
+
+# Purpose: Meta tags telling assets/metrics.js where to report, empty when metrics are off
+def client_meta_tags():
+    if not METRICS_ENABLED:
+        return []
+    return [{'name': 'rents-metrics', 'content': CLIENT_ENDPOINT}]
+
+
+# Purpose: Time every request on the Flask server and serve the metrics
+def register_metrics(server):
+    """
+    Endpoints (relative to the app's base path):
+
+    metrics          every metric, in the Prometheus text format
+    metrics/client   POST {"callbacks": {"choropleth": [milliseconds, ...], ...}} from assets/metrics.js
+
+    Does nothing when metrics are off.
+    """
+    if not METRICS_ENABLED:
+        return
+
+    @server.before_request
+    def start_timer():
+        start_snapshots()
+        g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None or request.path == '/metrics':
+            return response
+        seconds = time.perf_counter() - start
+        labels = (('route', request.url_rule.rule if request.url_rule is not None else 'unmatched'),
+                  ('method', request.method),
+                  ('status', response.status_code))
+        observe('rents_http_request_duration_seconds', labels, LATENCY_BUCKETS, seconds)
+        # Files are streamed, but send_file sets their Content-Length. Other streamed
+        # bodies (e.g. exports) are left unsized, as sizing them would buffer them
+        size = response.content_length
+        if size is None and response.is_sequence:
+            size = response.calculate_content_length()
+        if size is not None:
+            observe('rents_http_response_size_bytes', labels, SIZE_BUCKETS, size)
+        response.headers.add('Server-Timing', f'app;dur={seconds * 1000:.1f}')
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(exposition(), mimetype='text/plain; version=0.0.4')
+
+    @server.route(f'/{CLIENT_ENDPOINT}', methods=['POST'])
+    def client_metrics():
+        body = request.get_json(silent=True, force=True)
+        if not isinstance(body, dict) or not isinstance(body.get('callbacks'), dict):
+            abort(400, 'Expected a JSON object with a "callbacks" object.')
+        for callback, timings in body['callbacks'].items():
+            if callback not in CLIENT_CALLBACKS or not isinstance(timings, list):
+                continue
+            for milliseconds in timings[:MAX_CLIENT_TIMINGS]:
+                # JSON true and false arrive as bools, which are ints to isinstance
+                if isinstance(milliseconds, (int, float)) and not isinstance(milliseconds, bool) \
+                        and 0 <= milliseconds < 3600000:
+                    observe('rents_clientside_callback_seconds', (('callback', callback),), LATENCY_BUCKETS,
+                            milliseconds / 1000)
+        return Response(status=204)
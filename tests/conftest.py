@@ -0,0 +1,31 @@
+# ------------ TEST SETUP ------------ #
+# The modules of the app are flat scripts at the root of the repository
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+# ------------ FIXTURES ------------ #
+
+# Purpose: Build a partitioned cache of some years into a folder, returning its catalog
+@pytest.fixture(scope='session')
+def make_cache():
+    from data_build import build_masterfile, write_partitions, write_catalog
+
+    def make(folder, cache_years, edit=None):
+        masterfile = build_masterfile(cache_years)
+        if edit is not None:
+            masterfile = edit(masterfile)
+        write_partitions(masterfile, folder)
+        return write_catalog(folder)
+    return make
+
+
+# Purpose: A cache of the last two years, shared by the tests that only read it
+@pytest.fixture(scope='session')
+def cache(tmp_path_factory, make_cache):
+    folder = f'{tmp_path_factory.mktemp("cache")}/'
+    return make_cache(folder, [2022, 2023]), folder
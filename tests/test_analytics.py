@@ -0,0 +1,94 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import pandas as pd
+
+from analytics import group_quantiles, place_metrics
+
+
+# ------------ GROUP QUANTILES ------------ #
+
+# Purpose: Quantiles of random groups match numpy.quantile group by group
+def test_group_quantiles_match_numpy():
+    rng = np.random.default_rng(3)
+    ngroups = 30
+    groups = rng.integers(0, ngroups - 2, size=2000)     # the last two groups stay empty
+    values = rng.normal(1000, 300, size=len(groups))
+    values[rng.random(len(values)) < 0.1] = np.nan
+    values[groups == 5] = np.nan                         # a group with only missing values
+
+    for q in [0, 0.1, 0.25, 0.5, 0.75, 0.9, 1]:
+        result = group_quantiles(groups, values, ngroups, q)
+        for group in range(ngroups):
+            group_values = values[(groups == group) & ~np.isnan(values)]
+            expected = np.quantile(group_values, q) if len(group_values) else np.nan
+            np.testing.assert_allclose(result[group], expected, equal_nan=True)
+
+
+# Purpose: Infinite (censored) values sort above everything, and a quantile that lands on one is unknown
+def test_group_quantiles_censored():
+    groups = np.array([0, 0, 0, 1, 1, 1, 2, 2])
+    values = np.array([900, 1000, np.inf, 900, np.inf, np.inf, np.inf, np.nan])
+    result = group_quantiles(groups, values, 3, 0.5)
+    assert result[0] == 1000
+    assert np.isnan(result[1]) and np.isnan(result[2])
+    # Interpolating towards an infinite value is unknown too
+    assert np.isnan(group_quantiles(np.array([0, 0]), np.array([900, np.inf]), 1, 0.5)[0])
+
+
+
+# ------------ PLACE METRICS ------------ #
+
+# Purpose: Masterfile rows of places in one county, one row per tract and year
+def masterfile(rows):
+    return pd.DataFrame([{'PLACE': place, 'YEAR': year, 'GEO_ID': 6037000000 + tract, 'B25058_001E': value}
+                         for place, year, tract, value in rows])
+
+
+# Purpose: Censored medians are flagged, unknown, and tied for the top rank
+def test_place_metrics_censored_ranks():
+    rows = []
+    # Capped medians ($3501 from 2015): Hills and Estates are censored, Valley has the highest known median
+    for tract, value in enumerate([3501, 3501, 3000]):
+        rows.append(('Hills', 2020, 100 + tract, value))
+    for tract, value in enumerate([3501, 3501, 3501]):
+        rows.append(('Estates', 2020, 200 + tract, value))
+    for tract, value in enumerate([2500, 2600, 2700]):
+        rows.append(('Valley', 2020, 300 + tract, value))
+    for tract, value in enumerate([1500, 1500, 1200]):
+        rows.append(('Flats', 2020, 400 + tract, value))
+    for tract, value in enumerate([1500, 1500]):
+        rows.append(('Twin', 2020, 500 + tract, value))
+    for tract in range(2):
+        rows.append(('Blank', 2020, 600 + tract, np.nan))
+    metrics = place_metrics(masterfile(rows)).set_index('PLACE')
+
+    assert metrics.loc['Hills', 'median_censored'] == 1 and np.isnan(metrics.loc['Hills', 'median'])
+    assert metrics.loc['Estates', 'capped'] == 3 and metrics.loc['Estates', 'median_censored'] == 1
+    assert metrics.loc['Valley', 'median'] == 2600 and metrics.loc['Valley', 'median_censored'] == 0
+
+    # Both censored places tie first, then the known medians in order, with ties sharing the lower rank
+    assert metrics.loc['Hills', 'rank'] == 1 and metrics.loc['Estates', 'rank'] == 1
+    assert metrics.loc['Valley', 'rank'] == 3
+    assert metrics.loc['Flats', 'rank'] == 4 and metrics.loc['Twin', 'rank'] == 4
+    # A place without estimates has neither a median nor a rank, and is not counted among the ranked
+    assert metrics.loc['Blank', 'reported'] == 0 and metrics.loc['Blank', 'median_censored'] == 0
+    assert np.isnan(metrics.loc['Blank', 'rank'])
+    assert (metrics.drop('Blank')['ranked'] == 5).all()
+
+
+# Purpose: Growth and tract changes follow each place's years, leaving capped estimates out of changes
+def test_place_metrics_growth():
+    rows = [('Town', 2019, 1, 1000), ('Town', 2019, 2, 1200),
+            ('Town', 2020, 1, 1100), ('Town', 2020, 2, 3501),
+            ('Town', 2021, 1, 1210), ('Town', 2021, 2, 1320)]
+    metrics = place_metrics(masterfile(rows)).set_index('YEAR')
+
+    assert metrics.loc[2019, 'median'] == 1100
+    # Halfway between a known and a capped estimate is unknown
+    assert np.isnan(metrics.loc[2020, 'median']) and metrics.loc[2020, 'median_censored'] == 1
+    assert np.isnan(metrics.loc[2021, 'yoy'])
+    np.testing.assert_allclose(metrics.loc[2021, 'cagr'], (1265 / 1100) ** 0.5 - 1)
+    assert metrics.loc[2021, 'cagr_since'] == 2019
+    # Only tract 1 has an uncapped estimate in both 2019 and 2020
+    assert metrics.loc[2020, 'changes'] == 1
+    np.testing.assert_allclose(metrics.loc[2020, 'change_p50'], 0.1)
@@ -0,0 +1,81 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import pandas as pd
+import flask
+import gzip
+import json
+
+from data_build import masterfile_path
+from data_store import DataStore
+from data_api import register_data_api, catalog_version, CACHE_CONTROL
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: Payloads carry ETags, and a new data version leaves the old URLs behind
+def test_payload_etags_and_versions(tmp_path, make_cache):
+    folder = f'{tmp_path}/'
+    catalog = make_cache(folder, [2023])
+    store = DataStore(catalog, folder)
+    server = flask.Flask(__name__)
+    version = register_data_api(server, store)
+    client = server.test_client()
+    assert version == catalog_version(catalog)
+
+    url = f'/data/{version}/places/2023/Long%20Beach.json'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == CACHE_CONTROL
+    etag = response.headers['ETag']
+    payload = json.loads(response.data)
+    baseline = pd.read_csv(masterfile_path(2023))
+    baseline = baseline[baseline['PLACE'] == 'Long Beach']
+    assert payload['length'] == len(baseline)
+    assert sorted(payload['columns']['GEO_ID']) == sorted(baseline['GEO_ID'])
+
+    # Revalidation and compression
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip' and gzip.decompress(compressed.data) == response.data
+
+    # A year rebuilt with a changed rent gives a new version; the old one is gone
+    def edit(masterfile):
+        masterfile.loc[masterfile['PLACE'] == 'Long Beach', 'B25058_001E'] += 1
+        return masterfile
+    store.update(make_cache(folder, [2023], edit))
+    new_version = json.loads(client.get('/data/status.json').data)['version']
+    assert new_version != version and new_version == catalog_version(store.catalog)
+    assert client.get(url).status_code == 404
+    assert client.get(f'/data/{version}/schema.json').status_code == 404
+
+    new_url = f'/data/{new_version}/places/2023/Long%20Beach.json'
+    response = client.get(new_url, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    medians = np.array(json.loads(response.data)['columns']['B25058_001E'], dtype=float)
+    assert np.nansum(medians) == np.nansum(np.array(payload['columns']['B25058_001E'], dtype=float)) \
+        + np.isfinite(medians).sum()
+
+
+# Purpose: A place's partition payload decodes back to the place's rows of the masterfile
+def test_partition_payload_matches_masterfile(cache):
+    catalog, folder = cache
+    server = flask.Flask(__name__)
+    version = register_data_api(server, DataStore(catalog, folder))
+    client = server.test_client()
+    schema = json.loads(client.get(f'/data/{version}/schema.json').data)
+    payload = json.loads(client.get(f'/data/{version}/places/2022/Torrance.json').data)
+
+    columns = dict()
+    for col, values in payload['columns'].items():
+        if col in schema['encodings']:
+            dictionary = schema['dictionaries'][schema['encodings'][col]]
+            values = [dictionary[code] for code in values]
+        columns[col] = values
+    decoded = pd.DataFrame(columns).sort_values('GEO_ID').reset_index(drop=True)
+
+    baseline = pd.read_csv(masterfile_path(2022))
+    baseline = baseline[baseline['PLACE'] == 'Torrance'].sort_values('GEO_ID').reset_index(drop=True)
+    assert payload['length'] == len(baseline)
+    pd.testing.assert_frame_equal(decoded[['GEO_ID', 'NAME']], baseline[['GEO_ID', 'NAME']])
+    for col in ['B25058_001E', 'B25058_001M', 'B25057_001E', 'B25059_001E']:
+        np.testing.assert_array_equal(decoded[col].to_numpy(dtype=float), baseline[col].to_numpy(dtype=float))
@@ -0,0 +1,20 @@
+# ------------ LIBRARIES ------------ #
+import json
+
+import data_build
+from data_build import data_years
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: The years run from the first to the last masterfile on disk or year started by ingest.py
+def test_data_years(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_build, 'data_path', f'{tmp_path}/')
+    monkeypatch.setattr(data_build, 'ingest_manifest_path', f'{tmp_path}/ingest_manifest.json')
+    for year in [2011, 2012]:
+        (tmp_path / f'contract_rent_masterfile_{year}.csv').write_text('YEAR\n')
+    assert data_years() == range(2011, 2013)
+
+    # A year ingest.py has started counts before its masterfile is written
+    (tmp_path / 'ingest_manifest.json').write_text(json.dumps({'version': 1, 'years': {'2013': {'status': 'pending'}}}))
+    assert data_years() == range(2011, 2014)
@@ -0,0 +1,66 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import flask
+import io
+import json
+
+from data_build import masterfile_path
+from data_store import DataStore
+from export_api import register_export_api, source_files, EXPORT_COLUMNS
+from geometry_build import place_slug
+
+BASELINE_COLUMNS = ['YEAR', 'PLACE', 'GEO_ID', 'NAME', 'B25058_001E', 'B25058_001M', 'B25057_001E', 'B25057_001M',
+                    'B25059_001E', 'B25059_001M']
+
+
+# Purpose: Rows of a place in the given years of the masterfiles, sorted like the comparisons below
+def baseline_rows(place, export_years):
+    rows = pd.concat([pd.read_csv(masterfile_path(year)) for year in export_years])
+    return rows[rows['PLACE'] == place][BASELINE_COLUMNS].sort_values(['YEAR', 'GEO_ID']).reset_index(drop=True)
+
+
+# Purpose: A test client of the export endpoint over the shared cache
+def export_client(cache):
+    catalog, folder = cache
+    server = flask.Flask(__name__)
+    register_export_api(server, DataStore(catalog, folder), lambda path: path)
+    return server.test_client()
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: A CSV export of one place holds the place's rows of the masterfiles
+def test_csv_export_matches_masterfile(cache):
+    response = export_client(cache).get('/export/tracts.csv?place=Torrance&from=2022&to=2023')
+    assert response.status_code == 200
+    assert 'contract_rents_2022_2023.csv' in response.headers['Content-Disposition']
+    exported = pd.read_csv(io.BytesIO(response.data))
+    assert exported.columns.tolist() == EXPORT_COLUMNS
+    exported = exported.sort_values(['YEAR', 'GEO_ID']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(exported[BASELINE_COLUMNS], baseline_rows('Torrance', [2022, 2023]),
+                                  check_dtype=False)
+
+
+# Purpose: A GeoJSON export has one feature per row, with the properties and polygons of the source files
+def test_geojson_export_matches_masterfile(cache):
+    response = export_client(cache).get('/export/tracts.geojson?place=Torrance&from=2023&to=2023')
+    assert response.status_code == 200
+    collection = json.loads(response.data)
+    properties = pd.DataFrame([feature['properties'] for feature in collection['features']])
+    properties = properties.sort_values(['YEAR', 'GEO_ID']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(properties[BASELINE_COLUMNS].astype({col: float for col in BASELINE_COLUMNS[4:]}),
+                                  baseline_rows('Torrance', [2023]), check_dtype=False)
+
+    with open(source_files(2023)[place_slug('Torrance')]) as file:
+        sources = {int(feature['properties']['GEO_ID']): feature['geometry'] for feature in json.load(file)['features']}
+    exported = {feature['properties']['GEO_ID']: feature['geometry'] for feature in collection['features']}
+    assert exported == {geo_id: sources.get(geo_id) for geo_id in exported}
+    assert all(geometry is not None for geometry in exported.values())
+
+
+# Purpose: Invalid selections are refused
+def test_export_rejects_invalid_selection(cache):
+    client = export_client(cache)
+    assert client.get('/export/tracts.csv?place=Atlantis').status_code == 400
+    assert client.get('/export/tracts.csv?from=2023&to=2022').status_code == 400
+    assert client.get('/export/tracts.xlsx').status_code == 404
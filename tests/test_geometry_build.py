@@ -0,0 +1,45 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import shapely
+import gzip
+import json
+import os
+
+from geometry_build import encode_tracts, decode_tracts, quantize_tracts, write_output, RESOLUTION_LEVELS
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: Quantized tracts decode back to the same polygons, holes and multipolygons included
+def test_encode_tracts_round_trip():
+    grid = RESOLUTION_LEVELS['medium']['grid']
+    square = shapely.Polygon([(-118.30, 33.90), (-118.20, 33.90), (-118.20, 34.00), (-118.30, 34.00)],
+                             holes=[[(-118.28, 33.92), (-118.25, 33.92), (-118.25, 33.95), (-118.28, 33.95)]])
+    islands = shapely.MultiPolygon([shapely.box(-118.60, 33.30, -118.50, 33.40), shapely.box(-118.45, 33.35, -118.40, 33.45)])
+    geoms = quantize_tracts(np.array([square, islands], dtype=object), grid)
+
+    collection = json.loads(json.dumps(encode_tracts(['a', 'b'], geoms, grid), allow_nan=False))
+    ids, decoded = decode_tracts(collection)
+    assert ids == ['a', 'b']
+    assert [geom.geom_type for geom in decoded] == ['Polygon', 'MultiPolygon']
+    assert all(shapely.hausdorff_distance(decoded, geoms) < grid / 2)
+
+
+# Purpose: A store without polygons encodes as valid JSON
+def test_encode_empty_tracts():
+    collection = encode_tracts([], np.array([], dtype=object), RESOLUTION_LEVELS['medium']['grid'])
+    data = json.dumps(collection, allow_nan=False)
+    assert decode_tracts(json.loads(data))[0] == []
+
+
+# Purpose: Outputs replace the previous files whole, with no temporary files left behind
+def test_write_output(tmp_path):
+    destination = f'{tmp_path}/store/place.json'
+    write_output(destination, b'{"old":1}')
+    compressed = write_output(destination, b'{"new":2}')
+    with open(destination, 'rb') as file:
+        assert file.read() == b'{"new":2}'
+    assert gzip.decompress(compressed) == b'{"new":2}'
+    with open(destination + '.gz', 'rb') as file:
+        assert file.read() == compressed
+    assert not [name for name in os.listdir(f'{tmp_path}/store') if '.tmp' in name]
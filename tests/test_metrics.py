@@ -0,0 +1,34 @@
+# ------------ LIBRARIES ------------ #
+import re
+
+import flask
+import pytest
+
+import metrics
+from metrics import register_metrics, CLIENT_ENDPOINT
+
+
+# Purpose: Number of clientside timings recorded for a callback
+def timing_count(client, callback):
+    text = client.get('/metrics').get_data(as_text=True)
+    found = re.search(rf'rents_clientside_callback_seconds_count{{callback="{callback}"}} (\d+)', text)
+    return int(found.group(1)) if found else 0
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: Only numeric timings within range are recorded; booleans, strings and outliers are dropped
+@pytest.mark.skipif(not metrics.METRICS_ENABLED, reason='metrics are off')
+def test_client_metrics_validation():
+    server = flask.Flask(__name__)
+    register_metrics(server)
+    client = server.test_client()
+
+    before = timing_count(client, 'tract_options')
+    response = client.post(f'/{CLIENT_ENDPOINT}', json={'callbacks': {
+        'tract_options': [12, 3.5, True, False, '40', None, -1, 3600000],
+        'unknown_callback': [10]
+    }})
+    assert response.status_code == 204
+    assert timing_count(client, 'tract_options') == before + 2
+    assert client.post(f'/{CLIENT_ENDPOINT}', json=[1, 2]).status_code == 400
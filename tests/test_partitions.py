@@ -0,0 +1,82 @@
+# ------------ LIBRARIES ------------ #
+import pandas as pd
+import hashlib
+import json
+import os
+import shutil
+
+import data_build
+from data_build import (PartitionBuild, build_year, county_fips, write_partition, read_partition, read_catalog,
+                        partition_path, CATEGORICAL_COLUMNS, MASTERFILE_COLUMNS)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: A partition reads back as the rows written, with a summary matching the file
+def test_partition_round_trip(tmp_path):
+    folder = f'{tmp_path}/'
+    rows = build_year(2023)
+    county = county_fips(rows['GEO_ID'].to_numpy())[0]
+    rows = rows[county_fips(rows['GEO_ID'].to_numpy()) == county].reset_index(drop=True)
+    write_partition(rows, county, 2023, folder)
+
+    read = read_partition(county, 2023, folder)
+    pd.testing.assert_frame_equal(read.astype({col: object for col in CATEGORICAL_COLUMNS}),
+                                  rows[MASTERFILE_COLUMNS].astype({col: object for col in CATEGORICAL_COLUMNS}))
+    # Categories are narrowed to the values of the partition
+    assert all(read[col].cat.categories.isin(rows[col]).all() for col in CATEGORICAL_COLUMNS)
+
+    path = partition_path(county, 2023, folder)
+    with open(path[:-len('.npz')] + '.json') as file:
+        summary = json.load(file)
+    with open(path, 'rb') as file:
+        assert summary['sha256'] == hashlib.sha256(file.read()).hexdigest()
+    assert summary['rows'] == len(rows)
+    assert summary['places'] == rows['PLACE'].astype(object).value_counts().to_dict()
+
+
+# Purpose: Years are rebuilt only when their sources change or their partitions are missing
+def test_manifest_freshness(tmp_path, monkeypatch):
+    # The cache and masterfile paths are relative, so the build runs in a copy of the sources
+    os.mkdir(tmp_path / 'masterfiles')
+    for year in [2022, 2023]:
+        shutil.copy(f'{ROOT}/masterfiles/contract_rent_masterfile_{year}.csv', tmp_path / 'masterfiles')
+    os.symlink(f'{ROOT}/assets', tmp_path / 'assets')
+    os.symlink(f'{ROOT}/geometry', tmp_path / 'geometry')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(data_build, 'years', range(2022, 2024))
+
+    build = PartitionBuild(workers=1)
+    catalog = build.run()
+    assert sorted(build.built) == [2022, 2023] and not build.failures
+    assert catalog['counties']['06037']['years'] == [2022, 2023]
+
+    # Nothing to do when nothing changed, even if a source was touched
+    os.utime('masterfiles/contract_rent_masterfile_2022.csv')
+    build = PartitionBuild(workers=1)
+    assert build.pending == []
+    assert build.run()['data_version'] == catalog['data_version']
+
+    # A changed masterfile rebuilds its year only, and the catalog gets a new data version
+    kept = os.stat(partition_path('06037', 2022)).st_mtime_ns
+    csv = pd.read_csv('masterfiles/contract_rent_masterfile_2023.csv')
+    csv.loc[0, 'B25058_001E'] = 1234
+    csv.to_csv('masterfiles/contract_rent_masterfile_2023.csv', index=False)
+    build = PartitionBuild(workers=1)
+    assert build.pending == [2023]
+    changed = build.run()
+    assert changed['data_version'] != catalog['data_version']
+    assert read_catalog()['data_version'] == changed['data_version']
+    rows = read_partition('06037', 2023)
+    edited = (rows['GEO_ID'] == csv.loc[0, 'GEO_ID']) & (rows['PLACE'] == csv.loc[0, 'PLACE'])
+    assert rows.loc[edited, 'B25058_001E'].tolist() == [1234]
+    assert os.stat(partition_path('06037', 2022)).st_mtime_ns == kept
+
+    # A missing partition rebuilds its year, and the catalog stops listing it until then
+    os.remove(partition_path('06037', 2022))
+    build = PartitionBuild(workers=1)
+    assert build.pending == [2022]
+    assert build.catalog()['counties']['06037']['years'] == [2023]
+    assert build.run()['data_version'] == changed['data_version']
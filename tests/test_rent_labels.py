@@ -0,0 +1,45 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_build import rent_labels, rent_caps, masterfile_path, years
+
+LABEL_COLUMNS = ['B25058_001E', 'B25057_001E', 'B25059_001E']
+
+
+# Purpose: Labels of one year the way app.py built them before the vectorized build, column by column
+def baseline_labels(df, year):
+    labels = dict()
+    for col in LABEL_COLUMNS:
+        label = '$' + df[col].astype(str)
+        label = label.str.replace('.0', '')
+        label[label == '$3501'] = 'Not available. Exceeds $3500!'
+        label[label == '$nan'] = 'Not Available!'
+        if year in [2010, 2011, 2012, 2013, 2014]:
+            label[label == '$2001'] = 'Not available. Exceeds $2000!'
+        labels[col] = label.to_numpy(dtype=object)
+    return labels
+
+
+# Purpose: The vectorized labels match the baseline for every year of the masterfiles
+@pytest.mark.parametrize('year', list(years))
+def test_rent_labels_match_baseline(year):
+    df = pd.read_csv(masterfile_path(year))
+    expected = baseline_labels(df, year)
+    for col in LABEL_COLUMNS:
+        values = df[col].to_numpy(dtype=float)
+        labels = rent_labels(values, rent_caps(np.full(len(values), year)))
+        assert labels.tolist() == expected[col].tolist()
+
+
+# Purpose: Caps apply per year, so $2001 is capped before 2015 only, and missing values are labelled
+def test_rent_labels_caps_and_missing():
+    values = np.array([2001, 2001, 3501, np.nan, 950])
+    labels = rent_labels(values, rent_caps(np.array([2014, 2015, 2015, 2015, 2010])))
+    assert labels.tolist() == ['Not available. Exceeds $2000!', '$2001', 'Not available. Exceeds $3500!',
+                               'Not Available!', '$950']
+    # The masterfiles exercise the $2001 cap before 2015, uncapped $2001 and the $3501 cap after it
+    early = pd.read_csv(masterfile_path(2014), usecols=LABEL_COLUMNS)
+    late = pd.read_csv(masterfile_path(2023), usecols=LABEL_COLUMNS)
+    assert (early == 2001).any().any() and (late == 2001).any().any() and (late == 3501).any().any()
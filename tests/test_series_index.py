@@ -0,0 +1,123 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import pandas as pd
+
+from data_build import (build_series_index, rent_caps, vintage_of, years, SERIES_MEASURES, SERIES_COLUMNS,
+                        MIN_SHARE, MIN_COVERAGE, MIN_CAPPED_SHARE)
+
+
+# ------------ FIXTURES ------------ #
+
+# Purpose: Masterfile rows of tracts of the 2010 vintage (GEO_ID 100...) and the 2020 vintage (200...)
+def synthetic_masterfile(rng, sources, targets):
+    rows = []
+    for geo_id, tract_years in [(geo_id, range(2010, 2020)) for geo_id in sources] + \
+                               [(geo_id, range(2020, 2024)) for geo_id in targets]:
+        for year in tract_years:
+            row = {'GEO_ID': geo_id, 'NAME': f'Census Tract {geo_id}', 'YEAR': year}
+            for estimate_col, moe_col in SERIES_MEASURES.values():
+                row[estimate_col] = float(rng.integers(500, 1800))
+                row[moe_col] = float(rng.integers(20, 200))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# Purpose: Interpolate one tract and year the slow way, overlap by overlap
+def reference_cell(masterfile, overlaps, target, year, estimate_col, moe_col):
+    cap = rent_caps(np.array([year]))[0]
+    rows = masterfile[masterfile['YEAR'] == year].set_index('GEO_ID')
+    covered = weighted = squared = capped = 0.0
+    unknown_moe = False
+    for source, share in overlaps.get(target, []):
+        if share < MIN_SHARE or source not in rows.index or np.isnan(rows.loc[source, estimate_col]):
+            continue
+        value, moe = rows.loc[source, estimate_col], rows.loc[source, moe_col]
+        covered += share
+        weighted += share * value
+        squared += (share * (0 if np.isnan(moe) else moe)) ** 2
+        capped += share if value >= cap else 0
+        unknown_moe |= bool(np.isnan(moe))
+    if covered < MIN_COVERAGE:
+        return None
+    if capped / covered >= MIN_CAPPED_SHARE:
+        return cap, np.nan
+    return weighted / covered, np.nan if unknown_moe else np.sqrt(squared) / covered
+
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: The scattered interpolation matches a per-target loop, with capped and NaN sources
+def test_interpolation_matches_per_target_loop():
+    rng = np.random.default_rng(7)
+    sources = list(range(100, 140))
+    targets = list(range(200, 240))
+    masterfile = synthetic_masterfile(rng, sources, targets)
+
+    # A capped estimate, a missing margin of error and a missing estimate in some source years
+    median, median_moe = SERIES_MEASURES['Median']
+    masterfile.loc[(masterfile['GEO_ID'] == 101) & (masterfile['YEAR'] == 2012), median] = 2001
+    masterfile.loc[(masterfile['GEO_ID'] == 102) & (masterfile['YEAR'] == 2016), median] = 3501
+    masterfile.loc[(masterfile['GEO_ID'] == 103) & (masterfile['YEAR'] == 2013), median_moe] = np.nan
+    masterfile.loc[(masterfile['GEO_ID'] == 104) & (masterfile['YEAR'] == 2014), median] = np.nan
+
+    # Each target overlaps two to four sources, with shares that may fall below MIN_SHARE
+    overlaps = dict()
+    source_ids, target_ids, shares = [], [], []
+    for target in targets:
+        picked = rng.choice(sources, size=rng.integers(2, 5), replace=False)
+        target_shares = rng.dirichlet(np.ones(len(picked))) * rng.uniform(0.4, 1.0)
+        overlaps[target] = list(zip(picked.tolist(), target_shares.tolist()))
+        source_ids += picked.tolist()
+        target_ids += [target] * len(picked)
+        shares += target_shares.tolist()
+    # The capped tracts dominate one target, and barely touch another
+    for target, capped_shares in [(200, [(101, 0.9), (110, 0.1)]), (201, [(101, 0.01), (111, 0.99)]),
+                                  (202, [(102, 0.7), (112, 0.3)]), (203, [(103, 0.5), (113, 0.5)]),
+                                  (204, [(104, 0.6), (114, 0.4)])]:
+        keep = [i for i, t in enumerate(target_ids) if t != target]
+        source_ids = [source_ids[i] for i in keep] + [source for source, _ in capped_shares]
+        shares = [shares[i] for i in keep] + [share for _, share in capped_shares]
+        target_ids = [target_ids[i] for i in keep] + [target] * len(capped_shares)
+        overlaps[target] = capped_shares
+
+    source_ids, target_ids, shares = np.array(source_ids), np.array(target_ids), np.array(shares)
+    crosswalk = {'VINTAGES': np.array([2010, 2020]), 'SOURCE': source_ids, 'TARGET': target_ids,
+                 'AREA': shares * 1e6, 'SOURCE_AREA': np.full(len(shares), 1e6), 'TARGET_AREA': np.full(len(shares), 1e6)}
+    index = build_series_index(masterfile, crosswalk)
+
+    checked = 0
+    for target in targets:
+        row = int(np.searchsorted(index['GEO_ID'], target))
+        for col, year in enumerate(index['YEAR']):
+            if vintage_of(year) != 2010:
+                continue
+            for estimate_col, moe_col in SERIES_MEASURES.values():
+                expected = reference_cell(masterfile, overlaps, target, year, estimate_col, moe_col)
+                estimate, moe = index[estimate_col][row, col], index[moe_col][row, col]
+                if expected is None:
+                    # INTERPOLATED may still be set by another measure of the same tract and year
+                    assert np.isnan(estimate)
+                    continue
+                assert index['INTERPOLATED'][row, col]
+                np.testing.assert_allclose(estimate, expected[0], rtol=1e-5)
+                np.testing.assert_allclose(moe, expected[1], rtol=1e-5, equal_nan=True)
+                checked += 1
+    assert checked > 0
+
+    # The spot checks behind the loop: mostly capped, barely capped, missing margin
+    col_2012, col_2013, col_2016 = 2012 - years.start, 2013 - years.start, 2016 - years.start
+    row = lambda geo_id: int(np.searchsorted(index['GEO_ID'], geo_id))
+    assert index[median][row(200), col_2012] == 2001
+    assert index[median][row(201), col_2012] < 2001
+    assert index[median][row(202), col_2016] == 3501
+    assert np.isnan(index[median_moe][row(203), col_2013])
+
+
+# Purpose: Tracts of the same vintage are laid out as is, without interpolation
+def test_series_index_without_crosswalk():
+    masterfile = synthetic_masterfile(np.random.default_rng(1), [100, 101], [200])
+    index = build_series_index(masterfile)
+    assert index['GEO_ID'].tolist() == [100, 101, 200]
+    assert set(index) == {'GEO_ID', 'NAME', 'YEAR', 'INTERPOLATED'} | set(SERIES_COLUMNS)
+    assert np.isnan(index['B25058_001E'][2, 0]) and not index['INTERPOLATED'].any()
@@ -0,0 +1,144 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import shapely
+
+from tile_build import (encode_tile, encode_feature, tile_rings, EXTENT, LAYER_NAME, POLYGON,
+                        MOVE_TO, LINE_TO, CLOSE_PATH)
+
+
+# ------------ DECODING ------------ #
+# A minimal reader of the protobuf messages written by tile_build.py, following
+# the vector tile specification rather than the encoder.
+
+# Purpose: Read a varint at a position, returning it and the next position
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+# Purpose: Fields of a message as (number, value) pairs, values being ints or bytes
+def read_fields(data):
+    fields, pos = [], 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        else:
+            assert wire_type == 2
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        fields.append((number, value))
+    return fields
+
+
+# Purpose: Decode a geometry command stream into rings of absolute vertices, checking the commands
+def decode_geometry(data):
+    integers, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        integers.append(value)
+    rings, cursor, i = [], np.zeros(2, dtype=np.int64), 0
+    while i < len(integers):
+        command, count = integers[i] & 7, integers[i] >> 3
+        i += 1
+        if command == CLOSE_PATH:
+            assert count == 1 and len(rings[-1]) >= 3
+            continue
+        if command == MOVE_TO:
+            assert count == 1
+            rings.append([])
+        else:
+            # Each ring is a MoveTo, one LineTo of the remaining vertices and a ClosePath
+            assert command == LINE_TO and count >= 2 and len(rings[-1]) == 1
+        for _ in range(count):
+            zigzag = np.array(integers[i:i + 2], dtype=np.int64)
+            i += 2
+            cursor = cursor + ((zigzag >> 1) ^ -(zigzag & 1))
+            rings[-1].append(cursor.copy())
+    return [np.array(ring) for ring in rings]
+
+
+# Purpose: Decode a tile into its layers, each a dict of name, extent, version and features
+def decode_tile(data):
+    layers = []
+    for number, layer in read_fields(data):
+        assert number == 3
+        decoded = {'features': []}
+        for field, value in read_fields(layer):
+            if field == 1:
+                decoded['name'] = value.decode()
+            elif field == 5:
+                decoded['extent'] = value
+            elif field == 15:
+                decoded['version'] = value
+            elif field == 2:
+                feature = dict(read_fields(value))
+                decoded['features'].append({'id': feature[1], 'type': feature[3],
+                                            'rings': decode_geometry(feature[4])})
+        layers.append(decoded)
+    return layers
+
+
+# Purpose: Twice the signed area of a ring, positive when clockwise on screen (y pointing down)
+def ring_area(ring):
+    return np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1])
+
+
+
+# ------------ TESTS ------------ #
+
+# Purpose: Encoded tiles decode back to the same features, ids, vertices and winding
+def test_tile_round_trip():
+    # Exterior drawn counterclockwise and hole clockwise on screen, so both must be rewound
+    square = shapely.Polygon([(10, 10), (10, 90), (90, 90), (90, 10)], holes=[[(30, 30), (60, 30), (60, 60), (30, 60)]])
+    # A second polygon with a vertex that collapses when rounded, and a degenerate line part left by clipping
+    triangle = shapely.Polygon([(200.2, 100), (200.4, 100), (300, 100), (250, 180)])
+    multi = shapely.GeometryCollection([triangle, shapely.LineString([(0, 0), (0, 5)]),
+                                        shapely.Polygon([(500, 500), (520, 500), (510, 530)])])
+    geo_ids = [6037101110, 6037980000]
+    rings = [tile_rings(square, (0, 0), 1), tile_rings(multi, (0, 0), 1)]
+
+    layers = decode_tile(encode_tile([encode_feature(geo_id, r) for geo_id, r in zip(geo_ids, rings)]))
+    assert len(layers) == 1
+    layer = layers[0]
+    assert (layer['name'], layer['extent'], layer['version']) == (LAYER_NAME, EXTENT, 2)
+    assert [feature['id'] for feature in layer['features']] == geo_ids
+    assert all(feature['type'] == POLYGON for feature in layer['features'])
+
+    exterior, hole = layer['features'][0]['rings']
+    assert ring_area(exterior) > 0 and ring_area(hole) < 0
+    assert {tuple(v) for v in exterior} == {(10, 10), (10, 90), (90, 90), (90, 10)}
+    assert {tuple(v) for v in hole} == {(30, 30), (60, 30), (60, 60), (30, 60)}
+
+    triangle_ring, other_ring = layer['features'][1]['rings']
+    assert ring_area(triangle_ring) > 0 and ring_area(other_ring) > 0
+    assert {tuple(v) for v in triangle_ring} == {(200, 100), (300, 100), (250, 180)}
+    assert len(triangle_ring) == 3
+    assert {tuple(v) for v in other_ring} == {(500, 500), (520, 500), (510, 530)}
+    # Decoding went through the deltas, so every ring matches the encoder's own rings exactly
+    for decoded, expected in zip(layer['features'][1]['rings'], rings[1]):
+        assert np.array_equal(decoded, expected)
+
+
+# Purpose: Features are placed in tile units relative to the tile's origin and scale
+def test_tile_rings_scale_and_origin():
+    n = 2 ** 10
+    x, y = 300, 400
+    corner = np.array([x / n, y / n])
+    polygon = shapely.box(*(corner + 0.25 / n), *(corner + 0.75 / n))
+    (ring,) = tile_rings(polygon, (x / n, y / n), n * EXTENT)
+    assert ring.min() == EXTENT // 4 and ring.max() == 3 * EXTENT // 4
+    assert ring_area(ring) > 0
+
+
+# Purpose: A tile without features is empty
+def test_empty_tile():
+    assert encode_tile([]) == b''
+    assert decode_tile(b'') == []
@@ -0,0 +1,264 @@
+# ------------ LIBRARIES ------------ #
+import numpy as np
+import shapely
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+
+from geometry_build import geometry_path, years, vintage_of, source_paths, read_source, simplify_tracts, write_output
+
+
+# ------------ PATHS ------------ #
+tiles_path = f'{geometry_path}tiles/'
+
+metadata_path = f'{tiles_path}tiles.json'
+
+
+# ------------ VECTOR TILES ------------ #
+# The county-wide map draws every tract of the county at once, which would be far
+# too heavy as GeoJSON. Instead, each tract vintage is cut into Mapbox Vector
+# Tiles offline, from the per-place geometries in assets/{year}/:
+#
+#   geometry/tiles/{vintage}/{z}/{x}/{y}.pbf   one layer of tract polygons, with the GEO_ID as feature id
+#   geometry/tiles/tiles.json                  zoom range and bounds of each vintage
+#
+# Tiles carry geometry only. The map joins the rents of the selected year on the
+# client by feature id, so changing the year restyles the tiles already loaded
+# instead of fetching new ones. Every tile within the bounds of a vintage is
+# written, empty or not, so static hosts never answer 404 inside them; past
+# MAX_ZOOM the map scales up the MAX_ZOOM tiles.
+
+MIN_ZOOM = 6
+MAX_ZOOM = 13
+
+# Size of a tile and of the margin around it kept when clipping, in tile units
+EXTENT = 4096
+BUFFER = 64
+
+# Polygons are simplified at each zoom with this tolerance, in tile units
+TOLERANCE = 1
+
+LAYER_NAME = 'tracts'
+
+# Bump whenever the layout of the tiles changes, so that every vintage is rebuilt
+TILES_FORMAT = 1
+
+# Geometry type and command ids of the vector tile specification
+POLYGON = 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+
+# Purpose: Path to a tile of a vintage
+def tile_path(vintage, z, x, y):
+    return f'{tiles_path}{vintage}/{z}/{x}/{y}.pbf'
+
+
+# Purpose: Read the tiles' metadata, or None if tile_build.py has not been run
+def read_metadata():
+    try:
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if metadata.get('format') != TILES_FORMAT:
+        return None
+    return metadata
+
+
+# Purpose: Read every tract of the county in a vintage, across the per-place files of its years
+def read_county_tracts(vintage):
+    """
+    A tract spanning several places, or drawn in several years of the vintage,
+    is kept once.
+    """
+    tracts = dict()
+    for year in years:
+        if vintage_of(year) != vintage:
+            continue
+        for path in source_paths(year):
+            for geo_id, geom in zip(*read_source(path)):
+                tracts.setdefault(int(geo_id), geom)
+    return np.array(list(tracts), dtype=np.int64), np.array(list(tracts.values()), dtype=object)
+
+
+# Purpose: Project longitude and latitude onto Web Mercator world units, from (0, 0) at the top left to (1, 1)
+def to_world(geoms):
+    def project(coords):
+        lon, lat = coords[:, 0], np.radians(coords[:, 1])
+        return np.column_stack([(lon + 180) / 360, 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)])
+    return shapely.transform(geoms, project)
+
+
+
+# ------------ ENCODING ------------ #
+# Tiles are small protocol buffer messages (Tile > Layer > Feature), written by
+# hand rather than through a protobuf library. Geometries are command streams of
+# zigzag-encoded deltas: MoveTo the first vertex of a ring, LineTo the rest,
+# ClosePath. Exterior rings wind clockwise on screen (positive area with y
+# pointing down) and holes the other way.
+
+# Purpose: Encode an unsigned integer as a protobuf varint
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# Purpose: Encode a varint field
+def varint_field(number, value):
+    return encode_varint(number << 3) + encode_varint(value)
+
+
+# Purpose: Encode a length-delimited field (string, message or packed array)
+def bytes_field(number, data):
+    return encode_varint(number << 3 | 2) + encode_varint(len(data)) + data
+
+
+# Purpose: Integer vertices of a ring in tile units, wound as required, or None if it collapses
+def tile_ring(ring, origin, scale, sign):
+    coords = np.rint((np.asarray(ring.coords)[:-1, :2] - origin) * scale).astype(np.int64)
+    # Rounding leaves repeated vertices behind
+    coords = coords[np.any(coords != np.roll(coords, 1, axis=0), axis=1)]
+    if len(coords) < 3:
+        return None
+    area = np.sum(coords[:, 0] * np.roll(coords[:, 1], -1) - np.roll(coords[:, 0], -1) * coords[:, 1])
+    if area == 0:
+        return None
+    return coords if np.sign(area) == sign else coords[::-1]
+
+
+# Purpose: Rings of a clipped tract in tile units, each exterior followed by its holes
+def tile_rings(geom, origin, scale):
+    rings = []
+    # Clipping may also leave lines or points along the tile's edge
+    for polygon in shapely.get_parts(geom):
+        if polygon.geom_type != 'Polygon':
+            continue
+        exterior = tile_ring(polygon.exterior, origin, scale, 1)
+        if exterior is None:
+            continue
+        rings.append(exterior)
+        rings.extend(ring for ring in (tile_ring(interior, origin, scale, -1) for interior in polygon.interiors)
+                     if ring is not None)
+    return rings
+
+
+# Purpose: Encode rings as a geometry command stream
+def encode_geometry(rings):
+    commands = []
+    cursor = np.zeros((1, 2), dtype=np.int64)
+    for ring in rings:
+        deltas = np.diff(ring, axis=0, prepend=cursor)
+        cursor = ring[-1:]
+        zigzag = (deltas << 1) ^ (deltas >> 63)
+        commands.append(MOVE_TO | 1 << 3)
+        commands.extend(zigzag[0].tolist())
+        commands.append(LINE_TO | (len(ring) - 1) << 3)
+        commands.extend(zigzag[1:].ravel().tolist())
+        commands.append(CLOSE_PATH | 1 << 3)
+    return b''.join(map(encode_varint, commands))
+
+
+# Purpose: Encode a tract feature, with its GEO_ID as id
+def encode_feature(geo_id, rings):
+    return varint_field(1, geo_id) + varint_field(3, POLYGON) + bytes_field(4, encode_geometry(rings))
+
+
+# Purpose: Encode a tile with one layer of tract features
+def encode_tile(features):
+    if not features:
+        return b''
+    layer = (varint_field(15, 2) + bytes_field(1, LAYER_NAME.encode())
+             + b''.join(bytes_field(2, feature) for feature in features)
+             + varint_field(5, EXTENT))
+    return bytes_field(3, layer)
+
+
+
+# ------------ BUILD ------------ #
+
+# Purpose: Cut the tracts of a vintage into the tiles of one zoom level
+def build_zoom(vintage, z, geo_ids, world_geoms):
+    n = 2 ** z
+    simplified = simplify_tracts(world_geoms, TOLERANCE / (EXTENT * n))
+    tree = shapely.STRtree(simplified)
+    pad = BUFFER / EXTENT
+
+    min_x, min_y, max_x, max_y = shapely.total_bounds(world_geoms)
+    stats = {'tiles': 0, 'bytes': 0, 'gzip_bytes': 0}
+    for x in range(int(min_x * n), int(max_x * n) + 1):
+        for y in range(int(min_y * n), int(max_y * n) + 1):
+            box = ((x - pad) / n, (y - pad) / n, (x + 1 + pad) / n, (y + 1 + pad) / n)
+            rows = np.sort(tree.query(shapely.box(*box), predicate='intersects'))
+            clipped = shapely.clip_by_rect(simplified[rows], *box)
+
+            features = []
+            for row, geom in zip(rows, clipped):
+                rings = tile_rings(geom, (x / n, y / n), n * EXTENT)
+                if rings:
+                    features.append(encode_feature(int(geo_ids[row]), rings))
+            data = encode_tile(features)
+            compressed = write_output(tile_path(vintage, z, x, y), data)
+            stats['tiles'] += 1
+            stats['bytes'] += len(data)
+            stats['gzip_bytes'] += len(compressed)
+    return stats
+
+
+# Purpose: Build the tiles of the vintages covering the given years, across a process pool
+def build_tiles(build_years=years, force=False, workers=None):
+    """
+    A vintage is rebuilt only when one of its source files is newer than the
+    metadata, unless forced. Returns the metadata.
+    """
+    metadata = read_metadata() or {'format': TILES_FORMAT, 'layer': LAYER_NAME, 'vintages': dict()}
+    metadata.update({'minzoom': MIN_ZOOM, 'maxzoom': MAX_ZOOM})
+    built = os.path.getmtime(metadata_path) if os.path.exists(metadata_path) else 0
+
+    stale = []
+    for vintage in sorted({vintage_of(year) for year in build_years}):
+        paths = [path for year in years if vintage_of(year) == vintage for path in source_paths(year)]
+        if force or str(vintage) not in metadata['vintages'] or max(map(os.path.getmtime, paths)) > built:
+            stale.append(vintage)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for vintage in stale:
+            geo_ids, geoms = read_county_tracts(vintage)
+            world_geoms = to_world(geoms)
+            shutil.rmtree(f'{tiles_path}{vintage}/', ignore_errors=True)
+            futures = [executor.submit(build_zoom, vintage, z, geo_ids, world_geoms)
+                       for z in range(MIN_ZOOM, MAX_ZOOM + 1)]
+            stats = [future.result() for future in futures]
+            metadata['vintages'][str(vintage)] = {
+                'bounds': [round(float(value), 6) for value in shapely.total_bounds(geoms)],
+                'tracts': len(geo_ids),
+                'tiles': sum(row['tiles'] for row in stats),
+                'bytes': sum(row['bytes'] for row in stats),
+                'gzip_bytes': sum(row['gzip_bytes'] for row in stats)
+            }
+
+    os.makedirs(tiles_path, exist_ok=True)
+    with open(metadata_path, 'w') as file:
+        json.dump(metadata, file, indent=1)
+    return metadata
+
+
+
+# ------------ EXECUTE THE BUILD ------------ #
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cut the tracts of the county into vector tiles for the county-wide map.')
+    parser.add_argument('--years', type=int, nargs='+', default=list(years),
+                        help='rebuild the vintages covering these years')
+    parser.add_argument('--workers', type=int, default=None, help='size of the process pool')
+    parser.add_argument('--force', action='store_true', help='rebuild vintages that are already up to date')
+    args = parser.parse_args()
+
+    metadata = build_tiles(args.years, force=args.force, workers=args.workers)
+    for vintage, row in sorted(metadata['vintages'].items()):
+        print(f"{vintage}: {row['tracts']} tracts in {row['tiles']} tiles (zooms {metadata['minzoom']} to "
+              f"{metadata['maxzoom']}), {row['bytes'] / 1e6:.1f} MB ({row['gzip_bytes'] / 1e6:.1f} MB gzipped)")